@@ -12,6 +12,7 @@ install_requires = [
     'pydicom>=1.0.2',
     'nibabel>=3.2.1',
     'natsort>=7.1.1',
+    'numpy>=1.19',
     'fasteners>=0.7.0',
     'docker>=5.0.2',
     'neurodocker==0.7.0',
@@ -0,0 +1,158 @@
+from itertools import product
+import numpy as np
+
+
+DEFAULT_CHUNK_SIZE = 64 * 2 ** 20  # Bytes of each array read per slab
+
+
+def array_order(array):
+    """Returns the order of the elements of an array or array proxy on disk,
+    i.e. 'C' if the last axis varies fastest or 'F' if the first axis does
+
+    Parameters
+    ----------
+    array : array-like
+        A numpy array (or memmap) or a lazy proxy to an array on disk, such
+        as the `dataobj` of a nibabel image
+
+    Returns
+    -------
+    str
+        'C' or 'F'
+    """
+    if isinstance(array, np.ndarray):
+        flags = array.flags
+        return 'F' if flags.f_contiguous and not flags.c_contiguous else 'C'
+    return getattr(array, 'order', 'C')
+
+
+def iter_slabs(shape, itemsize, chunk_size=DEFAULT_CHUNK_SIZE, order='C'):
+    """Splits an array into slabs that are contiguous on disk (for the given
+    order) and no larger than the chunk size, unless a single row of the
+    array is larger than it
+
+    Parameters
+    ----------
+    shape : tuple[int]
+        The shape of the array
+    itemsize : int
+        The number of bytes of each element of the array
+    chunk_size : int
+        The maximum number of bytes in each slab
+    order : str
+        The order of the array on disk, 'C' or 'F'
+
+    Yields
+    ------
+    tuple[slice]
+        The slices that select each slab of the array
+    """
+    ndim = len(shape)
+    if not ndim:
+        yield ()
+        return
+    # Axes from the slowest to the fastest varying
+    axes = list(range(ndim)) if order == 'C' else list(reversed(range(ndim)))
+    sizes = [shape[a] for a in axes]
+    # Find the slowest varying axis that needs to be split, including all
+    # faster varying axes in full in each slab
+    split = ndim - 1
+    block = itemsize
+    while split > 0 and block * sizes[split] <= chunk_size:
+        block *= sizes[split]
+        split -= 1
+    step = max(1, chunk_size // block)
+    for outer in product(*(range(s) for s in sizes[:split])):
+        for start in range(0, sizes[split], step):
+            slices = [slice(None)] * ndim
+            for axis, index in zip(axes, outer):
+                slices[axis] = slice(index, index + 1)
+            slices[axes[split]] = slice(start, start + step)
+            yield tuple(slices)
+
+
+def iter_slab_pairs(array, other, chunk_size=None):
+    """Reads matching slabs of two arrays (or array proxies) of the same shape
+    in the order of the first array on disk, so only a pair of slabs is held
+    in memory at a time
+
+    Parameters
+    ----------
+    array : array-like
+        The first array or array proxy
+    other : array-like
+        The second array or array proxy
+    chunk_size : int, optional
+        The maximum number of bytes read from each array per slab, by default
+        DEFAULT_CHUNK_SIZE
+
+    Yields
+    ------
+    tuple[np.ndarray, np.ndarray]
+        The matching slabs of the arrays
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    itemsize = max(np.dtype(array.dtype).itemsize,
+                   np.dtype(other.dtype).itemsize)
+    for slices in iter_slabs(array.shape, itemsize, chunk_size,
+                             order=array_order(array)):
+        yield np.asarray(array[slices]), np.asarray(other[slices])
+
+
+def arrays_equal(array, other, chunk_size=None):
+    """Checks whether two arrays (or array proxies) are equal slab by slab,
+    returning as soon as a slab differs
+
+    Parameters
+    ----------
+    array : array-like
+        The first array or array proxy
+    other : array-like
+        The second array or array proxy
+    chunk_size : int, optional
+        The maximum number of bytes read from each array per slab
+
+    Returns
+    -------
+    bool
+        Whether the arrays have the same shape and values
+    """
+    if tuple(array.shape) != tuple(other.shape):
+        return False
+    return all(np.array_equal(a, b)
+               for a, b in iter_slab_pairs(array, other, chunk_size))
+
+
+def rms_diff(array, other, chunk_size=None, stop_above=None):
+    """Calculates the root of the sum of the squared differences between two
+    arrays (or array proxies) incrementally, slab by slab
+
+    Parameters
+    ----------
+    array : array-like
+        The first array or array proxy
+    other : array-like
+        The second array or array proxy
+    chunk_size : int, optional
+        The maximum number of bytes read from each array per slab
+    stop_above : float, optional
+        Return as soon as the accumulated difference exceeds this value
+        instead of reading the rest of the arrays
+
+    Returns
+    -------
+    float
+        The RMS difference (or the partial difference once it exceeds
+        `stop_above`). Infinite if the arrays have different shapes
+    """
+    if tuple(array.shape) != tuple(other.shape):
+        return np.inf
+    sum_sq = 0.0
+    stop_sq = stop_above ** 2 if stop_above is not None else None
+    for a, b in iter_slab_pairs(array, other, chunk_size):
+        sum_sq += float(np.sum(
+            (a.astype(np.float64) - b.astype(np.float64)) ** 2))
+        if stop_sq is not None and sum_sq > stop_sq:
+            break
+    return np.sqrt(sum_sq)
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+import typing as ty
+from contextlib import closing
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import attr
+from attr.converters import optional
+from arcana.exceptions import ArcanaUsageError
+
+
+logger = logging.getLogger('arcana')
+
+DEFAULT_MAX_ENTRIES = 100000
+
+
+@attr.s
+class ChecksumEngine():
+    """Calculates the digests of files, hashing them concurrently in a
+    thread pool (hashlib releases the GIL while it hashes large buffers) and
+    caching the digests against the device, inode, size and modification time
+    of each file so that unchanged files are never read twice. If a cache path
+    is provided the digests are also saved to an on-disk SQLite database so
+    they persist between processes. Only the `max_entries` most recently used
+    digests are held in memory.
+
+    Parameters
+    ----------
+    algorithm : str
+        The default hashlib algorithm used to calculate the digests. Stores
+        that compare the digests with ones provided by a remote server (e.g.
+        XNAT) request 'md5' explicitly, but faster algorithms (e.g. 'blake2b')
+        can be used for digests that are only compared with each other.
+    cache_path : Path, optional
+        The path of the SQLite database to persist the digests in. If None,
+        digests are only cached for the lifetime of the engine
+    max_workers : int, optional
+        The maximum number of threads used to hash files concurrently, by
+        default that of `concurrent.futures.ThreadPoolExecutor`
+    max_entries : int
+        The maximum number of digests cached in memory
+    """
+
+    algorithm: str = attr.ib(default='md5')
+    cache_path: Path = attr.ib(default=None, converter=optional(Path))
+    max_workers: int = attr.ib(default=None)
+    max_entries: int = attr.ib(default=DEFAULT_MAX_ENTRIES)
+    _memory: ty.Dict[tuple, str] = attr.ib(factory=OrderedDict, init=False,
+                                           repr=False, eq=False)
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False, eq=False)
+
+    HASH_CHUNK_SIZE = 2 ** 20  # 1MB in calc. checksums to avoid mem. issues
+
+    @algorithm.validator
+    def algorithm_validator(self, _, algorithm):
+        if algorithm not in hashlib.algorithms_available:
+            raise ArcanaUsageError(
+                f"Unrecognised checksum algorithm '{algorithm}', can be one "
+                f"of {sorted(hashlib.algorithms_available)}")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def digest(self, path, algorithm=None):
+        """Returns the hex digest of a single file
+
+        Parameters
+        ----------
+        path : str or Path
+            The path of the file
+        algorithm : str, optional
+            The hashlib algorithm to use, by default that of the engine
+
+        Returns
+        -------
+        str
+            The hex digest of the file
+        """
+        return self.digests([path], algorithm=algorithm)[Path(path)]
+
+    def digests(self, paths, algorithm=None):
+        """Returns the hex digests of a number of files, only reading the
+        files that have been modified since their digests were last cached
+
+        Parameters
+        ----------
+        paths : Iterable[str or Path]
+            The paths of the files
+        algorithm : str, optional
+            The hashlib algorithm to use, by default that of the engine
+
+        Returns
+        -------
+        Dict[Path, str]
+            The hex digests of the files keyed by their paths, in the order
+            they were provided
+        """
+        if algorithm is None:
+            algorithm = self.algorithm
+        else:
+            self.algorithm_validator(None, algorithm)
+        keys = {}
+        for path in paths:
+            path = Path(path)
+            stat = path.stat()
+            keys[path] = (algorithm, stat.st_dev, stat.st_ino, stat.st_size,
+                          stat.st_mtime_ns)
+        digests = {}
+        with self._lock:
+            for path, key in keys.items():
+                try:
+                    digests[path] = self._memory[key]
+                except KeyError:
+                    pass
+                else:
+                    self._memory.move_to_end(key)
+        missing = [p for p in keys if p not in digests]
+        if missing and self.cache_path is not None:
+            loaded = self._load([keys[p] for p in missing])
+            for path in missing:
+                try:
+                    digests[path] = loaded[keys[path]]
+                except KeyError:
+                    pass
+            missing = [p for p in missing if p not in digests]
+        if missing:
+            logger.debug("Hashing %d of %d files with %s", len(missing),
+                         len(keys), algorithm)
+            if len(missing) == 1:
+                calculated = [self.hash_file(missing[0], algorithm)]
+            else:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    calculated = list(pool.map(
+                        lambda p: self.hash_file(p, algorithm), missing))
+            new = {keys[p]: d for p, d in zip(missing, calculated)}
+            digests.update(zip(missing, calculated))
+            if self.cache_path is not None:
+                self._save(new)
+        with self._lock:
+            self._memory.update((keys[p], d) for p, d in digests.items())
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+        return {p: digests[p] for p in keys}
+
+    @classmethod
+    def hash_file(cls, path, algorithm):
+        """Calculates the hex digest of a file, reading it in chunks so large
+        files don't need to be loaded into memory"""
+        fhash = hashlib.new(algorithm)
+        buffer = bytearray(cls.HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                fhash.update(view[:n])
+        return fhash.hexdigest()
+
+    def _connect(self):
+        os.makedirs(self.cache_path.parent, exist_ok=True)
+        conn = sqlite3.connect(str(self.cache_path), timeout=30)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'algorithm TEXT, device INTEGER, inode INTEGER, size INTEGER, '
+            'mtime_ns INTEGER, digest TEXT, '
+            'PRIMARY KEY (algorithm, device, inode, size, mtime_ns))')
+        return conn
+
+    def _load(self, keys):
+        with closing(self._connect()) as conn:
+            loaded = {}
+            for key in keys:
+                row = conn.execute(
+                    'SELECT digest FROM digests WHERE algorithm=? AND '
+                    'device=? AND inode=? AND size=? AND mtime_ns=?',
+                    key).fetchone()
+                if row is not None:
+                    loaded[key] = row[0]
+        return loaded
+
+    def _save(self, digests):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                [k + (d,) for k, d in digests.items()])
+
+
+_default_engine = ChecksumEngine()
+
+
+def default_checksum_engine():
+    """Returns the checksum engine used by file groups and stores that haven't
+    been assigned one explicitly"""
+    return _default_engine
+
+
+def set_default_checksum_engine(engine):
+    """Sets the checksum engine used by file groups and stores that haven't
+    been assigned one explicitly (e.g. one with a persistent cache path)
+
+    Parameters
+    ----------
+    engine : ChecksumEngine
+        The engine to use by default
+    """
+    global _default_engine
+    _default_engine = engine
@@ -0,0 +1,272 @@
+import os
+import stat
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+from contextlib import closing
+from pathlib import Path
+import attr
+from arcana.core.utils import get_class_info
+from .enum import CopyMode
+from .materialize import materialize
+from .checksum import default_checksum_engine
+
+
+logger = logging.getLogger('arcana')
+
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+@attr.s
+class ConversionCache():
+    """A content-addressed cache of the results of format conversions, which
+    is shared between pipelines and runs. Results are keyed by the checksums
+    of the files converted and the identity of the converter (the class or
+    function of its task, the version of the package it belongs to, the
+    keyword arguments passed to it and the formats it converts between), so a
+    file group is only converted once by a given converter however many
+    pipelines require the conversion. The least recently used results are
+    evicted when the total size of the cache exceeds its cap.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        The directory the converted files and the index of the cache are
+        stored in
+    max_size : int, optional
+        The maximum total size of the converted files in the cache in bytes.
+        If None the cache is unbounded
+    copy_mode : CopyMode
+        The strategy used to materialise cached results in the working
+        directories of the conversion tasks and to add new results to the
+        cache. By default clones (copy-on-write reflinks where the
+        file-system supports them, falling back to copies), so writes to the
+        materialised files can't modify the cache. If hard links are used
+        instead, the files of cache entries are made read-only and their
+        digests are checked before they are materialised, so entries that
+        have been modified through a link are discarded.
+    checksum_engine : ChecksumEngine, optional
+        The engine used to calculate the checksums of the files to convert,
+        by default the engine returned by `default_checksum_engine`
+    """
+
+    cache_dir: Path = attr.ib(converter=Path)
+    max_size: int = attr.ib(default=None)
+    copy_mode: CopyMode = attr.ib(default=CopyMode.clone,
+                                  converter=lambda m: CopyMode[str(m)])
+    checksum_engine = attr.ib(default=None)
+
+    INDEX_FNAME = 'index.sqlite'
+    # Copy modes that share the files of cache entries with their copies
+    SHARED_MODES = (CopyMode.hardlink, CopyMode.symlink)
+
+    def key(self, converter, file_group):
+        """Returns the key of the result of converting a file group with a
+        converter
+
+        Parameters
+        ----------
+        converter : FileGroupConverter
+            The converter
+        file_group : FileGroup
+            The file group to convert
+
+        Returns
+        -------
+        str
+            The hex digest of the checksums and the converter identity
+        """
+        engine = (self.checksum_engine if self.checksum_engine is not None
+                  else default_checksum_engine())
+        identity = {
+            'task': get_class_info(converter.task),
+            'kwargs': {k: str(v) for k, v in converter.task_kwargs.items()},
+            'inputs': converter.inputs,
+            'outputs': converter.outputs,
+            'from_format': repr(converter.from_format),
+            'to_format': repr(converter.to_format),
+            'checksums': file_group.calculate_checksums(
+                engine=engine, algorithm='sha256')}
+        return hashlib.sha256(
+            json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key, file_format, dest_dir):
+        """Materialises a cached conversion result in the destination
+        directory
+
+        Parameters
+        ----------
+        key : str
+            The key of the result (see `key`)
+        file_format : FileFormat
+            The format of the result
+        dest_dir : Path
+            The directory to materialise the files of the result in
+
+        Returns
+        -------
+        FileGroup or None
+            The cached result, or None if it isn't in the cache
+        """
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                'SELECT primary_file, side_cars, digest FROM entries '
+                'WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE entries SET last_used=? WHERE key=?',
+                         (time.time(), key))
+        primary_file, side_cars, digest = row[0], json.loads(row[1]), row[2]
+        entry_dir = self.cache_dir / key
+        if not (entry_dir / primary_file).exists():
+            # Evicted by another process since the index was read
+            return None
+        if (self.copy_mode in self.SHARED_MODES
+                and self._digest(entry_dir) != digest):
+            logger.warning(
+                "Discarding conversion result %s as it has been modified "
+                "since it was cached", key)
+            self._remove(key)
+            return None
+        dest_dir = Path(dest_dir)
+        for fname in [primary_file] + list(side_cars.values()):
+            materialize(entry_dir / fname, dest_dir / fname, self.copy_mode)
+        logger.debug("Found cached conversion result %s to %s", key,
+                     file_format)
+        return file_format.from_path(
+            str(dest_dir / primary_file),
+            side_cars={n: dest_dir / f for n, f in side_cars.items()})
+
+    def put(self, key, file_group):
+        """Adds a conversion result to the cache, evicting the least recently
+        used results if the size cap is exceeded
+
+        Parameters
+        ----------
+        key : str
+            The key of the result (see `key`)
+        file_group : FileGroup
+            The converted file group
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_dir = self.cache_dir / key
+        side_cars = {n: Path(p).name for n, p in file_group.side_cars.items()}
+        primary_file = Path(file_group.fs_path).name
+        # Populate a temporary directory that is renamed into place so that
+        # other processes never see partial entries
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.cache_dir,
+                                        prefix='.tmp-' + key[:8]))
+        for src, fname in zip(file_group.fs_paths,
+                              [primary_file] + list(side_cars.values())):
+            materialize(src, tmp_dir / fname, self.copy_mode)
+        size = sum(f.stat().st_size for f in tmp_dir.rglob('*')
+                   if f.is_file())
+        digest = self._digest(tmp_dir)
+        if self.copy_mode in self.SHARED_MODES:
+            # Guard against in-place writes through the shared files
+            for fpath in tmp_dir.rglob('*'):
+                if fpath.is_file() and not fpath.is_symlink():
+                    fpath.chmod(fpath.stat().st_mode & ~WRITE_BITS)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # Added by another process in the meantime
+            shutil.rmtree(tmp_dir)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (key, primary_file, json.dumps(side_cars), size, time.time(),
+                 digest))
+        logger.debug("Added conversion result %s (%d bytes) to cache", key,
+                     size)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def evict(self, max_size):
+        """Evicts the least recently used results until the total size of the
+        cache is no greater than the given size
+
+        Parameters
+        ----------
+        max_size : int
+            The size to reduce the cache to in bytes
+
+        Returns
+        -------
+        list[str]
+            The keys of the evicted results
+        """
+        evicted = []
+        with closing(self._connect()) as conn, conn:
+            total = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            rows = conn.execute(
+                'SELECT key, size FROM entries ORDER BY last_used').fetchall()
+            for key, size in rows:
+                if total <= max_size:
+                    break
+                conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                shutil.rmtree(self.cache_dir / key, ignore_errors=True)
+                total -= size
+                evicted.append(key)
+        if evicted:
+            logger.info("Evicted %d results from conversion cache at %s",
+                        len(evicted), self.cache_dir)
+        return evicted
+
+    def _remove(self, key):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM entries WHERE key=?', (key,))
+        shutil.rmtree(self.cache_dir / key, ignore_errors=True)
+
+    def _digest(self, entry_dir):
+        "A digest of the names and contents of the files of an entry"
+        engine = (self.checksum_engine if self.checksum_engine is not None
+                  else default_checksum_engine())
+        fpaths = sorted(f for f in Path(entry_dir).rglob('*') if f.is_file())
+        digests = engine.digests(fpaths, algorithm='sha256')
+        return hashlib.sha256(json.dumps(
+            [(str(f.relative_to(entry_dir)), digests[f]) for f in fpaths]
+        ).encode('utf-8')).hexdigest()
+
+    @property
+    def size(self):
+        "The total size of the converted files in the cache in bytes"
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _connect(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.cache_dir / self.INDEX_FNAME),
+                               timeout=30)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, primary_file TEXT, side_cars TEXT, '
+            'size INTEGER, last_used REAL, digest TEXT)')
+        return conn
+
+
+_default_cache = None
+
+
+def default_conversion_cache():
+    """Returns the conversion cache used by the converters of pipeline inputs
+    and outputs, or None if conversion results aren't cached"""
+    return _default_cache
+
+
+def set_default_conversion_cache(cache):
+    """Sets the conversion cache used by the converters of pipeline inputs
+    and outputs
+
+    Parameters
+    ----------
+    cache : ConversionCache or None
+        The cache to use, or None to disable caching of conversion results
+    """
+    global _default_cache
+    _default_cache = cache
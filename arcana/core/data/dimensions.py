@@ -1,9 +1,23 @@
 import typing as ty
 from operator import __or__
-from enum import Enum
+from enum import Enum, EnumMeta
 
 
-class DataDimensions(Enum):
+class DataDimensionsMeta(EnumMeta):
+    """Metaclass that precomputes lookup tables for the frequency algebra of
+    each DataDimensions subclass when it is created (the member for each
+    value, basis decompositions and parent/child relations), so operations
+    used in the inner loops of data-tree construction are table lookups rather
+    than creating new enum members or decoding bits in Python loops"""
+
+    def __new__(metacls, *args, **kwargs):
+        cls = super().__new__(metacls, *args, **kwargs)
+        if cls._member_map_:
+            cls._build_tables()
+        return cls
+
+
+class DataDimensions(Enum, metaclass=DataDimensionsMeta):
     """
     Base class for all "data dimensions" enums. DataDimensions enums specify
     the relationships between nodes of a dataset.
@@ -55,6 +69,32 @@ class DataDimensions(Enum):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def _build_tables(cls):
+        members = list(cls)
+        n_values = max(m._value_ for m in members) + 1
+        cls._by_value = [None] * n_values
+        for member in members:
+            cls._by_value[member._value_] = member
+        cls._basis_table = [None] * n_values
+        cls._parent_table = [[False] * n_values for _ in range(n_values)]
+        for member in members:
+            v = member._value_
+            cls._basis_table[v] = tuple(
+                cls._by_value[b]
+                for b in sorted(member.nonzero_bits(), reverse=True))
+            for child in members:
+                c = child._value_
+                cls._parent_table[v][c] = (v & c) == v and c != v
+
+    def _lookup(self, value):
+        """Returns the member of the enum with the given value"""
+        member = self._by_value[value] if 0 <= value < len(
+            self._by_value) else None
+        if member is None:
+            return type(self)(value)  # raises a ValueError
+        return member
+
     @classmethod
     def basis(cls):
         return max(cls).nonzero_basis()
@@ -75,9 +115,7 @@ class DataDimensions(Enum):
             matchedpoint -> [timepoint, member]
             session -> [timepoint, group, member]
         """
-        # Check which bits are '1', and append them to the list of levels
-        cls = type(self)
-        return [cls(b) for b in sorted(self.nonzero_bits(), reverse=True)]
+        return list(self._basis_table[self._value_])
 
     def nonzero_bits(self):
         v = self.value
@@ -96,40 +134,40 @@ class DataDimensions(Enum):
             bit >>= 1
 
     def is_basis(self):
-        return len(self._nonzero_bits()) == 1
+        return len(self._basis_table[self._value_]) == 1
 
     def __eq__(self, other):
-        return self.value == other.value
+        return self._value_ == other._value_
 
     def __lt__(self, other):
-        return self.value < other.value
+        return self._value_ < other._value_
 
     def __le__(self, other):
-        return self.value <= other.value
+        return self._value_ <= other._value_
 
     def __xor__(self, other):
-        return type(self)(self.value ^ other.value)
+        return self._lookup(self._value_ ^ other._value_)
 
     def __and__(self, other):
-        return type(self)(self.value & other.value)
+        return self._lookup(self._value_ & other._value_)
 
     def __or__(self, other):
-        return type(self)(self.value | other.value)
+        return self._lookup(self._value_ | other._value_)
 
     def __invert__(self):
-        return type(self)(~self.value)
+        return self._lookup(~self._value_)
 
     def __add__(self, other):
-        return type(self)(self.value + other.value)
+        return self._lookup(self._value_ + other._value_)
 
     def __sub__(self, other):
-        return type(self)(self.value - other.value)
+        return self._lookup(self._value_ - other._value_)
 
     def __hash__(self):
-        return self.value
+        return self._value_
 
     def __bool__(self):
-        return bool(self.value)
+        return bool(self._value_)
 
     @classmethod
     def union(cls, freqs: ty.Sequence[Enum]):
@@ -160,4 +198,5 @@ class DataDimensions(Enum):
         bool
             True if self is parent of child
         """
-        return ((self & child) == self) and (child != self or if_match)
\ No newline at end of file
+        return (self._parent_table[self._value_][child._value_]
+                or (if_match and self._value_ == child._value_))
\ No newline at end of file
@@ -57,3 +57,21 @@ class DataQuality(Enum):
 
     def __le__(self, other):
         return self.value <= other.value
+
+
+class CopyMode(Enum):
+    """The strategies that can be used to materialise file groups at new
+    locations (e.g. when putting them into a store), from the cheapest to the
+    most expensive. Each strategy falls back to the next one that is possible
+    if it isn't supported between the source and destination (e.g. they are on
+    different file-systems).
+    """
+
+    symlink = 'symlink'  # Link to the source (no fallback)
+    move = 'move'  # Rename the source, falling back to clone + delete source
+    hardlink = 'hardlink'  # Share the inode of the source, falling back to clone
+    clone = 'clone'  # Reflink/copy_file_range clone, falling back to copy
+    copy = 'copy'  # Byte-for-byte copy, in parallel chunks for large files
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,213 @@
+import os
+import os.path as op
+import stat
+import logging
+import threading
+import typing as ty
+from collections import OrderedDict
+import attr
+
+
+logger = logging.getLogger('arcana')
+
+FILE = 'f'
+DIRECTORY = 'd'
+OTHER = 'o'
+
+DEFAULT_MAX_ENTRIES = 500000
+
+
+@attr.s
+class FileSystemCache():
+    """A cache of the types of paths (file, directory, other) and the
+    listings of directories on the local file-system, so that file groups can
+    be resolved and validated without repeatedly stat-ing the same paths,
+    which are network round trips on NFS-backed stores.
+
+    Directories are listed with `os.scandir`, which records the types of their
+    entries from the directory listing itself (d_type) on most file-systems,
+    so the entries don't need to be stat-ed individually. Only paths found to
+    exist are cached, so paths that are created after they were found to be
+    missing are picked up. Paths that are modified or removed by Arcana are
+    invalidated (see `invalidate`) and the whole cache is cleared when the data
+    tree of a dataset is refreshed (see `Dataset.refresh`). The least recently
+    used paths are evicted once more than `max_entries` paths (or directory
+    listings) are cached, so long-lived processes that walk many datasets
+    don't accumulate them indefinitely.
+
+    Parameters
+    ----------
+    max_entries : int
+        The maximum number of path kinds, and separately of directory
+        listings, that are cached
+    hits : int
+        The number of lookups answered from the cache, i.e. the number of stat
+        and directory listing syscalls saved
+    misses : int
+        The number of lookups that required a syscall
+    """
+
+    max_entries: int = attr.ib(default=DEFAULT_MAX_ENTRIES)
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+    _kinds: ty.Dict[str, str] = attr.ib(factory=OrderedDict, repr=False)
+    _listings: ty.Dict[str, ty.Tuple[str]] = attr.ib(factory=OrderedDict,
+                                                     repr=False)
+    _exts: ty.Dict[str, str] = attr.ib(factory=dict, repr=False)
+    _lock = attr.ib(factory=threading.Lock, repr=False, eq=False)
+
+    @property
+    def syscalls_saved(self):
+        return self.hits
+
+    def exists(self, path):
+        return self.kind(path) is not None
+
+    def is_dir(self, path):
+        return self.kind(path) == DIRECTORY
+
+    def is_file(self, path):
+        return self.kind(path) == FILE
+
+    def kind(self, path):
+        """Returns the kind of the path
+
+        Parameters
+        ----------
+        path : str or Path
+            The path to look up
+
+        Returns
+        -------
+        str or None
+            FILE, DIRECTORY or OTHER, or None if the path doesn't exist
+        """
+        key = self._key(path)
+        kind = self._lookup(self._kinds, key)
+        if kind is not None:
+            return kind
+        try:
+            mode = os.stat(key).st_mode
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if stat.S_ISDIR(mode):
+            kind = DIRECTORY
+        elif stat.S_ISREG(mode):
+            kind = FILE
+        else:
+            kind = OTHER
+        with self._lock:
+            self._kinds[key] = kind
+            self._evict(self._kinds)
+        return kind
+
+    def listdir(self, path):
+        """Lists the names of the entries of a directory, caching the kinds
+        of the entries
+
+        Parameters
+        ----------
+        path : str or Path
+            The path of the directory
+
+        Returns
+        -------
+        tuple[str]
+            The names of the entries in the directory
+        """
+        key = self._key(path)
+        names = self._lookup(self._listings, key)
+        if names is not None:
+            return names
+        names = []
+        kinds = {}
+        with os.scandir(key) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        kind = DIRECTORY
+                    elif entry.is_file():
+                        kind = FILE
+                    else:
+                        kind = OTHER
+                except OSError:  # e.g. broken symlinks
+                    continue
+                kinds[op.join(key, entry.name)] = kind
+        names = tuple(names)
+        with self._lock:
+            self._kinds.update(kinds)
+            self._kinds[key] = DIRECTORY
+            self._listings[key] = names
+            self._evict(self._kinds)
+            self._evict(self._listings)
+        return names
+
+    def ext(self, path):
+        """Returns the lower-case extension (all suffixes) of the path, or
+        None if it doesn't have one"""
+        name = op.basename(str(path).rstrip(os.sep))
+        try:
+            return self._exts[name]
+        except KeyError:
+            pass
+        if len(self._exts) >= self.max_entries:
+            # Only memoises a function of the name, so can simply be reset
+            self._exts.clear()
+        # Equivalent to ''.join(Path(path).suffixes).lower()
+        if name.endswith('.'):
+            ext = None
+        else:
+            ext = ''.join(
+                '.' + s for s in name.lstrip('.').split('.')[1:]).lower()
+            ext = ext or None
+        self._exts[name] = ext
+        return ext
+
+    def invalidate(self, path):
+        """Removes a path, anything cached below it, and the listing of its
+        parent directory from the cache (e.g. after it has been written to)
+
+        Parameters
+        ----------
+        path : str or Path
+            The path to invalidate
+        """
+        key = self._key(path)
+        prefix = key.rstrip(os.sep) + os.sep
+        with self._lock:
+            for cache in (self._kinds, self._listings):
+                cache.pop(key, None)
+                for k in [k for k in cache if k.startswith(prefix)]:
+                    del cache[k]
+            self._listings.pop(op.dirname(key), None)
+
+    def clear(self):
+        """Clears the cache, e.g. at the start of a new run"""
+        with self._lock:
+            self._kinds.clear()
+            self._listings.clear()
+            self._exts.clear()
+
+    def _lookup(self, cache, key):
+        """Looks up a key in one of the caches, marking it as recently used
+        and counting the hit or miss"""
+        with self._lock:
+            value = cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                cache.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def _evict(self, cache):
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _key(path):
+        return op.abspath(path)
+
+
+fs_cache = FileSystemCache()
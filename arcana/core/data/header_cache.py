@@ -0,0 +1,173 @@
+import os
+import sys
+import logging
+import threading
+import typing as ty
+from collections import OrderedDict
+import numpy as np
+import attr
+
+
+logger = logging.getLogger('arcana')
+
+
+DEFAULT_MAX_SIZE = 256 * 2 ** 20
+
+
+@attr.s
+class HeaderCache():
+    """A bounded, thread-safe, least-recently-used cache of the parsed headers
+    (and lazy array proxies) of image files, which is shared across the
+    process so that repeated header lookups (e.g. `get_vox_sizes` followed by
+    `get_dims`) don't re-read and re-parse the files.
+
+    Entries are keyed by the kind of entry and the paths, modification times
+    and sizes of the files they were loaded from, so entries of files that
+    have since been modified are never returned. The least recently used
+    entries are evicted once the estimated memory used by the cached values
+    exceeds `max_size`. Cached values are shared between callers and
+    shouldn't be modified.
+
+    Parameters
+    ----------
+    max_size : int
+        The memory budget of the cache in bytes (estimated, see
+        `estimate_size`)
+    hits : int
+        The number of lookups answered from the cache
+    misses : int
+        The number of lookups that required the files to be loaded
+    """
+
+    max_size: int = attr.ib(default=DEFAULT_MAX_SIZE)
+    hits: int = attr.ib(default=0)
+    misses: int = attr.ib(default=0)
+    _entries: ty.Dict[tuple, tuple] = attr.ib(factory=OrderedDict,
+                                              repr=False)
+    _size: int = attr.ib(default=0, repr=False)
+    _lock = attr.ib(factory=threading.Lock, repr=False, eq=False)
+
+    def get(self, kind, paths, loader):
+        """Returns the cached value loaded from the given files, loading it
+        if it isn't in the cache or the files have changed
+
+        Parameters
+        ----------
+        kind : str
+            The kind of value (e.g. 'nifti_header'), to distinguish values
+            loaded from the same files
+        paths : str or Path or Sequence[str or Path]
+            The path(s) of the files the value is loaded from
+        loader : Callable[[], Any]
+            Loads the value from the files
+
+        Returns
+        -------
+        Any
+            The cached or loaded value
+        """
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        key = (kind,) + tuple(self._stamp(p) for p in paths)
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        # Loaded outside the lock so other lookups aren't blocked
+        value = loader()
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                # Loaded by another thread in the meantime
+                value = self._entries[key][0]
+            else:
+                self._entries[key] = (value, size)
+                self._size += size
+                self._evict(self.max_size)
+        return value
+
+    @property
+    def size(self):
+        "The estimated memory used by the cached values in bytes"
+        return self._size
+
+    @property
+    def stats(self):
+        "The hits, misses, number of entries and estimated size of the cache"
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'size': self._size}
+
+    def resize(self, max_size):
+        """Sets the memory budget of the cache, evicting entries if it is
+        exceeded
+
+        Parameters
+        ----------
+        max_size : int
+            The new memory budget in bytes
+        """
+        with self._lock:
+            self.max_size = max_size
+            self._evict(max_size)
+
+    def clear(self):
+        """Clears the cache"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self, max_size):
+        while self._size > max_size and self._entries:
+            key, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            logger.debug("Evicted %s from header cache", key)
+
+    @classmethod
+    def _stamp(cls, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def estimate_size(value, _depth=0):
+    """Estimates the memory used by a cached value, including the contents
+    of containers, in-memory arrays and DICOM data elements. Memory-mapped
+    arrays and array proxies only count the size of the objects themselves
+
+    Parameters
+    ----------
+    value : Any
+        The value to estimate the size of
+
+    Returns
+    -------
+    int
+        The estimated size in bytes
+    """
+    size = sys.getsizeof(value)
+    if _depth > 8:
+        return size
+    if isinstance(value, (np.ndarray, str, bytes)):
+        # Includes the data of arrays that own it but not that of views or
+        # memory-mapped arrays
+        return size
+    if hasattr(value, 'values') and callable(value.values):
+        # Dictionaries and pydicom datasets
+        members = value.values()
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        members = value
+    elif hasattr(value, 'VR') and hasattr(value, 'value'):
+        # pydicom data elements
+        members = [value.value]
+    else:
+        return size
+    return size + sum(estimate_size(m, _depth + 1) for m in members)
+
+
+header_cache = HeaderCache()
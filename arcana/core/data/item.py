@@ -1,10 +1,9 @@
 import os
 import os.path as op
+import sys
 from pathlib import Path
 import typing as ty
 from itertools import chain
-import hashlib
-import shutil
 from abc import ABCMeta, abstractmethod
 import attr
 from attr.converters import optional
@@ -12,12 +11,22 @@ from arcana.core.utils import parse_value
 from arcana.exceptions import (
     ArcanaUsageError, ArcanaNameError, ArcanaUsageError,
     ArcanaDataNotDerivedYetError)
-from .enum import DataQuality
+from .enum import DataQuality, CopyMode
 from .type import FileFormat
 from .provenance import DataProvenance
+from .checksum import default_checksum_engine
+from .materialize import materialize
+from .fscache import fs_cache
 
 
-@attr.s
+def intern_str(value):
+    """Interns strings (e.g. the paths of data items, which are repeated
+    across every node of a dataset) so that equal strings share the same
+    object in memory. Other values are returned unchanged"""
+    return sys.intern(value) if type(value) is str else value
+
+
+@attr.s(slots=True)
 class DataItem(metaclass=ABCMeta):
     """
     A representation of a file_group within the dataset.
@@ -46,7 +55,7 @@ class DataItem(metaclass=ABCMeta):
         if applicable        
     """
 
-    path: str = attr.ib()
+    path: str = attr.ib(converter=intern_str)
     datatype: type or FileFormat = attr.ib()
     uri: str = attr.ib(default=None)
     order: int = attr.ib(default=None)
@@ -81,6 +90,47 @@ class DataItem(metaclass=ABCMeta):
                     f"{provenance.outputs.keys()} of provenance provenance "
                     f"{provenance}")
 
+    def metadata(self, key):
+        """Returns the value of a header metadata field of the item (see
+        `metadata_values`)"""
+        return self.metadata_values([key])[key]
+
+    def metadata_values(self, keys):
+        """Returns the values of header metadata fields of the item, looked
+        up from the metadata index of the dataset it belongs to (if any) so
+        that they are only extracted once
+
+        Parameters
+        ----------
+        keys : Sequence[str]
+            The names of the fields
+
+        Returns
+        -------
+        dict[str, Any]
+            The values of the fields, None for fields the item doesn't have
+        """
+        keys = list(keys)
+        if self.data_node is None:
+            return self.extract_metadata(keys)
+        return self.data_node.dataset.metadata_index.values(self, keys)
+
+    def extract_metadata(self, keys):
+        """Extracts the values of header metadata fields from the item.
+        Overridden by items with headers (e.g. DICOM and NIfTI-X images)
+
+        Parameters
+        ----------
+        keys : Sequence[str]
+            The names of the fields
+
+        Returns
+        -------
+        dict[str, Any]
+            The values of the fields, None for fields the item doesn't have
+        """
+        return {k: None for k in keys}
+
     def _check_exists(self):
         if not self.exists:
             raise ArcanaDataNotDerivedYetError(
@@ -100,7 +150,7 @@ def absolute_path(path):
 def absolute_paths_dict(dct):
     return {n: absolute_path(p) for n, p in dict(dct).items()}
 
-@attr.s
+@attr.s(slots=True)
 class FileGroup(DataItem):
     """
     A representation of a file_group within the dataset.
@@ -142,12 +192,10 @@ class FileGroup(DataItem):
         converter=optional(absolute_paths_dict))
     _checksums: ty.Dict[str, str] = attr.ib(default=None, repr=False)
 
-    HASH_CHUNK_SIZE = 2 ** 20  # 1MB in calc. checksums to avoid mem. issues
-
     @fs_path.validator
     def validate_fs_path(self, _, fs_path):
         if fs_path is not None:
-            if not fs_path.exists:
+            if not fs_cache.exists(fs_path):
                 raise ArcanaUsageError(
                     "Attempting to set a path that doesn't exist "
                     f"({fs_path})")
@@ -176,8 +224,8 @@ class FileGroup(DataItem):
                     "format ('{}')".format(
                         "', '".join(side_cars.keys()),
                         "', '".join(self.datatype.side_cars.keys())))
-            missing_side_cars = [f for f in side_cars.values()
-                                 if not op.exists(f)]
+            missing_side_cars = [str(f) for f in side_cars.values()
+                                 if not fs_cache.exists(f)]
             if missing_side_cars:
                 raise ArcanaUsageError(
                     f"Attempting to set paths of auxiliary files for {self} "
@@ -239,8 +287,9 @@ class FileGroup(DataItem):
                 f"{self} has not be retrieved from the store. Use 'get' "
                 "method first.")
         if self.datatype.directory:
-            return chain(*((Path(root) / f for f in files)
-                           for root, _, files in os.walk(self.fs_path)))
+            return (Path(root) / f
+                    for root, _, files in os.walk(self.fs_path)
+                    for f in files)
         else:
             return self.fs_paths
 
@@ -262,21 +311,34 @@ class FileGroup(DataItem):
         else:
             self._checksums = self.calculate_checksums()
 
-    def calculate_checksums(self):
+    def calculate_checksums(self, engine=None, algorithm=None):
+        """Calculates the checksums of all files in the file group
+
+        Parameters
+        ----------
+        engine : ChecksumEngine, optional
+            The engine used to calculate the digests, by default the engine
+            returned by `default_checksum_engine`
+        algorithm : str, optional
+            The hashlib algorithm to use, by default that of the engine
+
+        Returns
+        -------
+        checksums : Dict[str, str]
+            The digests of the files keyed by their paths relative to the
+            primary file (or extensions for side cars)
+        """
         self._check_exists()
+        if engine is None:
+            engine = default_checksum_engine()
         checksums = {}
-        for fpath in self.all_file_paths():
-            fhash = hashlib.md5()
-            with open(fpath, 'rb') as f:
-                # Calculate hash in chunks so we don't run out of memory for
-                # large files.
-                for chunk in iter(lambda: f.read(self.HASH_CHUNK_SIZE), b''):
-                    fhash.update(chunk)
+        digests = engine.digests(self.all_file_paths(), algorithm=algorithm)
+        for fpath, digest in digests.items():
             try:
                 rel_path = str(fpath.relative_to(self.fs_path))
             except ValueError:
                 rel_path = '.'.join(fpath.suffixes)
-            checksums[rel_path] = fhash.hexdigest()
+            checksums[rel_path] = digest
         return checksums
 
     def contents_equal(self, other, **kwargs):
@@ -298,7 +360,7 @@ class FileGroup(DataItem):
             equal = (self.checksums == other.checksums)
         return equal
 
-    def copy_to(self, path: str, symlink: bool=False):
+    def copy_to(self, path: str, symlink: bool=False, mode: CopyMode=None):
         """Copies the file-group to the new path, with auxiliary files saved
         alongside the primary-file path.
 
@@ -308,24 +370,26 @@ class FileGroup(DataItem):
             Path to save the file-group to excluding file extensions
         symlink : bool
             Use symbolic links instead of copying files to new location
+        mode : CopyMode or str, optional
+            The strategy used to materialise the files at the new location
+            (see `CopyMode`), by default a clone of the files or a symlink
+            to them if `symlink` is True
         """
-        if symlink:
-            copy_dir = copy_file = os.symlink
-        else:
-            copy_file = shutil.copyfile
-            copy_dir = shutil.copytree
+        if mode is None:
+            mode = CopyMode.symlink if symlink else CopyMode.clone
         if self.datatype.directory:
-            copy_dir(self.fs_path, path)
+            materialize(self.fs_path, path, mode)
         else:
-            copy_file(self.fs_path, path + self.datatype.ext)
+            materialize(self.fs_path, path + self.datatype.ext, mode)
             for aux_name, aux_path in self.side_cars.items():
-                copy_file(aux_path, path + self.datatype.side_cars[aux_name])
+                materialize(aux_path, path + self.datatype.side_cars[aux_name],
+                            mode)
         return self.datatype.from_path(path)
 
     
 
 
-@attr.s
+@attr.s(slots=True)
 class Field(DataItem):
     """
     A representation of a value field in the dataset.
@@ -0,0 +1,169 @@
+import os
+import errno
+import shutil
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .enum import CopyMode
+from .fscache import fs_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+logger = logging.getLogger('arcana')
+
+FICLONE = 0x40049409  # Linux ioctl to share the extents of a file (reflink)
+CHUNK_SIZE = 2 ** 26  # 64MB chunks used when copying large files in parallel
+PARALLEL_COPY_MIN_SIZE = 2 ** 28  # only copy files > 256MB in parallel
+
+# Errors that indicate a strategy isn't supported between the source and
+# destination, as opposed to errors that should be raised (e.g. ENOENT)
+UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, n) for n in ('EXDEV', 'EPERM', 'EACCES', 'EOPNOTSUPP',
+                                'ENOTSUP', 'ENOSYS', 'EINVAL', 'ENOTTY',
+                                'EMLINK', 'EBADF') if hasattr(errno, n))
+
+
+def materialize(src, dst, mode=CopyMode.copy, max_workers=None):
+    """Materialises a file or directory at a new path using the given
+    strategy, falling back to the next cheapest strategy that is supported
+    between the source and destination. Existing files at the destination
+    are replaced.
+
+    Parameters
+    ----------
+    src : str or Path
+        The file or directory to materialise
+    dst : str or Path
+        The path to materialise it at
+    mode : CopyMode or str
+        The strategy to use
+    max_workers : int, optional
+        The maximum number of threads used to copy large files in chunks
+    """
+    src = Path(src)
+    dst = Path(dst)
+    mode = CopyMode[str(mode)]
+    fs_cache.invalidate(dst)
+    if mode == CopyMode.move:
+        fs_cache.invalidate(src)
+    if mode == CopyMode.symlink:
+        _remove_file(dst)
+        os.symlink(src, dst)
+    elif src.is_dir():
+        if mode == CopyMode.move and _try(os.rename, src, dst):
+            return
+        shutil.copytree(
+            src, dst,
+            copy_function=lambda s, d: _materialize_file(
+                Path(s), Path(d), CopyMode.clone if mode == CopyMode.move
+                else mode, max_workers))
+        if mode == CopyMode.move:
+            shutil.rmtree(src)
+    else:
+        _materialize_file(src, dst, mode, max_workers)
+
+
+def clone_file(src, dst):
+    """Clones a file so the copy shares the data blocks of the source
+    (copy-on-write), where supported by the file-system, otherwise copies it
+    in the kernel with copy_file_range
+
+    Raises
+    ------
+    OSError
+        If neither is supported between the source and destination
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+            else:
+                return
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, "copy_file_range is not available")
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                   min(remaining, CHUNK_SIZE))
+            if not n:
+                break
+            remaining -= n
+
+
+def copy_file(src, dst, max_workers=None):
+    """Copies the bytes of a file, in chunks in parallel threads if it is
+    large (os.pread/pwrite release the GIL)"""
+    size = os.stat(src).st_size
+    if size < PARALLEL_COPY_MIN_SIZE:
+        shutil.copyfile(src, dst)
+        return
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(dst_fd, size)
+
+            def copy_chunk(offset):
+                length = min(CHUNK_SIZE, size - offset)
+                while length:
+                    data = os.pread(src_fd, length, offset)
+                    if not data:
+                        break
+                    written = os.pwrite(dst_fd, data, offset)
+                    offset += written
+                    length -= written
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(copy_chunk, range(0, size, CHUNK_SIZE)))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _materialize_file(src, dst, mode, max_workers):
+    if mode == CopyMode.move:
+        if _try(os.replace, src, dst):
+            return
+        mode = CopyMode.clone
+        remove_src = True
+    else:
+        remove_src = False
+    if mode == CopyMode.hardlink:
+        _remove_file(dst)
+        if _try(os.link, src, dst):
+            return
+        mode = CopyMode.clone
+    if mode == CopyMode.clone:
+        if not _try(clone_file, src, dst):
+            copy_file(src, dst, max_workers=max_workers)
+    else:
+        copy_file(src, dst, max_workers=max_workers)
+    if remove_src:
+        os.unlink(src)
+
+
+def _try(strategy, src, dst):
+    try:
+        strategy(src, dst)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        logger.debug("Could not %s %s to %s (%s), falling back",
+                     strategy.__name__, src, dst, e)
+        return False
+    return True
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
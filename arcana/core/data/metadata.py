@@ -0,0 +1,155 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import closing
+from pathlib import Path
+import attr
+from attr.converters import optional
+
+
+logger = logging.getLogger('arcana')
+
+
+@attr.s
+class MetadataIndex():
+    """An index of the header metadata of the items in a dataset (e.g. DICOM
+    tags or the fields of NIfTI-X JSON side cars), which is used to match
+    items against the metadata criteria of data sources. The requested fields
+    are extracted from each item once (see `DataItem.extract_metadata`) and
+    then looked up from memory or, if `index_dir` is set, from an on-disk
+    SQLite index that persists between runs. Entries are invalidated when the
+    modification times or sizes of an item's files (or its URI for items that
+    haven't been downloaded) change, including those of the files within
+    items stored as directories (e.g. DICOM series).
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset the index is of
+    index_dir : Path, optional
+        The directory the on-disk index is stored in. If None, the index is
+        only held in memory
+    """
+
+    dataset = attr.ib()
+    index_dir: Path = attr.ib(default=None, converter=optional(Path))
+    _entries = attr.ib(factory=dict, init=False, repr=False)
+    _lock = attr.ib(factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def path(self):
+        dataset_hash = hashlib.sha1(
+            str(self.dataset.id).encode('utf-8')).hexdigest()
+        return self.index_dir / (
+            f"{self.dataset.store.type}_{dataset_hash}_metadata.sqlite")
+
+    def values(self, item, keys):
+        """Returns the values of the metadata fields of an item, extracting
+        them from the item if they aren't in the index
+
+        Parameters
+        ----------
+        item : DataItem
+            The item to return the metadata of
+        keys : Sequence[str]
+            The names of the fields (e.g. DICOM keywords or 'GGGG,EEEE' tags,
+            or the keys of a JSON side car)
+
+        Returns
+        -------
+        dict[str, Any]
+            The values of the fields, None for fields the item doesn't have
+        """
+        item_key = self.item_key(item)
+        stamp = self.stamp(item)
+        with self._lock:
+            entry = self._entries.get(item_key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, self._load(item_key, stamp))
+                self._entries[item_key] = entry
+            missing = [k for k in keys if k not in entry[1]]
+        if missing:
+            extracted = item.extract_metadata(missing)
+            logger.debug("Extracted metadata fields %s from %s", missing,
+                         item)
+            with self._lock:
+                entry[1].update(extracted)
+            self._save(item_key, stamp, extracted)
+        return {k: entry[1][k] for k in keys}
+
+    def clear(self):
+        """Clears the in-memory and on-disk indices"""
+        with self._lock:
+            self._entries.clear()
+        if self.index_dir is not None and self.path.exists():
+            self.path.unlink()
+
+    @classmethod
+    def item_key(cls, item):
+        "A string that identifies an item within the dataset"
+        node = item.data_node
+        return json.dumps([str(node.frequency), node.id, item.path,
+                           getattr(item.datatype, 'name', str(item.datatype))])
+
+    @classmethod
+    def stamp(cls, item):
+        """Returns a stamp that changes when the files of an item (or the
+        files within it if it is a directory) are modified, from their sizes
+        and modification times"""
+        fs_path = getattr(item, 'fs_path', None)
+        if fs_path is None:
+            return str(item.uri)
+        parts = []
+        for path in [fs_path] + list((item.side_cars or {}).values()):
+            parts.append(cls._stat_str(path))
+            if os.path.isdir(path):
+                for dpath, dnames, fnames in os.walk(path):
+                    dnames.sort()
+                    for fname in sorted(fnames):
+                        fpath = os.path.join(dpath, fname)
+                        parts.append(os.path.relpath(fpath, path) + '='
+                                     + cls._stat_str(fpath))
+        stamp = ';'.join(parts)
+        if len(stamp) > 64:
+            # Keep the stamps of large directories compact in the index
+            stamp = hashlib.sha1(stamp.encode('utf-8')).hexdigest()
+        return stamp
+
+    @classmethod
+    def _stat_str(cls, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 'missing'
+        return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+    def _load(self, item_key, stamp):
+        if self.index_dir is None or not self.path.exists():
+            return {}
+        with closing(self._connect()) as conn:
+            return {f: json.loads(v) for f, v in conn.execute(
+                'SELECT field, value FROM metadata WHERE item=? AND stamp=?',
+                (item_key, stamp))}
+
+    def _save(self, item_key, stamp, values):
+        if self.index_dir is None:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM metadata WHERE item=? AND stamp!=?',
+                         (item_key, stamp))
+            conn.executemany(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                ((item_key, stamp, f, json.dumps(v, default=str))
+                 for f, v in values.items()))
+
+    def _connect(self):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            'item TEXT, stamp TEXT, field TEXT, value TEXT, '
+            'PRIMARY KEY (item, field))')
+        return conn
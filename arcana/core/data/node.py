@@ -1,46 +1,88 @@
 from __future__ import annotations
-from pathlib import Path
+from pathlib import Path, PurePath
 import typing as ty
 import os
+import os.path as op
 import attr
-from collections import defaultdict
+from collections.abc import Mapping
 from abc import ABCMeta, abstractmethod
 import arcana.core.data.set
 from arcana.exceptions import (
     ArcanaNameError, ArcanaUsageError, ArcanaUnresolvableFormatException,
     ArcanaWrongFrequencyError, ArcanaFileFormatError, ArcanaError)
 from arcana.core.utils import split_extension
-from .type import FileFormat
-from .item import DataItem
+from .type import FileFormat, format_registry
+from .item import DataItem, intern_str
 from .provenance import DataProvenance
 from .enum import DataQuality
 from .dimensions import DataDimensions
+from .fscache import fs_cache
 
 
-@attr.s(auto_detect=True)
+@attr.s(auto_detect=True, slots=True)
 class DataNode():
     """A "node" in a data tree where file-groups and fields can be placed, e.g.
-    a session or subject.
+    a session or subject. Nodes are lightweight views onto a row of the
+    `DataTree` table of the dataset, so can be created on demand.
 
     Parameters
     ----------
-    ids : Dict[DataDimensions, str]
-        The ids for the frequency of the node and all "parent" frequencies
-        within the tree
-    frequency : DataDimensions
-        The frequency of the node
     dataset : Dataset
         A reference to the root of the data tree
+    frequency : DataDimensions
+        The frequency of the node
+    row : int
+        The row of the node in the data tree table for its frequency
     """
 
-    ids: ty.Dict[DataDimensions, str] = attr.ib()
+    dataset: arcana.core.data.set.Dataset = attr.ib(repr=False)
     frequency: DataDimensions = attr.ib()
-    dataset: arcana.core.data.set.Dataset = attr.ib(repr=False)    
-    children: ty.DefaultDict[DataDimensions,
-                             ty.Dict[ty.Union[str, ty.Tuple[str]], str]] = attr.ib(
-        factory=lambda: defaultdict(dict), repr=False)
-    _unresolved = attr.ib(default=None, repr=False)
-    _items = attr.ib(factory=dict, init=False, repr=False)
+    _row: int = attr.ib()
+
+    def __eq__(self, other):
+        return (isinstance(other, DataNode)
+                and self.dataset is other.dataset
+                and self.frequency == other.frequency
+                and self._row == other._row)
+
+    def __hash__(self):
+        return hash((id(self.dataset), self.frequency, self._row))
+
+    @property
+    def ids(self) -> ty.Dict[DataDimensions, str]:
+        """The ids for the frequency of the node and all "parent" frequencies
+        within the tree"""
+        return self.dataset._tree.ids(self.frequency, self._row)
+
+    @property
+    def children(self) -> DataNodeChildren:
+        """The child nodes of the node, keyed by frequency and then by the ID
+        of the frequency that separates them from the node"""
+        return DataNodeChildren(self)
+
+    @property
+    def _unresolved(self):
+        return self.dataset._tree.unresolved(self.frequency, self._row)
+
+    @_unresolved.setter
+    def _unresolved(self, unresolved):
+        self.dataset._tree.set_unresolved(self.frequency, self._row,
+                                          unresolved)
+
+    @property
+    def _items(self):
+        return self.dataset._tree.items(self.frequency, self._row)
+
+    @property
+    def _item_index(self) -> UnresolvedIndex:
+        tree = self.dataset._tree
+        index = tree.item_index(self.frequency, self._row)
+        if index is None:
+            index = UnresolvedIndex(self.unresolved)
+            # Don't cache indices of items that are still being found
+            if self._unresolved is not None:
+                tree.set_item_index(self.frequency, self._row, index)
+        return index
 
     def __getitem__(self, column_name):
         """Gets the item for the current node
@@ -85,7 +127,7 @@ class DataNode():
 
     @property
     def id(self):
-        return self.ids[self.frequency]
+        return self.dataset._tree.id(self.frequency, self._row)
 
     @property
     def label(self):
@@ -135,26 +177,45 @@ class DataNode():
 
     @property
     def unresolved(self):
-        if self._unresolved is None:
-            self._unresolved = []
-            self.dataset.store.find_items(self)
-        return self._unresolved
-
-    def resolved(self, format):
+        unresolved = self._unresolved
+        if unresolved is None:
+            unresolved = self.dataset._tree.discover(
+                self.frequency, self._row,
+                lambda: self.dataset.store.find_items(self))
+        return unresolved
+
+    def resolved(self, format, path=None):
         """
-        Items in the node that are able to be resolved to the given format
+        Items in the node that are able to be resolved to the given format.
+        Only items that could plausibly be resolved to the format (going by
+        the extensions of their files) are attempted, and the results are
+        cached until the items of the node change
 
         Parameters
         ----------
         format : FileFormat or type
             The file format or type to reolve the item to
+        path : str, optional
+            Only consider items at this path
+
+        Returns
+        -------
+        list[DataItem]
+            The resolved items in the order they were found in the node
         """
+        index = self._item_index
+        key = (format, path)
+        try:
+            return index.resolved[key]
+        except KeyError:
+            pass
         matches = []
-        for potential in self.unresolved:
+        for potential in index.candidates(format, path):
             try:
                 matches.append(potential.resolve(format))
             except ArcanaUnresolvableFormatException:
                 pass
+        index.resolved[key] = matches
         return matches
 
     @property
@@ -162,17 +223,16 @@ class DataNode():
         return self.dataset.ids_tuple(self.ids)
 
     def add_file_group(self, path, **kwargs):
-        if self._unresolved is None:
-            self._unresolved = []
-        self._unresolved.append(UnresolvedFileGroup(
+        self._append_unresolved(UnresolvedFileGroup(
             path=path, data_node=self, **kwargs))
 
     def add_field(self, path, value, **kwargs):
-        if self._unresolved is None:
-            self._unresolved = []
-        self._unresolved.append(UnresolvedField(
+        self._append_unresolved(UnresolvedField(
             path=path, data_node=self, value=value, **kwargs))
 
+    def _append_unresolved(self, item):
+        self.dataset._tree.append_unresolved(self.frequency, self._row, item)
+
     def get_file_group(self, file_group, **kwargs):
         return self.dataset.store.get_file_group(file_group, **kwargs)
 
@@ -187,7 +247,44 @@ class DataNode():
         self.dataset.store.put_field(field, value)
 
 
-@attr.s
+class DataNodeChildren(Mapping):
+    """Read-only mapping from frequency to the child nodes of a node of that
+    frequency (keyed by the ID of the frequency that separates them from the
+    parent node), which are looked up in the data tree table on access.
+    Frequencies that the node doesn't have any children of map to empty
+    dictionaries.
+
+    Parameters
+    ----------
+    node : DataNode
+        The parent node
+    """
+
+    def __init__(self, node: DataNode):
+        self.node = node
+
+    def __getitem__(self, frequency):
+        node = self.node
+        if not node.frequency.is_parent(frequency):
+            return {}
+        tree = node.dataset._tree
+        rows = tree.child_rows(node.frequency, node._row, frequency)
+        return dict(zip(tree.child_ids(node.frequency, frequency, rows),
+                        (DataNode(node.dataset, frequency, int(r))
+                         for r in rows.tolist())))
+
+    def __iter__(self):
+        node = self.node
+        tree = node.dataset._tree
+        return (f for f in node.dataset.space
+                if node.frequency.is_parent(f)
+                and len(tree.child_rows(node.frequency, node._row, f)))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+@attr.s(slots=True)
 class UnresolvedDataItem(metaclass=ABCMeta):
     """A file-group stored in, potentially multiple, unknown file formats.
     File formats are resolved by providing a list of candidates to the
@@ -210,12 +307,14 @@ class UnresolvedDataItem(metaclass=ABCMeta):
         if applicable
     """
 
-    path: str = attr.ib()
+    path: str = attr.ib(converter=intern_str)
     data_node: DataNode = attr.ib()
     order: int = attr.ib(default=None)
     quality: DataQuality = attr.ib(default=DataQuality.usable)
     provenance: DataProvenance = attr.ib(default=None)
-    _matched: ty.Dict[str, DataItem] = attr.ib(factory=dict, init=False)
+    # Created on demand, as most unresolved items are never resolved
+    _matched: ty.Optional[ty.Dict[str, DataItem]] = attr.ib(
+        default=None, init=False, repr=False)
 
     def resolve(self, datatype):
         """
@@ -245,21 +344,20 @@ class UnresolvedDataItem(metaclass=ABCMeta):
         ArcanaUnresolvableFormatException
             If 
         """
-        # If multiple formats are specified via resource names
-        
-        if not (self.uris or self.file_paths):
-            raise ArcanaError(
-                "Either uris or local name_paths must be provided "
-                f"to UnresolvedFileGroup('{self.name_path}') in before "
-                "attempting to resolve a file-groups format")
+        if self._matched is None:
+            self._matched = {}
         try:
             # Attempt to access previously saved
             item = self._matched[datatype]
         except KeyError:
-            if isinstance(datatype, FileFormat):
-                item = self._resolve(datatype)
-            else:
+            try:
                 item = self._resolve(datatype)
+            except ArcanaUnresolvableFormatException as e:
+                # Failures are cached too so the format isn't tried again
+                item = e
+            self._matched[datatype] = item
+        if isinstance(item, ArcanaUnresolvableFormatException):
+            raise item.with_traceback(None)
         return item
 
     @abstractmethod
@@ -275,14 +373,43 @@ class UnresolvedDataItem(metaclass=ABCMeta):
             'quality': self.quality}
 
 
-def normalise_paths(file_paths):
-    "Convert all file paths to absolute real paths"
-    if file_paths:
-        file_paths = [Path(p).absolute() for p in file_paths]
-    return file_paths
-
-
-@attr.s
+def compact_paths(file_paths):
+    """Converts file paths to absolute paths stored in a flat tuple of
+    alternating interned directory and file name strings, so that the
+    directory of a node and file names repeated across nodes are only held in
+    memory once"""
+    if not file_paths:
+        return ()
+    return tuple(intern_str(s) for p in file_paths
+                 for s in op.split(op.abspath(p)))
+
+
+def intern_keys(dct):
+    "Interns the keys of a dictionary (e.g. resource names)"
+    return {intern_str(k): v for k, v in dct.items()}
+
+
+def dir_exts(dpath):
+    """Returns the extensions of the files in a directory, used to match the
+    directory against directory formats. Files without a recognised extension
+    (e.g. DICOMs named by their UIDs) are sniffed from their magic bytes,
+    assuming that all such files in the directory are of the same type (so
+    only the first one has to be read)"""
+    exts = set()
+    sniffed = None
+    for fname in fs_cache.listdir(dpath):
+        if fname.startswith('.'):
+            continue
+        ext = split_extension(PurePath(fname))[1]
+        if not format_registry.by_ext(ext):
+            if sniffed is None:
+                sniffed = format_registry.sniff(op.join(dpath, fname)) or ''
+            ext = sniffed or ext
+        exts.add(ext)
+    return frozenset(exts)
+
+
+@attr.s(slots=True)
 class UnresolvedFileGroup(UnresolvedDataItem):
     """A file-group stored in, potentially multiple, unknown file formats.
     File formats are resolved by providing a list of candidates to the
@@ -314,17 +441,35 @@ class UnresolvedFileGroup(UnresolvedDataItem):
         to each resource        
     """
 
-    file_paths: ty.Sequence[Path] = attr.ib(factory=list,
-                                            converter=normalise_paths)
-    uris: ty.Dict[str] = attr.ib(default=None)
+    _file_paths: ty.Tuple[str] = attr.ib(
+        default=(), converter=compact_paths)
+    uris: ty.Dict[str] = attr.ib(default=None,
+                                 converter=attr.converters.optional(
+                                     intern_keys))
+
+    @property
+    def file_paths(self) -> ty.List[Path]:
+        """The absolute paths of the files in the file group, which are
+        created on access"""
+        paths = self._file_paths
+        return [Path(paths[i], paths[i + 1]) for i in range(0, len(paths), 2)]
+
+    @file_paths.setter
+    def file_paths(self, file_paths):
+        self._file_paths = compact_paths(file_paths)
 
     def _resolve(self, datatype):
+        if not (self.uris or self._file_paths):
+            raise ArcanaError(
+                "Either uris or local name_paths must be provided "
+                f"to UnresolvedFileGroup('{self.path}') in before "
+                "attempting to resolve a file-groups format")
         # Perform matching based on resource names in multi-format
         # file-group
         if self.uris is not None:
             item = None
             for datatype_name, uri in self.uris.items():
-                if datatype_name.lower() in datatype.all_names:
+                if format_registry.has_name(datatype, datatype_name):
                     item = datatype(uri=uri, **self.item_kwargs)
             if item is None:
                 raise ArcanaUnresolvableFormatException(
@@ -337,14 +482,13 @@ class UnresolvedFileGroup(UnresolvedDataItem):
             file_path = None
             side_cars = None
             if datatype.directory:
-                if (len(self.file_paths) == 1
-                    and self.file_paths[0].is_dir()
+                file_paths = self.file_paths
+                if (len(file_paths) == 1
+                    and fs_cache.is_dir(file_paths[0])
                     and (datatype.within_dir_exts is None
-                        or (datatype.within_dir_exts == frozenset(
-                            split_extension(f)[1]
-                            for f in self.file_paths[0].iterdir()
-                            if not str(f).startswith('.'))))):
-                    file_path = self.file_paths[0]
+                        or (datatype.within_dir_exts
+                            == dir_exts(file_paths[0])))):
+                    file_path = file_paths[0]
             else:
                 try:
                     file_path, side_cars = datatype.assort_files(
@@ -365,7 +509,7 @@ class UnresolvedFileGroup(UnresolvedDataItem):
         return item
 
 
-@attr.s
+@attr.s(slots=True)
 class UnresolvedField(UnresolvedDataItem):
     """A file-group stored in, potentially multiple, unknown file formats.
     File formats are resolved by providing a list of candidates to the
@@ -416,3 +560,77 @@ class UnresolvedField(UnresolvedDataItem):
         else:
             item = DataItem(value=value, **self.item_kwargs)
         return item
+
+
+def file_ext(fname):
+    "The (lower-case) extension of a file name as used to match file formats"
+    return ''.join(PurePath(fname).suffixes).lower() or None
+
+
+@attr.s(slots=True)
+class UnresolvedIndex():
+    """An index of the unresolved items of a node by their paths and the
+    extensions of their files, so that only plausible candidates are resolved
+    when looking up the item of a column, along with a cache of the items
+    resolved from them
+
+    Parameters
+    ----------
+    unresolved : list[UnresolvedDataItem]
+        The unresolved items of the node
+    """
+
+    unresolved: ty.List[UnresolvedDataItem] = attr.ib()
+    # Positions of the items in the unresolved list by path and by the
+    # extensions of their files
+    by_path: ty.Dict[str, ty.List[int]] = attr.ib(factory=dict, init=False)
+    by_ext: ty.Dict[str, ty.List[int]] = attr.ib(factory=dict, init=False)
+    # Positions of fields, of file groups whose formats are given by resource
+    # names (which could match any format) and of file groups consisting of
+    # a single path (which could match directory formats)
+    fields: ty.List[int] = attr.ib(factory=list, init=False)
+    by_uri: ty.List[int] = attr.ib(factory=list, init=False)
+    single: ty.List[int] = attr.ib(factory=list, init=False)
+    # Items resolved to each (datatype, path) combination
+    resolved: ty.Dict[tuple, ty.List[DataItem]] = attr.ib(factory=dict,
+                                                          init=False)
+
+    def __attrs_post_init__(self):
+        for i, item in enumerate(self.unresolved):
+            self.by_path.setdefault(item.path, []).append(i)
+            if isinstance(item, UnresolvedField):
+                self.fields.append(i)
+            elif item.uris is not None:
+                self.by_uri.append(i)
+            else:
+                fnames = item._file_paths[1::2]
+                if len(fnames) == 1:
+                    self.single.append(i)
+                for ext in set(file_ext(f) for f in fnames):
+                    self.by_ext.setdefault(ext, []).append(i)
+
+    def candidates(self, datatype, path=None):
+        """Returns the items that could plausibly be resolved to the datatype
+
+        Parameters
+        ----------
+        datatype : FileFormat or type
+            The datatype to resolve the items to
+        path : str, optional
+            Only return items at this path
+
+        Returns
+        -------
+        list[UnresolvedDataItem]
+            The candidate items in the order they were found in the node
+        """
+        if isinstance(datatype, FileFormat):
+            positions = self.by_uri + (
+                self.single if datatype.directory
+                else self.by_ext.get(datatype.ext, []))
+        else:
+            positions = self.fields
+        if path is not None:
+            positions = set(positions).intersection(
+                self.by_path.get(path, ()))
+        return [self.unresolved[i] for i in sorted(positions)]
@@ -0,0 +1,172 @@
+from __future__ import annotations
+import logging
+import typing as ty
+from collections import defaultdict
+import attr
+from arcana.exceptions import (
+    ArcanaSelectionError, ArcanaInputMissingMatchError,
+    ArcanaMultipleMatchesInputError)
+from .spec import DataSource
+
+
+logger = logging.getLogger('arcana')
+
+
+@attr.s
+class MatchPlan():
+    """A "match matrix" of the items selected by the column specs of a dataset
+    in each of the nodes of their frequency, which is built in a single pass
+    over the dataset instead of one column and one node at a time. The items
+    of all nodes are found concurrently (see `Dataset.prefetch_items`), the
+    path regular expressions of sources are only evaluated once for each
+    distinct item path in the dataset, and all missing and ambiguous matches
+    are collected so they can be reported together. Matched items are cached
+    in the nodes, so subsequent accesses via `DataNode.__getitem__` don't
+    need to match them again.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset the plan was built for
+    items : Dict[str, Dict[str, DataItem]]
+        The matched items of each column keyed by the IDs of the nodes
+    errors : Dict[str, Dict[str, ArcanaSelectionError]]
+        The errors raised matching each column in each node they couldn't be
+        matched in, keyed by column name and node ID
+    """
+
+    dataset = attr.ib(repr=False)
+    items: ty.Dict[str, ty.Dict[str, ty.Any]] = attr.ib(factory=dict)
+    errors: ty.Dict[str, ty.Dict[str, ArcanaSelectionError]] = attr.ib(
+        factory=dict)
+
+    @classmethod
+    def build(cls, dataset, columns=None, ids=None, frequency=None,
+              prefetch=True):
+        """Matches the column specs of the dataset against all nodes of their
+        frequency, or only the nodes related to a selection of nodes
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to match the columns of
+        columns : Sequence[str], optional
+            The names of the columns to match, by default all column specs of
+            the dataset
+        ids : Sequence[str], optional
+            The IDs of the nodes of `frequency` to match the columns in, by
+            default all nodes of the frequency of each column. Columns of
+            other frequencies are matched in the ancestors (e.g. the subjects
+            of selected sessions) or descendants of the selected nodes, or in
+            all of their nodes if their frequency is unrelated
+        frequency : DataDimensions or str, optional
+            The frequency of the nodes that `ids` refers to, by default the
+            leaf frequency of the dataset
+        prefetch : bool
+            Whether to find the items in all nodes concurrently first
+
+        Returns
+        -------
+        MatchPlan
+            The match matrix
+        """
+        if columns is None:
+            columns = list(dataset.column_specs)
+        plan = cls(dataset)
+        by_freq = defaultdict(list)
+        for name in columns:
+            by_freq[dataset.column_specs[name].frequency].append(name)
+            plan.items[name] = {}
+        if ids is not None:
+            frequency = dataset._parse_freq(frequency)
+            selected = dataset.nodes(frequency, ids=ids)
+        for col_freq, names in by_freq.items():
+            col_ids = None
+            if ids is not None:
+                col_ids = cls._related_ids(dataset, col_freq, frequency,
+                                           selected, ids)
+            if prefetch:
+                dataset.prefetch_items(col_freq, ids=col_ids)
+            nodes = dataset.nodes(col_freq, ids=col_ids)
+            # Evaluate the regular expressions of sources against each
+            # distinct path in all the nodes together
+            regex_specs = {n: s for n, s in ((n, dataset.column_specs[n])
+                                             for n in names)
+                           if isinstance(s, DataSource) and s.is_regex}
+            matching_paths = {}
+            if regex_specs:
+                all_paths = set()
+                for node in nodes:
+                    all_paths.update(node._item_index.by_path)
+                matching_paths = {n: s.match_paths(all_paths)
+                                  for n, s in regex_specs.items()}
+            for node in nodes:
+                node_items = node._items
+                for name in names:
+                    try:
+                        item = node_items[name]
+                    except KeyError:
+                        spec = dataset.column_specs[name]
+                        try:
+                            if name in matching_paths:
+                                item = spec.match(
+                                    node, matching_paths=matching_paths[name])
+                            else:
+                                item = spec.match(node)
+                        except ArcanaSelectionError as e:
+                            plan.errors.setdefault(name, {})[node.id] = e
+                            continue
+                        node_items[name] = item
+                    plan.items[name][node.id] = item
+        logger.debug("Matched %d columns of %s with %d errors", len(columns),
+                     dataset.id, sum(len(e) for e in plan.errors.values()))
+        return plan
+
+    @classmethod
+    def _related_ids(cls, dataset, col_freq, frequency, selected, ids):
+        """Returns the IDs of the nodes of a column's frequency that are
+        related to the selected nodes, or None if all nodes are"""
+        if col_freq == frequency:
+            return ids
+        if col_freq == dataset.root_freq:
+            return None
+        if col_freq.is_parent(frequency):
+            return list(dict.fromkeys(n.ids[col_freq] for n in selected))
+        if frequency.is_parent(col_freq):
+            return [n.id for n in dataset.select(
+                col_freq, **{str(frequency): [n.id for n in selected]})]
+        return None
+
+    @property
+    def missing(self) -> ty.Dict[str, ty.List[str]]:
+        """The IDs of the nodes that each column couldn't be matched in"""
+        return self._ids_with_error(ArcanaInputMissingMatchError)
+
+    @property
+    def ambiguous(self) -> ty.Dict[str, ty.List[str]]:
+        """The IDs of the nodes that each column matched multiple items in"""
+        return self._ids_with_error(ArcanaMultipleMatchesInputError)
+
+    def raise_errors(self):
+        """Raises an error reporting all the nodes that each column couldn't
+        be matched in, if there are any
+
+        Raises
+        ------
+        ArcanaSelectionError
+            If there were any missing or ambiguous matches
+        """
+        if not self.errors:
+            return
+        msg = f"Could not match all columns of {self.dataset.id}:"
+        for desc, errors in (('Missing', self.missing),
+                             ('Multiple matches for', self.ambiguous)):
+            for name, ids in errors.items():
+                msg += f"\n    {desc} '{name}' in: " + ', '.join(
+                    str(i) for i in ids)
+        raise ArcanaSelectionError(msg)
+
+    def _ids_with_error(self, error_type):
+        return {n: [i for i, e in errors.items() if isinstance(e, error_type)]
+                for n, errors in self.errors.items()
+                if any(isinstance(e, error_type) for e in errors.values())}
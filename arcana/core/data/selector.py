@@ -0,0 +1,162 @@
+from __future__ import annotations
+import os
+import re
+import typing as ty
+from itertools import chain
+import attr
+from attr.converters import optional
+from arcana.exceptions import ArcanaUsageError
+
+
+# Characters that indicate that a string selector is a regular expression
+# rather than a literal ID
+REGEX_CHARS_RE = re.compile(r'[\\^$.|?*+()\[\]{}]')
+
+
+@attr.s(frozen=True)
+class IdSelector():
+    """Selects the IDs of nodes of a given frequency, either by an explicit
+    set of IDs, a prefix that the IDs start with or a regular expression that
+    the IDs must fully match. Used to specify the `included` and `excluded`
+    nodes of a dataset and to select nodes with `Dataset.select`.
+
+    Parameters
+    ----------
+    ids : Set[str or Tuple[str]], optional
+        The literal IDs to select
+    pattern : str or re.Pattern, optional
+        A regular expression that selected IDs must fully match
+    prefix : str, optional
+        A prefix that selected IDs must start with
+    """
+
+    ids: ty.FrozenSet[str] = attr.ib(default=None, converter=optional(frozenset))
+    pattern: re.Pattern = attr.ib(default=None, converter=optional(re.compile))
+    prefix: str = attr.ib(default=None)
+
+    @prefix.validator
+    def prefix_validator(self, _, prefix):
+        if sum(a is not None for a in (self.ids, self.pattern, prefix)) != 1:
+            raise ArcanaUsageError(
+                "Exactly one of 'ids', 'pattern' and 'prefix' needs to be "
+                "provided to IdSelector")
+
+    @classmethod
+    def parse(cls, selector):
+        """Converts the different forms that ID selectors can be specified in
+        into an IdSelector
+
+        Parameters
+        ----------
+        selector : IdSelector or str or re.Pattern or Path or Sequence[str]
+            Either a sequence of literal IDs, a compiled regular expression, a
+            path to a text file containing whitespace-separated IDs, or a
+            string, which is treated as a regular expression if it contains
+            any special characters and a single literal ID otherwise
+
+        Returns
+        -------
+        IdSelector
+            The parsed selector
+        """
+        if isinstance(selector, cls):
+            return selector
+        if isinstance(selector, re.Pattern):
+            return cls(pattern=selector)
+        if isinstance(selector, os.PathLike):
+            return cls.from_file(selector)
+        if isinstance(selector, str):
+            if REGEX_CHARS_RE.search(selector):
+                return cls(pattern=selector)
+            return cls(ids=[selector])
+        return cls(ids=selector)
+
+    @classmethod
+    def from_file(cls, path):
+        """Reads literal IDs from a text file
+
+        Parameters
+        ----------
+        path : Path
+            Path to a text file containing whitespace-separated IDs
+
+        Returns
+        -------
+        IdSelector
+            Selector for the IDs in the file
+        """
+        with open(path) as f:
+            return cls(ids=f.read().split())
+
+    @classmethod
+    def union(cls, selectors):
+        """Combines multiple selectors into one that selects the IDs selected
+        by any of them
+
+        Parameters
+        ----------
+        selectors : Sequence[IdSelector]
+            The selectors to combine
+
+        Returns
+        -------
+        IdSelector
+            The combined selector
+        """
+        if len(selectors) == 1:
+            return selectors[0]
+        if all(s.is_literal for s in selectors):
+            return cls(ids=chain(*(s.ids for s in selectors)))
+        # Combine into a single regular expression
+        return cls(pattern='|'.join(f'(?:{s.regex})' for s in selectors))
+
+    @property
+    def is_literal(self):
+        """Whether the selector consists of literal IDs, which stores can
+        query directly"""
+        return self.ids is not None
+
+    @property
+    def regex(self):
+        """A regular expression equivalent to the selector"""
+        if self.ids is not None:
+            return '|'.join(re.escape(i) for i in sorted(self.ids))
+        if self.prefix is not None:
+            return re.escape(self.prefix) + '.*'
+        return self.pattern.pattern
+
+    def match(self, id):
+        """Whether an ID is selected
+
+        Parameters
+        ----------
+        id : str or Tuple[str] or None
+            The ID to check
+
+        Returns
+        -------
+        bool
+            Whether the ID is selected
+        """
+        if self.ids is not None:
+            return id in self.ids
+        if not isinstance(id, str):
+            return False
+        if self.prefix is not None:
+            return id.startswith(self.prefix)
+        return self.pattern.fullmatch(id) is not None
+
+    def __str__(self):
+        if self.ids is not None:
+            return ','.join(sorted(str(i) for i in self.ids))
+        return self.regex
+
+
+def id_selectors_converter(selectors):
+    """Converts the values of a dictionary of ID selectors (e.g. the `included`
+    and `excluded` attributes of a Dataset) to IdSelector objects, dropping
+    frequencies that map to None (i.e. no selection)"""
+    if selectors is None:
+        return {}
+    return {f: IdSelector.parse(s) for f, s in selectors.items()
+            if s is not None}
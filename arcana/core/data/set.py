@@ -2,11 +2,16 @@ from __future__ import annotations
 import logging
 import typing as ty
 from pathlib import Path
-from itertools import chain
+from itertools import chain, repeat
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
+import hashlib
+import threading
+import weakref
 import attr
 import attr.filters
-from attr.converters import default_if_none
+from attr.converters import default_if_none, optional
 from pydra import Workflow
 from arcana.exceptions import (
     ArcanaNameError, ArcanaDataTreeConstructionError, ArcanaUsageError,
@@ -16,10 +21,30 @@ from .spec import DataSink, DataSource
 from . import store
 
 from .node import DataNode
+from .tree import DataTree
+from .snapshot import TreeSnapshot
+from .metadata import MetadataIndex
+from .fscache import fs_cache
+from .planner import MatchPlan
+from .selector import IdSelector, id_selectors_converter
 
 
 logger = logging.getLogger('arcana')
 
+DEFAULT_PREFETCH_WORKERS = 8
+
+# The number of datasets rehydrated from references that are kept alive in
+# each worker process for reuse by subsequent tasks
+MAX_REHYDRATED_DATASETS = 8
+
+# Datasets that references have been created to (held weakly so they can be
+# garbage collected as normal), and the most recently used datasets
+# rehydrated from references in worker processes, keyed by the digests of the
+# references
+_referenced_datasets = weakref.WeakValueDictionary()
+_rehydrated_datasets = OrderedDict()
+_rehydrate_lock = threading.Lock()
+
 
 @attr.s
 class Dataset():
@@ -87,19 +112,35 @@ class Dataset():
     column_specs : Dict[str, DataSource or DataSink]
         The sources and sinks to be initially added to the dataset (columns are
         explicitly added when workflows are applied to the dataset).
-    included : Dict[DataDimensions, List[str]]
+    included : Dict[DataDimensions, IdSelector or List[str] or str or Path]
         The IDs to be included in the dataset per frequency. E.g. can be
         used to limit the subject IDs in a project to the sub-set that passed
-        QC. If a frequency is omitted or its value is None, then all available
-        will be used
-    excluded : Dict[DataDimensions, List[str]]
+        QC. IDs can be selected by a list of literal IDs, a regular expression
+        or a path to a text file containing the IDs (see `IdSelector.parse`).
+        If a frequency is omitted or its value is None, then all available
+        will be used. Stores skip non-matching sub-trees where they can
+    excluded : Dict[DataDimensions, IdSelector or List[str] or str or Path]
         The IDs to be excluded in the dataset per frequency. E.g. can be
-        used to exclude specific subjects that failed QC. If a frequency is
-        omitted or its value is None, then all available will be used
+        used to exclude specific subjects that failed QC. Takes the same forms
+        as `included`. If a frequency is omitted or its value is None, then
+        all available will be used
     workflows : Dict[str, pydra.Workflow]
         Workflows that have been applied to the dataset to generate sink
     access_args: ty.Dict[str, Any]
         Repository specific args used to control the way the dataset is accessed
+    snapshot_dir : Path, optional
+        Directory in which to save an on-disk snapshot of the data tree (and
+        the unresolved items found in it) so that subsequent accesses of the
+        dataset (e.g. in pipeline workers) can load it instead of
+        re-enumerating the store. The snapshot is only used if the store is
+        able to report that its data tree hasn't changed since it was saved
+        (see `DataStore.tree_version`). If None, snapshots are not used.
+    metadata_dir : Path, optional
+        Directory in which to save an on-disk index of the header metadata
+        of the items in the dataset that have been matched against the
+        metadata criteria of data sources, so that the headers only need to
+        be read once (see `MetadataIndex`). If None, the index is only held in
+        memory.
     """
 
     id: str = attr.ib()
@@ -109,14 +150,23 @@ class Dataset():
         factory=dict, converter=default_if_none(factory=dict))
     column_specs: ty.Optional[ty.Dict[str, ty.Union[DataSource, DataSink]]] = attr.ib(
         factory=dict, converter=default_if_none(factory=dict), repr=False)
-    included: ty.Dict[DataDimensions, ty.List[str]] = attr.ib(
-        factory=dict, converter=default_if_none(factory=dict), repr=False)
-    excluded: ty.Dict[DataDimensions, ty.List[str]] = attr.ib(
-        factory=dict, converter=default_if_none(factory=dict), repr=False)
+    included: ty.Dict[DataDimensions, IdSelector] = attr.ib(
+        factory=dict, converter=id_selectors_converter, repr=False)
+    excluded: ty.Dict[DataDimensions, IdSelector] = attr.ib(
+        factory=dict, converter=id_selectors_converter, repr=False)
     workflows: ty.Dict[str, Workflow] = attr.ib(factory=dict, repr=False)
     access_args: ty.Dict[str, ty.Any] = attr.ib(factory=dict)
-    _root_node: DataNode = attr.ib(default=None, init=False, repr=False,
-                                   eq=False)  
+    snapshot_dir: Path = attr.ib(default=None, converter=optional(Path),
+                                 repr=False)
+    metadata_dir: Path = attr.ib(default=None, converter=optional(Path),
+                                 repr=False)
+    _tree: DataTree = attr.ib(default=None, init=False, repr=False, eq=False)
+    _tree_version: str = attr.ib(default=None, init=False, repr=False,
+                                 eq=False)
+    _watermark: ty.Any = attr.ib(default=None, init=False, repr=False,
+                                 eq=False)
+    _metadata_index: MetadataIndex = attr.ib(default=None, init=False,
+                                             repr=False, eq=False)
 
     @column_specs.validator
     def column_specs_validator(self, _, column_specs):
@@ -129,9 +179,7 @@ class Dataset():
 
     @excluded.validator
     def excluded_validator(self, _, excluded):
-        both = [f for f in self.included
-                if (self.included[f] is not None
-                    and excluded[f] is not None)]
+        both = [str(f) for f in self.included if f in excluded]
         if both:
             raise ArcanaUsageError(
                     "Cannot provide both 'included' and 'excluded' arguments "
@@ -199,15 +247,250 @@ class Dataset():
         DataNode
             The root node of the data tree
         """
-        if self._root_node is None:
-            self._root_node = DataNode({self.root_freq: None}, self.root_freq,
-                                       self)
+        self._load_tree()
+        return DataNode(self, self.root_freq, 0)
+
+    def _load_tree(self):
+        """Loads the data tree table from the store (or a snapshot of it) if
+        it hasn't been already
+
+        Returns
+        -------
+        DataTree
+            The table of nodes in the data tree
+        """
+        if self._tree is None:
+            self._tree = self._new_tree()
+            # Enumerate the tree within a single connection so that stores
+            # can share a listing of the dataset between find_nodes,
+            # tree_version and watermark
+            with self.store:
+                # Taken before the tree is enumerated so that changes made
+                # while it is being enumerated are picked up by the next
+                # refresh. Stores that list the dataset derive it from the
+                # same listing the tree is enumerated from, so it doesn't
+                # cost an extra query
+                self._watermark = self.store.watermark(self)
+                if self.snapshot_dir is None:
+                    self.store.find_nodes(self)
+                else:
+                    self._load_tree_via_snapshot()
+        return self._tree
+
+    def _load_tree_via_snapshot(self):
+        self._tree_version = self.store.tree_version(self)
+        if self._tree_version is None:
             self.store.find_nodes(self)
-        return self._root_node
+        elif not self._snapshot.load(self._tree_version):
+            with self._snapshot.lock():
+                # Check whether another process rebuilt the snapshot while
+                # waiting for the lock
+                if not self._snapshot.load(self._tree_version):
+                    self.store.find_nodes(self)
+                    self._snapshot.save(self._tree_version)
+
+    def _new_tree(self):
+        """Creates an empty data tree table containing just the root node"""
+        tree = DataTree(self.space)
+        tree.add_row(self.root_freq, {self.root_freq: None})
+        return tree
+
+    def selects(self, frequency, id):
+        """Whether nodes of the given frequency and ID are selected by the
+        `included` and `excluded` filters of the dataset. Stores can use this
+        to skip enumerating sub-trees that won't be included in the dataset.
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the node
+        id : str or Tuple[str]
+            The ID of the node
+
+        Returns
+        -------
+        bool
+            Whether the node is selected
+        """
+        try:
+            if not self.included[frequency].match(id):
+                return False
+        except KeyError:
+            pass
+        try:
+            if self.excluded[frequency].match(id):
+                return False
+        except KeyError:
+            pass
+        return True
+
+    def refresh(self, full=False):
+        """Refreshes the data tree to reflect changes made to the dataset in
+        the store since the tree was loaded (or last refreshed).
+
+        If the store can report the changes since then (see
+        `DataStore.find_changes`), the tree is patched in place: new leaf nodes
+        (and their parents) are added, removed nodes are dropped and the items
+        found in modified nodes are cleared so they are searched for again on
+        next access. Items already found in unchanged nodes are kept, as are
+        existing DataNode objects of nodes that haven't been removed.
+        Otherwise, the tree is dropped and reloaded from the store on next
+        access.
+
+        Parameters
+        ----------
+        full : bool
+            Whether to drop the tree and reload it from scratch even if the
+            store can report the changes to it
+
+        Returns
+        -------
+        DataTreeChanges or None
+            The changes that were applied to the tree, or None if it was
+            dropped
+        """
+        # Paths cached during the previous run may have changed
+        fs_cache.clear()
+        # Within a single connection so that stores can share the listing of
+        # the dataset between find_changes and tree_version
+        with self.store:
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        changes = None
+        if not full and self._tree is not None and self._watermark is not None:
+            changes = self.store.find_changes(self, self._watermark)
+        if changes is None:
+            self._tree = None
+            self._tree_version = None
+            self._watermark = None
+            return None
+        tree = self._tree
+        leaf_freq = self.leaf_freq
+        if changes.removed:
+            tree.remove(leaf_freq, (r for r in (tree.row(leaf_freq, i)
+                                                for i in changes.removed)
+                                    if r is not None))
+            tree.prune(leaf_freq)
+        added = self.add_leaf_nodes(changes.added) if changes.added else []
+        for freq, id in changes.modified:
+            row = tree.row(freq, id)
+            if row is not None:
+                tree.clear_items(freq, row)
+        self._watermark = changes.watermark
+        if self.snapshot_dir is not None:
+            self._tree_version = self.store.tree_version(self)
+        logger.info("Refreshed data tree of %s: %d added, %d removed and %d "
+                    "modified nodes", self.id, len(added),
+                    len(changes.removed), len(changes.modified))
+        return changes
+
+    def prefetch_items(self, frequency=None, ids=None,
+                       workers=DEFAULT_PREFETCH_WORKERS, progress=None):
+        """Finds the unresolved items in many nodes of the dataset concurrently
+        using a bounded pool of threads, instead of lazily one node at a time
+        as they are accessed (which requires several round trips per node for
+        remote stores). Nodes whose items have already been found are skipped.
+
+        Parameters
+        ----------
+        frequency : DataDimensions or str, optional
+            The frequency of the nodes to find the items of, by default the
+            leaf frequency of the dataset
+        ids : Sequence[str], optional
+            The IDs of the nodes to find the items of, by default all nodes of
+            the frequency
+        workers : int
+            The maximum number of threads to search nodes with
+        progress : Callable[[int, int], None], optional
+            Called with the number of nodes that have been searched so far and
+            the total number of nodes to search after each node is searched.
+            By default, progress is logged at 10% intervals
+
+        Returns
+        -------
+        dict[DataNode, Exception]
+            The errors raised when searching each node that failed. The items
+            of these nodes will be searched for again when they are next
+            accessed
+        """
+        frequency = self._parse_freq(frequency)
+        tree = self._load_tree()
+        to_search = [n for n in self.nodes(frequency, ids=ids)
+                     if tree.unresolved(n.frequency, n._row) is None]
+        total = len(to_search)
+        if progress is None:
+            progress = self._log_prefetch_progress
+        errors = {}
+        if not total:
+            return errors
+        # Enter the store's context so that all worker threads share the
+        # same connection
+        with self.store, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(lambda n: n.unresolved, n): n
+                       for n in to_search}
+            for done, future in enumerate(as_completed(futures), start=1):
+                node = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning("Could not find items in %s: %s", node, e)
+                    errors[node] = e
+                progress(done, total)
+        return errors
+
+    def _log_prefetch_progress(self, done, total):
+        if done == total or done % max(total // 10, 1) == 0:
+            logger.info("Found items in %d/%d nodes of %s", done, total,
+                        self.id)
+
+    def save_snapshot(self, find_items=False):
+        """Saves the nodes of the data tree, along with any unresolved items
+        that have been found in them, to the snapshot in `snapshot_dir` so
+        they can be loaded by subsequent accesses to the dataset
+
+        Parameters
+        ----------
+        find_items : bool
+            Whether to find the items in all nodes of the tree that haven't
+            been accessed yet before saving the snapshot
+        """
+        if self.snapshot_dir is None:
+            raise ArcanaUsageError(
+                f"'snapshot_dir' needs to be set on {self} before a snapshot "
+                "can be saved")
+        if find_items:
+            for freq in self.space:
+                self.prefetch_items(freq)
+        else:
+            self._load_tree()
+        self._snapshot.save(self._tree_version)
 
-    def refresh(self):
-        """Refresh the dataset nodes"""
-        self._root_node = None
+    @property
+    def _snapshot(self):
+        return TreeSnapshot(self, self.snapshot_dir)
+
+    @property
+    def metadata_index(self):
+        """The index of the header metadata of the items in the dataset (see
+        `MetadataIndex`)"""
+        if self._metadata_index is None:
+            self._metadata_index = MetadataIndex(self, self.metadata_dir)
+        return self._metadata_index
+
+    def ref(self):
+        """Creates a lightweight reference to the dataset to pass to pydra
+        tasks in place of the dataset itself, so that the data tree doesn't
+        need to be hashed and pickled for every task
+
+        Returns
+        -------
+        DatasetRef
+            The reference to the dataset
+        """
+        ref = DatasetRef.from_dataset(self)
+        _referenced_datasets[ref.digest] = self
+        return ref
 
     def add_source(self, name, datatype, path=None, frequency=None,
                    overwrite=False, **kwargs):
@@ -330,12 +613,12 @@ class Dataset():
                     raise ArcanaNameError(
                         id, f"{id} ({freq}) not a child node of {node}")
         else:
-            try:
-                return self.root_node.children[frequency][id]
-            except KeyError:
+            row = self._load_tree().row(frequency, id)
+            if row is None:
                 raise ArcanaNameError(
                     id, f"{id} not present in data tree "
                     f"({list(self.node_ids(frequency))})")
+            return DataNode(self, frequency, row)
 
     def nodes(self, frequency=None, ids=None):
         """Return all the IDs in the dataset for a given frequency
@@ -346,7 +629,8 @@ class Dataset():
             The "frequency" of the nodes, e.g. per-session, per-subject. If
             None then all nodes are returned
         ids : Sequence[str or Tuple[str]]
-            The i
+            The IDs of the nodes to return. If None, all nodes of the frequency
+            are returned
 
         Returns
         -------
@@ -354,15 +638,66 @@ class Dataset():
             The sequence of the data node within the dataset
         """
         if frequency is None:
-            return chain(
-                *(d.values() for d in self.root_node.children.values()))
+            return chain(*(self.nodes(f) for f in self.space if f))
         frequency = self._parse_freq(frequency)
         if frequency == self.root_freq:
             return [self.root_node]
-        nodes = self.root_node.children[frequency].values()
         if ids is not None:
-            nodes = (n for n in nodes if n.id in set(ids))
-        return nodes
+            return self.select(frequency, ids=IdSelector(ids=ids))
+        return [DataNode(self, frequency, r)
+                for r in self._load_tree().rows(frequency).tolist()]
+
+    def select(self, frequency, ids=None, **constraints):
+        """Selects the nodes of a given frequency that match constraints on
+        their IDs and the IDs of their "parent" frequencies, e.g. all sessions
+        of a set of subjects at the second timepoint
+
+            dataset.select('session', subject=['MRH001', 'MRH002'],
+                           timepoint='2')
+
+        Constraints are looked up in indices over the data tree, so the
+        time taken is proportional to the number of matching nodes (except for
+        regular expressions, which are matched against each distinct ID of the
+        constrained frequency).
+
+        Parameters
+        ----------
+        frequency : DataDimensions or str
+            The frequency of the nodes to select
+        ids : IdSelector or Sequence[str] or str or re.Pattern, optional
+            Selects the IDs of the nodes. Either a sequence of IDs, a single
+            ID, a regular expression or an IdSelector (e.g. to select IDs
+            that start with a prefix), see `IdSelector.parse`
+        **constraints : Dict[str, IdSelector or Sequence[str] or str or re.Pattern]
+            Selectors for the IDs of "parent" frequencies of the nodes, keyed
+            by the name of the frequency, taking the same forms as `ids`
+
+        Returns
+        -------
+        list[DataNode]
+            The selected nodes, in the order they were added to the tree
+
+        Raises
+        ------
+        ArcanaUsageError
+            If a constraint is placed on a frequency that isn't a parent of the
+            frequency of the nodes
+        """
+        frequency = self._parse_freq(frequency)
+        selectors = {}
+        if ids is not None:
+            selectors[frequency] = IdSelector.parse(ids)
+        for freq_name, selector in constraints.items():
+            freq = self._parse_freq(freq_name)
+            if not freq.is_parent(frequency, if_match=True):
+                raise ArcanaUsageError(
+                    f"Cannot select {frequency} nodes by the IDs of {freq} as "
+                    f"it is not a parent frequency of {frequency}")
+            selectors[freq] = IdSelector.parse(selector)
+        if frequency == self.root_freq:
+            return [self.root_node]
+        return [DataNode(self, frequency, r) for r in
+                self._load_tree().select(frequency, selectors).tolist()]
         
     def node_ids(self, frequency):
         """Return all the IDs in the dataset for a given frequency
@@ -380,7 +715,7 @@ class Dataset():
         frequency = self._parse_freq(frequency)
         if frequency == self.root_freq:
             return [None]
-        return self.root_node.children[frequency].keys()
+        return self._load_tree().node_ids(frequency)
 
     def __getitem__(self, name):
         """Return all data items across the dataset for a given source or sink
@@ -398,6 +733,33 @@ class Dataset():
         spec = self.column_specs[name]
         return (n[name] for n in self.nodes(spec.frequency))
 
+    def match_columns(self, columns=None, ids=None, frequency=None):
+        """Matches column specs against all nodes of their frequency in a
+        single pass, caching the matched items in the nodes and collecting all
+        missing and ambiguous matches (see `MatchPlan`)
+
+        Parameters
+        ----------
+        columns : Sequence[str], optional
+            The names of the columns to match, by default all columns
+        ids : Sequence[str], optional
+            The IDs of the nodes of `frequency` to match the columns in, by
+            default all nodes of the frequency of each column. Columns of
+            other frequencies are matched in the related nodes (see
+            `MatchPlan.build`)
+        frequency : DataDimensions or str, optional
+            The frequency of the nodes that `ids` refers to, by default the
+            leaf frequency of the dataset
+
+        Returns
+        -------
+        MatchPlan
+            The items matched by each column in each node and the errors
+            raised for the nodes they couldn't be matched in
+        """
+        return MatchPlan.build(self, columns=columns, ids=ids,
+                               frequency=frequency)
+
     def columns(self, *names):
         """Iterate over all columns in the dataset
 
@@ -423,6 +785,41 @@ class Dataset():
             IDs for frequencies not in the dataset hierarchy that are to be
             set explicitly
 
+        Raises
+        ------
+        ArcanaBadlyFormattedIDError
+            raised if one of the IDs doesn't match the pattern in the
+            `id_inference`
+        ArcanaDataTreeConstructionError
+            raised if one of the groups specified in the ID inference reg-ex
+            doesn't match a valid frequency in the data dimensions
+        """
+        return self._insert_node(self._infer_ids(tree_path, explicit_ids),
+                                 self.leaf_freq, self._parent_freqs())
+
+    def add_leaf_nodes(self, tree_paths, explicit_ids=None):
+        """Creates new nodes at each of the paths down the tree of the dataset,
+        along with all "parent" nodes upstream of them in the data tree, in a
+        single pass. Parent nodes are looked up without raising exceptions on
+        misses, so the time taken to build the tree is linear in the number of
+        leaves. Leaves that aren't selected by the `included` and `excluded`
+        filters of the dataset are skipped.
+
+        Parameters
+        ----------
+        tree_paths : Iterable[Sequence[str]]
+            The sequences of labels for each layer in the hierarchy of the
+            dataset leading to each leaf node.
+        explicit_ids : Iterable[dict[DataDimensions, str]], optional
+            IDs for frequencies not in the dataset hierarchy that are to be
+            set explicitly, one dictionary (or None) per tree path
+
+        Returns
+        -------
+        list[DataNode]
+            The newly created leaf nodes (excluding those that were filtered
+            out)
+
         Raises
         ------
         ArcanaBadlyFormattedIDError
@@ -433,7 +830,22 @@ class Dataset():
             doesn't match a valid frequency in the data dimensions
         """
         if explicit_ids is None:
-            explicit_ids = {}
+            explicit_ids = repeat(None)
+        parent_freqs = self._parent_freqs()
+        leaf_freq = self.leaf_freq
+        filtered_freqs = list(chain(self.included, self.excluded))
+        added = []
+        for tree_path, expl_ids in zip(tree_paths, explicit_ids):
+            ids = self._infer_ids(tree_path, expl_ids)
+            if all(self.selects(f, ids[f]) for f in filtered_freqs):
+                added.append(self._insert_node(ids, leaf_freq, parent_freqs,
+                                               check_clashes=False))
+        self._check_clashes()
+        return added
+
+    def _infer_ids(self, tree_path, explicit_ids=None):
+        """Infers the IDs of all frequencies in the data dimensions from the
+        labels of a path down the data tree (see `add_leaf_node`)"""
         # Get basis frequencies covered at the given depth of the
         if len(tree_path) != len(self.hierarchy):
             raise ArcanaDataTreeConstructionError(
@@ -494,7 +906,8 @@ class Dataset():
         assert(frequency == max(self.space))
         # Set or override any inferred IDs within the ones that have been
         # explicitly provided
-        ids.update(explicit_ids)
+        if explicit_ids:
+            ids.update(explicit_ids)
         # Create composite IDs for non-basis frequencies if they are not
         # explicitly in the layer dimensions
         for freq in (set(self.space) - set(frequency.nonzero_basis())):
@@ -504,7 +917,7 @@ class Dataset():
                     if len(id) == 1:
                         id = id[0]
                     ids[freq] = id
-        return self.add_node(ids, frequency)
+        return ids
 
     def add_node(self, ids, frequency):
         """Adds a node to the dataset, creating all parent "aggregate" nodes
@@ -512,8 +925,10 @@ class Dataset():
 
         Parameters
         ----------
-        node: DataNode
-            The node to add into the data tree
+        ids : Dict[DataDimensions, str]
+            The IDs of the node to add and all of its "parent" frequencies
+        frequency : DataDimensions or str
+            The frequency of the node to add
 
         Raises
         ------
@@ -521,46 +936,89 @@ class Dataset():
             If inserting a multiple IDs of the same class within the tree if
             one of their ids is None
         """
-        logger.debug(f'Adding new %s node to %s dataset: %s',
-                     frequency, self.id, ids)
         frequency = self._parse_freq(frequency)
-        node = DataNode(ids, frequency, self)
+        return self._insert_node(ids, frequency, self._parent_freqs())
+
+    def _insert_node(self, ids, frequency, parent_freqs, check_clashes=True):
+        """Inserts a node into the data tree and links it to its parent nodes,
+        creating them if they are not already present.
+
+        Parameters
+        ----------
+        ids : Dict[DataDimensions, str]
+            The IDs of the node to add and all of its "parent" frequencies
+        frequency : DataDimensions
+            The frequency of the node to add
+        parent_freqs : Dict[DataDimensions, List[Tuple[DataDimensions, DataDimensions]]]
+            Maps each frequency onto its (non-root) parent frequencies and the
+            frequencies that distinguish it from each parent, as returned by
+            `_parent_freqs`
+        check_clashes : bool
+            Whether to check for clashes between the children of the parent
+            nodes as the node is linked to them. Bulk insertions skip this
+            check and call `_check_clashes` once all nodes have been inserted
+        """
+        logger.debug('Adding new %s node to %s dataset: %s',
+                     frequency, self.id, ids)
+        tree = self._load_tree()
         # Create new data node
-        node_dict = self.root_node.children[node.frequency]
-        if node.id in node_dict:
+        node_id = ids[frequency]
+        if tree.row(frequency, node_id) is not None:
             raise ArcanaDataTreeConstructionError(
-                f"ID clash ({node.id}) between nodes inserted into data "
+                f"ID clash ({node_id}) between nodes inserted into data "
                 "tree")
-        node_dict[node.id] = node
-        # Insert root node
+        row = tree.add_row(frequency, ids)
         # Insert parent nodes if not already present and link them with
         # inserted node
-        for parent_freq, parent_id in node.ids.items():
-            diff_freq = node.frequency - (parent_freq & node.frequency)
-            if diff_freq and parent_freq:  # Don't need to insert root node again
-                # logger.debug(f'Linking parent {parent_freq}: {parent_id}')
-                try:
-                    parent_node = self.node(parent_freq, parent_id)
-                except ArcanaNameError:
-                    # logger.debug(
-                    #     f'Parent {parent_freq}:{parent_id} not found, adding')
-                    parent_ids = {f: i for f, i in node.ids.items()
-                                  if (f.is_parent(parent_freq)
-                                      or f == parent_freq)}
-                    parent_node = self.add_node(parent_ids, parent_freq)
-                # Set reference to level node in new node
-                diff_id = node.ids[diff_freq]
-                children_dict = parent_node.children[frequency]
-                if diff_id in children_dict:
-                    raise ArcanaDataTreeConstructionError(
-                        f"ID clash ({diff_id}) between nodes inserted into "
-                        f"data tree in {diff_freq} children of {parent_node} "
-                        f"({children_dict[diff_id]} and {node}). You may "
-                        f"need to set the `id_inference` attr of the dataset "
-                        "to disambiguate ID components (e.g. how to extract "
-                        "the timepoint ID from a session label)")
-                children_dict[diff_id] = node
-        return node
+        for parent_freq, diff_freq in parent_freqs[frequency]:
+            if parent_freq not in ids:
+                continue
+            parent_row = tree.row(parent_freq, ids[parent_freq])
+            if parent_row is None:
+                parent_ids = {f: i for f, i in ids.items()
+                              if (f.is_parent(parent_freq)
+                                  or f == parent_freq)}
+                parent_row = self._insert_node(
+                    parent_ids, parent_freq, parent_freqs,
+                    check_clashes=check_clashes)._row
+            if check_clashes:
+                clash_row = tree.find_child(parent_freq, parent_row, frequency,
+                                            ids[diff_freq])
+                if clash_row is not None:
+                    self._raise_clash(parent_freq, parent_row, frequency,
+                                      [clash_row, row])
+            # Set reference to level node in new node
+            tree.link(frequency, row, parent_freq, parent_row)
+        return DataNode(self, frequency, row)
+
+    def _check_clashes(self):
+        """Checks for nodes that have been inserted into the children of the
+        same parent node under the same ID"""
+        clashes = self._load_tree().find_clashes()
+        if clashes:
+            self._raise_clash(*clashes[0])
+
+    def _raise_clash(self, parent_freq, parent_row, frequency, rows):
+        parent_node = DataNode(self, parent_freq, parent_row)
+        diff_freq = frequency - parent_freq
+        node, other = (DataNode(self, frequency, r) for r in rows[:2])
+        raise ArcanaDataTreeConstructionError(
+            f"ID clash ({node.ids[diff_freq]}) between nodes inserted into "
+            f"data tree in {diff_freq} children of {parent_node} "
+            f"({node} and {other}). You may "
+            f"need to set the `id_inference` attr of the dataset "
+            "to disambiguate ID components (e.g. how to extract "
+            "the timepoint ID from a session label)")
+
+    def _parent_freqs(self):
+        """Maps each frequency in the data dimensions of the dataset onto its
+        non-root parent frequencies, paired with the frequency that separates
+        the child from the parent (i.e. the one used to key the child within
+        the parent's children)"""
+        return {
+            freq: [(p, freq - p) for p in self.space
+                   if p and p.is_parent(freq)]
+            for freq in self.space}
 
     def new_pipeline(self, name, inputs, outputs, frequency=None, **kwargs):
         """Generate a Pydra task that sources the specified inputs from the
@@ -635,6 +1093,130 @@ class Dataset():
         return f'{workflow_name}/{sink_name}'
 
 
+@attr.s(frozen=True, repr=False)
+class DatasetRef():
+    """A lightweight, picklable reference to a dataset, consisting of the
+    configuration of its store, its ID, hierarchy and column specs (but not
+    its data tree), which is passed to pydra tasks instead of the dataset. It
+    has a stable digest that is cheap to hash, and is rehydrated into a
+    dataset with `load`, which lazily loads the data tree on first access.
+
+    Parameters
+    ----------
+    id : str
+        The ID of the dataset within the store
+    store : DataStore
+        The store the dataset is stored in
+    hierarchy : Sequence[DataDimensions]
+        The hierarchy of the dataset
+    column_specs : Dict[str, DataSource or DataSink]
+        The column specs of the dataset, with the pipelines of the sinks
+        replaced by their names
+    dataset_class : type
+        The class of the dataset (e.g. BidsDataset)
+    attributes : Dict[str, Any]
+        Other arguments to pass to the dataset class when rehydrating it (e.g.
+        `id_inference`, `included`, `snapshot_dir`)
+    """
+
+    id: str = attr.ib()
+    store: store.DataStore = attr.ib()
+    hierarchy: ty.Tuple[DataDimensions] = attr.ib(converter=tuple)
+    column_specs: ty.Dict[str, ty.Union[DataSource, DataSink]] = attr.ib(
+        factory=dict)
+    dataset_class: type = attr.ib(default=Dataset)
+    attributes: ty.Dict[str, ty.Any] = attr.ib(factory=dict)
+    digest: str = attr.ib(init=False, eq=False)
+
+    # Attributes of datasets that aren't needed in tasks
+    OMITTED_ATTRS = ('workflows',)
+
+    def __attrs_post_init__(self):
+        object.__setattr__(self, 'digest', self._calculate_digest())
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """Creates a reference to a dataset (see also `Dataset.ref`)
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to reference
+
+        Returns
+        -------
+        DatasetRef
+            The reference
+        """
+        column_specs = {}
+        for name, spec in dataset.column_specs.items():
+            if isinstance(spec, DataSink) and not isinstance(
+                    spec.pipeline, (str, type(None))):
+                spec = attr.evolve(spec, pipeline=spec.pipeline.wf.name)
+            column_specs[name] = spec
+        attributes = {}
+        for field in attr.fields(type(dataset)):
+            if not field.init or field.name in (
+                    ('id', 'store', 'hierarchy', 'column_specs')
+                    + cls.OMITTED_ATTRS):
+                continue
+            attributes[field.name.lstrip('_')] = getattr(dataset, field.name)
+        return cls(id=dataset.id, store=dataset.store,
+                   hierarchy=dataset.hierarchy, column_specs=column_specs,
+                   dataset_class=type(dataset), attributes=attributes)
+
+    def load(self):
+        """Rehydrates the reference into a dataset. If the reference was
+        created in the current process from a dataset that is still alive,
+        that dataset is returned. Otherwise a new dataset is created (once per
+        process, while it is one of the `MAX_REHYDRATED_DATASETS` most
+        recently loaded), whose data tree is loaded from the store (or its snapshot)
+        when it is first accessed
+
+        Returns
+        -------
+        Dataset
+            The referenced dataset
+        """
+        try:
+            return _referenced_datasets[self.digest]
+        except KeyError:
+            pass
+        with _rehydrate_lock:
+            try:
+                dataset = _rehydrated_datasets[self.digest]
+            except KeyError:
+                dataset = _rehydrated_datasets[self.digest] = (
+                    self.dataset_class(
+                        self.id, store=self.store,
+                        hierarchy=list(self.hierarchy),
+                        column_specs=dict(self.column_specs),
+                        **self.attributes))
+                while len(_rehydrated_datasets) > MAX_REHYDRATED_DATASETS:
+                    _rehydrated_datasets.popitem(last=False)
+            else:
+                _rehydrated_datasets.move_to_end(self.digest)
+        return dataset
+
+    def _calculate_digest(self):
+        store_args = [(f.name, getattr(self.store, f.name))
+                      for f in attr.fields(type(self.store)) if f.init]
+        vhash = hashlib.sha1()
+        for part in (
+                self.dataset_class, type(self.store), store_args, self.id,
+                self.hierarchy, sorted(self.column_specs.items()),
+                sorted(self.attributes.items())):
+            vhash.update(repr(part).encode('utf-8'))
+        return vhash.hexdigest()
+
+    def __repr__(self):
+        # pydra hashes the inputs of tasks by their string representations
+        return f"{type(self).__name__}(id={self.id!r}, digest={self.digest})"
+
+    def __str__(self):
+        return repr(self)
+
+
 @attr.s
 class SplitDataset():
     """A dataset created by combining multiple datasets into a conglomerate
@@ -0,0 +1,216 @@
+import os
+import json
+import sqlite3
+import tempfile
+import hashlib
+import logging
+from contextlib import closing
+from pathlib import Path
+import attr
+from fasteners import InterProcessLock
+from arcana.exceptions import ArcanaUsageError
+from .enum import DataQuality
+from .provenance import DataProvenance
+
+
+logger = logging.getLogger('arcana')
+
+
+@attr.s
+class TreeSnapshot():
+    """An on-disk SQLite index of the nodes in a dataset's data tree and the
+    unresolved items that have been found in them, which can be loaded instead
+    of re-enumerating the store. Snapshots are keyed by the type of the store
+    and the ID of the dataset, and are only loaded if the "tree version"
+    reported by the store matches the one recorded when they were saved.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset the snapshot is of
+    snapshot_dir : Path
+        The directory the snapshots are stored in
+    """
+
+    dataset = attr.ib()
+    snapshot_dir: Path = attr.ib(converter=Path)
+
+    SCHEMA_VERSION = '1'
+
+    @property
+    def path(self):
+        dataset_hash = hashlib.sha1(
+            str(self.dataset.id).encode('utf-8')).hexdigest()
+        return self.snapshot_dir / f"{self.dataset.store.type}_{dataset_hash}.sqlite"
+
+    @property
+    def signature(self):
+        """The store and tree-construction parameters that must match for the
+        snapshot to be valid (in addition to the tree version)"""
+        return {
+            'schema': self.SCHEMA_VERSION,
+            'store': self.dataset.store.type,
+            'dataset': str(self.dataset.id),
+            'hierarchy': [str(h) for h in self.dataset.hierarchy],
+            'id_inference': {str(k): str(v) for k, v in
+                             self.dataset.id_inference.items()},
+            'included': {str(k): str(v) for k, v in
+                         self.dataset.included.items()},
+            'excluded': {str(k): str(v) for k, v in
+                         self.dataset.excluded.items()}}
+
+    def load(self, tree_version):
+        """Populates the data tree of the dataset from the snapshot
+
+        Parameters
+        ----------
+        tree_version : str
+            The current version of the data tree as reported by the store
+
+        Returns
+        -------
+        bool
+            Whether a valid snapshot was found and loaded
+        """
+        if not self.path.exists():
+            return False
+        with closing(sqlite3.connect(f'file:{self.path}?mode=ro',
+                                     uri=True)) as conn:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+            if (meta.get('tree_version') != tree_version
+                    or meta.get('signature') != self._dumps(self.signature)):
+                logger.info("Snapshot of %s data tree at %s is out of date",
+                            self.dataset.id, self.path)
+                return False
+            self._insert_leaves(self.dataset, (
+                self._loads_ids(r) for r, in conn.execute(
+                    'SELECT ids FROM leaves ORDER BY row')))
+            space = self.dataset.space
+            for freq, node_id, items in conn.execute(
+                    'SELECT frequency, node_id, items FROM items'):
+                freq = space[freq]
+                if freq == self.dataset.root_freq:
+                    node = self.dataset.root_node
+                else:
+                    node = self.dataset.node(
+                        freq, self._loads_id(json.loads(node_id)))
+                node._unresolved = []
+                for record in json.loads(items):
+                    self._add_item(node, record)
+        logger.info("Loaded snapshot of %s data tree from %s",
+                    self.dataset.id, self.path)
+        return True
+
+    def save(self, tree_version):
+        """Saves the nodes of the data tree and any unresolved items that have
+        been found in them to the snapshot
+
+        Parameters
+        ----------
+        tree_version : str
+            The version of the data tree as reported by the store when it was
+            enumerated
+        """
+        if tree_version is None:
+            raise ArcanaUsageError(
+                f"{self.dataset.store} does not report the version of its "
+                "data trees so snapshots cannot be saved")
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        # Each save writes to its own temporary file, which is then atomically
+        # moved into place, so concurrent saves can't clobber each other
+        fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            self._write(tmp_path, tree_version)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        logger.info("Saved snapshot of %s data tree to %s", self.dataset.id,
+                    self.path)
+
+    def lock(self):
+        """Returns an inter-process lock on the snapshot, which is held while
+        the data tree is enumerated and the snapshot rebuilt so that
+        concurrent workers that find the same out-of-date snapshot wait for
+        it to be rebuilt instead of all enumerating the store"""
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        return InterProcessLock(str(self.path) + '.lock', logger=logger)
+
+    def _write(self, tmp_path, tree_version):
+        dataset = self.dataset
+        with closing(sqlite3.connect(str(tmp_path))) as conn, conn:
+            conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE leaves (row INTEGER PRIMARY KEY, '
+                         'ids TEXT)')
+            conn.execute('CREATE TABLE items (frequency TEXT, node_id TEXT, '
+                         'items TEXT)')
+            conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('tree_version', tree_version),
+                ('signature', self._dumps(self.signature))])
+            conn.executemany(
+                'INSERT INTO leaves (ids) VALUES (?)',
+                ((self._dumps({str(f): i for f, i in n.ids.items()}),)
+                 for n in dataset.nodes(dataset.leaf_freq)))
+            conn.executemany(
+                'INSERT INTO items VALUES (?, ?, ?)',
+                ((str(n.frequency), json.dumps(n.id),
+                  json.dumps([self._item_record(i) for i in n._unresolved]))
+                 for n in self._all_nodes() if n._unresolved is not None))
+
+    def _all_nodes(self):
+        yield self.dataset.root_node
+        yield from self.dataset.nodes()
+
+    @classmethod
+    def _insert_leaves(cls, dataset, leaf_ids):
+        parent_freqs = dataset._parent_freqs()
+        leaf_freq = dataset.leaf_freq
+        for ids in leaf_ids:
+            dataset._insert_node(
+                {dataset.space[f]: i for f, i in ids.items()}, leaf_freq,
+                parent_freqs, check_clashes=False)
+        dataset._check_clashes()
+
+    @classmethod
+    def _item_record(cls, item):
+        record = {
+            'path': item.path,
+            'order': item.order,
+            'quality': (item.quality.name
+                        if isinstance(item.quality, DataQuality)
+                        else item.quality),
+            'provenance': (item.provenance.dct
+                           if isinstance(item.provenance, DataProvenance)
+                           else item.provenance)}
+        if hasattr(item, 'value'):
+            record['value'] = item.value
+        else:
+            record['file_paths'] = [str(p) for p in item.file_paths]
+            record['uris'] = item.uris
+        return record
+
+    @classmethod
+    def _add_item(cls, node, record):
+        record = dict(record)
+        if record['quality'] in DataQuality.__members__:
+            record['quality'] = DataQuality[record['quality']]
+        if isinstance(record['provenance'], dict):
+            record['provenance'] = DataProvenance(record['provenance'])
+        if 'value' in record:
+            node.add_field(**record)
+        else:
+            node.add_file_group(**record)
+
+    @classmethod
+    def _loads_ids(cls, ids):
+        return {f: cls._loads_id(i) for f, i in json.loads(ids).items()}
+
+    @classmethod
+    def _loads_id(cls, id):
+        "Composite IDs are saved as JSON lists and need to be converted back"
+        return tuple(id) if isinstance(id, list) else id
+
+    @classmethod
+    def _dumps(cls, obj):
+        return json.dumps(obj, sort_keys=True)
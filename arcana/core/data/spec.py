@@ -51,15 +51,68 @@ class DataSource():
     order: int = attr.ib(default=None)
     metadata: ty.Dict[str, ty.Any] = attr.ib(default=None)
     is_regex: bool = attr.ib(default=False)
+    _path_regex: re.Pattern = attr.ib(default=None, init=False, eq=False,
+                                      repr=False)
 
-    def match(self, node):
+    @property
+    def path_regex(self):
+        """The path regular expression compiled so that it matches whole
+        paths (only compiled once)"""
+        if self._path_regex is None:
+            pattern = self.path if self.path.endswith('$') else self.path + '$'
+            self._path_regex = re.compile(pattern)
+        return self._path_regex
+
+    def match_paths(self, paths):
+        """Returns the paths that match the path regular expression of the
+        source
+
+        Parameters
+        ----------
+        paths : Iterable[str]
+            The paths to match
+
+        Returns
+        -------
+        set[str]
+            The matching paths
+        """
+        regex = self.path_regex
+        return set(p for p in set(paths) if regex.match(p))
+
+    def match(self, node, matching_paths=None):
+        """Selects the item in the node that matches the criteria of the
+        source
+
+        Parameters
+        ----------
+        node : DataNode
+            The node to select the item from
+        matching_paths : Set[str], optional
+            The paths that match the path regular expression of the source,
+            if they have already been determined (see `MatchPlan`)
+
+        Returns
+        -------
+        DataItem
+            The matching item
+        """
+        if self.is_regex and matching_paths is None:
+            matching_paths = self.match_paths(
+                i.path for i in node.unresolved)
         criteria = [
             (match_path, self.path if not self.is_regex else None),
-            (match_path_regex, self.path if self.is_regex else None),
+            (match_path_in, matching_paths),
             (match_quality, self.quality_threshold),
             (match_metadata, self.metadata)]
-        # Get all items that match the data format of the source
-        matches = node.resolved(self.datatype)
+        # Get all items that match the data format of the source, looking up
+        # the items at the path directly if it isn't a regular expression
+        matches = node.resolved(
+            self.datatype, path=None if self.is_regex else self.path)
+        if not matches and not self.is_regex:
+            # Check the items at all paths so that the error reports why
+            # nothing matched
+            matches = node.resolved(self.datatype)
         if not matches:
             raise ArcanaInputMissingMatchError(
                 f"Did not find any items matching data format "
@@ -70,6 +123,8 @@ class DataSource():
             if arg is not None:
                 filtered = [m for m in matches if func(m, arg)]
                 if not filtered:
+                    if func is match_path_in:
+                        arg = self.path  # report the pattern not the paths
                     raise ArcanaInputMissingMatchError(
                         "Did not find any items " + func.__doc__.format(arg)
                         + self._error_msg(node, matches))
@@ -105,13 +160,18 @@ def match_path_regex(item, pattern):
         pattern += '$'
     return re.match(pattern, item.path)
 
+def match_path_in(item, paths):
+    "with a path that matched the pattern {}"
+    return item.path in paths
+
 def match_quality(item, threshold):
     "with an acceptable quality {}"
     return item.quality >= threshold
 
 def match_metadata(item, metadata):
     "with the header values {}"
-    return all(item.metadata(k) == v for k, v in metadata.items())
+    values = item.metadata_values(metadata)
+    return all(values[k] == v for k, v in metadata.items())
 
 
 @attr.s
@@ -147,8 +207,7 @@ class DataSink():
     pipeline: str = attr.ib(default=None)
 
     def match(self, node):
-        matches = [i for i in node.resolved(self.datatype)
-                   if i.path == self.path]
+        matches = node.resolved(self.datatype, path=self.path)
         if not matches:
             # Return a placeholder data item that can be set
             return self.datatype(path=self.path, data_node=node,
@@ -157,3 +216,8 @@ class DataSink():
             raise ArcanaMultipleMatchesInputError(
                 "Found multiple matches " + self._error_msg(node, matches))
         return matches[0]
+
+    def _error_msg(self, node, matches):
+        return (
+            f" attempting to select an item from {node} matching {self}, "
+            "found:\n" + "\n    ".join(str(m) for m in matches))
@@ -1,12 +1,46 @@
 import logging
+import threading
 from abc import abstractmethod, ABCMeta
 import attr
 from arcana.exceptions import ArcanaUsageError
 from . import set as set_module
+from .enum import CopyMode
+from .checksum import ChecksumEngine
 
 
 logger = logging.getLogger('arcana')
 
+# Guards the connection depth of stores that are entered from multiple
+# threads (e.g. by Dataset.prefetch_items). Module-level so that stores remain
+# picklable
+connection_lock = threading.RLock()
+
+
+@attr.s
+class DataTreeChanges():
+    """The changes made to a dataset in a store since a watermark, as
+    reported by `DataStore.find_changes`
+
+    Parameters
+    ----------
+    watermark : Any
+        The watermark marking the state of the dataset the changes bring the
+        data tree up to, to be passed to the next call to `find_changes`
+    added : list[Sequence[str]]
+        The tree paths (labels for each layer of the hierarchy) of the leaf
+        nodes that have been added
+    removed : list[str or Tuple[str]]
+        The IDs of the leaf nodes that have been removed
+    modified : list[tuple[DataDimensions, str or Tuple[str]]]
+        The frequencies and IDs of existing nodes whose items may have changed
+    """
+
+    watermark = attr.ib()
+    added: list = attr.ib(factory=list)
+    removed: list = attr.ib(factory=list)
+    modified: list = attr.ib(factory=list)
+
+
 @attr.s
 class DataStore(metaclass=ABCMeta):
     """
@@ -15,11 +49,21 @@ class DataStore(metaclass=ABCMeta):
     classes should implement.
 
     Parameters
-
+    ----------
+    checksum_engine : ChecksumEngine, optional
+        The engine used to calculate the checksums of the file groups in the
+        store (e.g. one with a persistent cache), by default the engine
+        returned by `default_checksum_engine`. Keyword-only
     """
 
     _connection_depth = attr.ib(default=0, init=False, hash=False, repr=False,
                                 eq=False)
+    checksum_engine: ChecksumEngine = attr.ib(default=None, kw_only=True)
+
+    # The strategy used to materialise file groups in the store when they are
+    # put into it (see `CopyMode`), can be set on instances (e.g. to 'move'
+    # derivatives out of the pydra cache)
+    copy_mode = CopyMode.clone
 
     def __enter__(self):
         # This allows the store to be used within nested contexts
@@ -27,15 +71,24 @@ class DataStore(metaclass=ABCMeta):
         # methods that need connections, and therefore control their
         # own connection, in batches using the same connection by
         # placing the batch calls within an outer context.
-        if self._connection_depth == 0:
-            self.connect()
-        self._connection_depth += 1
+        with connection_lock:
+            if self._connection_depth == 0:
+                self.connect()
+            self._connection_depth += 1
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self._connection_depth -= 1
-        if self._connection_depth == 0:
-            self.disconnect()
+        with connection_lock:
+            self._connection_depth -= 1
+            if self._connection_depth == 0:
+                self.disconnect()
+
+    def __getstate__(self):
+        # Connections aren't carried over into copies of the store (e.g. those
+        # unpickled in pydra workers), which connect again when entered
+        state = self.__dict__.copy()
+        state['_connection_depth'] = 0
+        return state
 
     def dataset(self, name, hierarchy=None, **kwargs):
         """
@@ -74,7 +127,7 @@ class DataStore(metaclass=ABCMeta):
     def find_nodes(self, dataset):
         """
         Find all data nodes for a dataset in the store and populate the
-        Dataset object using its `add_node` method.
+        Dataset object using its `add_leaf_nodes` method.
 
         Parameters
         ----------
@@ -179,7 +232,69 @@ class DataStore(metaclass=ABCMeta):
             MD5 hex digest. The primary file in the file-set (i.e. the one that
             the path points to) should be specified by '.'.
         """
-        return file_group.calculate_checksums()
+        return file_group.calculate_checksums(engine=self.checksum_engine)
+
+    def tree_version(self, dataset):
+        """
+        Returns a token that is cheap to compute (relative to enumerating the
+        store) and changes whenever nodes or items are added to or removed
+        from the dataset. Used to check whether on-disk snapshots of the data
+        tree are still valid. Stores that can't provide such a token should
+        leave this method to return None, in which case snapshots are not used.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the version of the data tree for
+
+        Returns
+        -------
+        str or None
+            The version token
+        """
+        return None
+
+    def watermark(self, dataset):
+        """
+        Returns a watermark marking the current state of the dataset in the
+        store, which can be passed to `find_changes` to find the nodes and items
+        that have been added, removed or modified since. Stores that can't
+        report changes should leave this method to return None, in which case
+        `Dataset.refresh` reloads the whole data tree.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the watermark for
+
+        Returns
+        -------
+        Any
+            The watermark (must be picklable)
+        """
+        return None
+
+    def find_changes(self, dataset, watermark):
+        """
+        Finds the leaf nodes that have been added to or removed from the
+        dataset and the nodes whose items have been modified since the
+        watermark was taken.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to find the changes to
+        watermark : Any
+            A watermark previously returned by `watermark` or in the
+            `DataTreeChanges` returned by a previous call to this method
+
+        Returns
+        -------
+        DataTreeChanges or None
+            The changes to the dataset, or None if they can't be determined
+            (in which case the data tree is reloaded from scratch)
+        """
+        return None
 
     def connect(self):
         """
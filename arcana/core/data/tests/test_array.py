@@ -0,0 +1,69 @@
+import numpy as np
+import nibabel
+from arcana.core.data.array import (
+    iter_slabs, array_order, arrays_equal, rms_diff)
+from arcana.data.types.neuroimaging import nifti
+
+
+class CountingProxy():
+    "Records the number of elements read from an array"
+
+    def __init__(self, array, order='C'):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.order = order
+        self.n_read = 0
+
+    def __getitem__(self, slices):
+        slab = self.array[slices]
+        self.n_read += slab.size
+        return slab
+
+
+def test_iter_slabs():
+    shape = (4, 5, 6)
+    for order in 'CF':
+        for chunk_size in (1, 8, 40, 100, 1000):
+            covered = np.zeros(shape, dtype=int)
+            for slices in iter_slabs(shape, 8, chunk_size, order=order):
+                covered[slices] += 1
+                # Slabs fit within the chunk size unless a single row doesn't
+                assert covered[slices].size * 8 <= max(chunk_size, 8 * (
+                    shape[-1] if order == 'C' else shape[0]))
+            assert (covered == 1).all()
+    assert array_order(np.zeros((2, 3), order='F')) == 'F'
+    assert array_order(np.zeros((2, 3))) == 'C'
+
+
+def test_streaming_comparison():
+    array = np.arange(1000, dtype=np.float32).reshape(10, 10, 10)
+    other = array.copy()
+    assert arrays_equal(array, other, chunk_size=400)
+    other[0, 0, 0] += 3
+    proxy = CountingProxy(other)
+    assert not arrays_equal(array, proxy, chunk_size=400)
+    # Returned after the first slab
+    assert proxy.n_read == 100
+    other[9, 9, 9] -= 4
+    assert rms_diff(array, other, chunk_size=400) == 5.0
+    proxy = CountingProxy(other)
+    assert rms_diff(array, proxy, chunk_size=400, stop_above=1) == 3.0
+    assert proxy.n_read == 100
+    assert not arrays_equal(array, array[:5])
+    assert rms_diff(array, array[:5]) == np.inf
+
+
+def test_nifti_contents_equal(work_dir):
+    data = np.random.default_rng(0).integers(
+        0, 100, size=(6, 7, 8, 3)).astype(np.int16)
+    paths = []
+    for name, array in (('a', data), ('b', data), ('c', data + 1)):
+        paths.append(str(work_dir / f'{name}.nii'))
+        nibabel.save(nibabel.Nifti1Image(array, np.eye(4)), paths[-1])
+    a, b, c = (nifti.from_path(p) for p in paths)
+    assert a.contents_equal(b, chunk_size=1024)
+    assert not a.contents_equal(c, chunk_size=1024)
+    assert a.rms_diff(c) == np.sqrt(data.size)
+    assert a.contents_equal(c, rms_tol=np.sqrt(data.size) + 1)
+    assert (a.get_array() == data).all()
@@ -0,0 +1,64 @@
+import os
+import hashlib
+import pickle
+from arcana.core.data.checksum import ChecksumEngine
+from arcana.core.data.item import FileGroup
+from arcana.data.types.general import directory
+
+
+def test_checksum_engine(work_dir, monkeypatch):
+    paths = []
+    for i in range(5):
+        path = work_dir / f'file{i}.dat'
+        path.write_bytes(os.urandom(ChecksumEngine.HASH_CHUNK_SIZE * i + 10))
+        paths.append(path)
+    cache_path = work_dir / 'cache' / 'checksums.sqlite'
+    engine = ChecksumEngine(algorithm='blake2b', cache_path=cache_path)
+    digests = engine.digests(paths)
+    assert list(digests) == paths
+    assert digests == {p: hashlib.blake2b(p.read_bytes()).hexdigest()
+                       for p in paths}
+    assert engine.digest(paths[0], algorithm='md5') == hashlib.md5(
+        paths[0].read_bytes()).hexdigest()
+    # Unchanged files aren't read again, either by the same engine or a new
+    # engine (e.g. in another process) sharing the cache
+    hashed = []
+    orig_hash_file = ChecksumEngine.hash_file.__func__
+
+    def hash_file(cls, path, algorithm):
+        hashed.append(path)
+        return orig_hash_file(cls, path, algorithm)
+
+    monkeypatch.setattr(ChecksumEngine, 'hash_file', classmethod(hash_file))
+    assert engine.digests(paths) == digests
+    reloaded = pickle.loads(pickle.dumps(engine))
+    assert reloaded.digests(paths) == digests
+    assert not hashed
+    # Modified files are
+    paths[2].write_bytes(b'modified')
+    new_digests = reloaded.digests(paths)
+    assert hashed == [paths[2]]
+    assert new_digests[paths[2]] == hashlib.blake2b(b'modified').hexdigest()
+    # Only the most recently used digests are held in memory
+    bounded = ChecksumEngine(max_entries=2)
+    hashed.clear()
+    bounded.digests(paths[:3])
+    assert len(bounded._memory) == 2
+    bounded.digests(paths[1:3])
+    assert hashed == paths[:3]
+    bounded.digests(paths[:1])
+    assert hashed == paths[:3] + paths[:1]
+
+
+def test_file_group_checksums(work_dir):
+    dpath = work_dir / 'dir'
+    (dpath / 'sub').mkdir(parents=True)
+    contents = {'a.txt': b'a', 'sub/b.txt': b'b'}
+    for rel_path, data in contents.items():
+        (dpath / rel_path).write_bytes(data)
+    file_group = FileGroup('dir', datatype=directory, fs_path=dpath)
+    assert file_group.calculate_checksums() == {
+        p: hashlib.md5(d).hexdigest() for p, d in contents.items()}
+    engine = ChecksumEngine(algorithm='sha256')
+    assert file_group.calculate_checksums(engine=engine) == {
+        p: hashlib.sha256(d).hexdigest() for p, d in contents.items()}
@@ -1,4 +1,6 @@
+import pytest
 from arcana.data.dimensions.clinical import Clinical
+from arcana.data.stores.tests.fixtures import TestDataDimensions
 
 def test_is_parent():
     assert not Clinical.session.is_parent(Clinical.session)
@@ -74,5 +76,22 @@ def test_is_parent():
     assert not Clinical.dataset.is_parent(Clinical.dataset)
 
 
-
-
+def test_frequency_tables():
+    # Check the precomputed tables against the equivalent bit arithmetic
+    for space in (Clinical, TestDataDimensions):
+        for freq in space:
+            assert freq.nonzero_basis() == [
+                space(b) for b in sorted(freq.nonzero_bits(), reverse=True)]
+            for other in space:
+                assert (freq & other).value == freq.value & other.value
+                assert (freq | other).value == freq.value | other.value
+                assert (freq ^ other).value == freq.value ^ other.value
+                assert freq.is_parent(other) == (
+                    (freq.value & other.value) == freq.value
+                    and freq.value != other.value)
+                assert freq.is_parent(other, if_match=True) == (
+                    (freq.value & other.value) == freq.value)
+                if freq.value >= other.value:
+                    assert (freq - other).value == freq.value - other.value
+    with pytest.raises(ValueError):
+        Clinical.member - Clinical.session
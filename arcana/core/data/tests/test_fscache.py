@@ -0,0 +1,61 @@
+from arcana.core.data.fscache import FileSystemCache, fs_cache
+from arcana.core.data.materialize import materialize
+from arcana.data.types.general import text, directory
+from arcana.data.stores.file_system import FileSystem
+from arcana.data.dimensions.clinical import Clinical
+
+
+def test_fs_cache(work_dir):
+    (work_dir / 'sub').mkdir()
+    (work_dir / 'file.nii.gz').write_text('a')
+    cache = FileSystemCache()
+    assert sorted(cache.listdir(work_dir)) == ['file.nii.gz', 'sub']
+    # The kinds of the entries are recorded from the listing
+    assert cache.is_dir(work_dir / 'sub')
+    assert cache.is_file(str(work_dir / 'file.nii.gz'))
+    assert not cache.exists(work_dir / 'missing')
+    assert cache.listdir(work_dir)
+    assert cache.hits == 3
+    assert cache.misses == 2
+    assert cache.ext(work_dir / 'file.nii.gz') == '.nii.gz'
+    assert cache.ext('noext') is None
+    # Missing paths aren't cached
+    (work_dir / 'missing').write_text('b')
+    assert cache.is_file(work_dir / 'missing')
+    # Invalidated paths (and their parent's listings) are looked up again
+    (work_dir / 'sub').rmdir()
+    cache.invalidate(work_dir / 'sub')
+    assert not cache.exists(work_dir / 'sub')
+    assert sorted(cache.listdir(work_dir)) == ['file.nii.gz', 'missing']
+    cache.clear()
+    assert cache.syscalls_saved == 3
+    # The least recently used paths are evicted once the cap is reached
+    bounded = FileSystemCache(max_entries=2)
+    for name in ('file.nii.gz', 'missing', 'file.nii.gz', 'new'):
+        (work_dir / name).write_text('c')
+        assert bounded.is_file(work_dir / name)
+    assert bounded.hits == 1
+    assert bounded.is_file(work_dir / 'file.nii.gz')
+    assert bounded.is_file(work_dir / 'missing')
+    assert (bounded.hits, bounded.misses) == (2, 4)
+
+
+def test_resolve_with_fs_cache(work_dir):
+    session_dir = work_dir / 'dataset' / 'sess1'
+    (session_dir / 'dir1').mkdir(parents=True)
+    (session_dir / 'dir1' / 'a.txt').write_text('a')
+    (session_dir / 'file1.txt').write_text('b')
+    dataset = FileSystem().dataset(work_dir / 'dataset',
+                                   hierarchy=[Clinical.session])
+    node = dataset.node(Clinical.session, 'sess1')
+    node.unresolved  # find the items in the node
+    misses = fs_cache.misses
+    file1 = node.resolved(text, path='file1')[0]
+    node.resolved(directory, path='dir1')[0]
+    # The kinds of the items' paths were cached when their directory was
+    # listed to find them
+    assert fs_cache.misses == misses
+    # Paths written by Arcana are invalidated
+    materialize(file1.fs_path, session_dir / 'file2.txt')
+    dataset.refresh()
+    assert sorted(i.path for i in node.resolved(text)) == ['file1', 'file2']
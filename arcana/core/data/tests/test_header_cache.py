@@ -0,0 +1,56 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from arcana.core.data.header_cache import HeaderCache, estimate_size
+
+
+def test_header_cache(work_dir):
+    cache = HeaderCache(max_size=10000)
+    paths = []
+    for i in range(3):
+        paths.append(work_dir / f'file{i}.txt')
+        paths[-1].write_text(str(i))
+    loads = []
+
+    def loader(path):
+        def load():
+            loads.append(path)
+            return np.zeros(400, dtype=np.uint8) + int(path.read_text())
+        return load
+
+    assert cache.get('array', paths[0], loader(paths[0]))[0] == 0
+    assert cache.get('array', str(paths[0]), loader(paths[0]))[0] == 0
+    assert cache.get('other', paths[0], loader(paths[0]))[0] == 0
+    assert len(loads) == 2
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 2
+    # Modified files are loaded again
+    paths[0].write_text('55')
+    os.utime(paths[0], ns=(0, 10 ** 9))
+    assert cache.get('array', paths[0], loader(paths[0]))[0] == 55
+    assert len(loads) == 3
+    # Lookups from many threads share the cached value
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(
+            lambda _: cache.get('array', paths[1], loader(paths[1])),
+            range(50)))
+    assert all(r is results[0] for r in results[1:])
+    # The least recently used entries are evicted to stay within budget
+    entry_size = estimate_size(results[0])
+    cache.resize(2 * entry_size)
+    assert cache.stats['entries'] == 2
+    assert cache.size <= 2 * entry_size
+    n_loads = len(loads)
+    cache.get('array', paths[1], loader(paths[1]))
+    assert len(loads) == n_loads
+    cache.get('array', paths[2], loader(paths[2]))
+    cache.get('array', paths[0], loader(paths[0]))
+    assert len(loads) == n_loads + 2
+    cache.clear()
+    assert cache.stats['entries'] == 0 and cache.size == 0
+
+
+def test_estimate_size():
+    array = np.zeros(1000)
+    assert estimate_size(array) >= 8000
+    assert estimate_size({'a': array, 'b': [array]}) >= 16000
+    assert estimate_size(array[:10]) < 8000
@@ -0,0 +1,63 @@
+import os
+import errno
+import pytest
+from arcana.core.data import materialize as materialize_module
+from arcana.core.data.materialize import materialize
+from arcana.core.data.enum import CopyMode
+
+
+@pytest.fixture
+def src_dir(work_dir):
+    src_dir = work_dir / 'src'
+    (src_dir / 'sub').mkdir(parents=True)
+    (src_dir / 'a.dat').write_bytes(os.urandom(1000))
+    (src_dir / 'sub' / 'b.dat').write_bytes(os.urandom(100))
+    return src_dir
+
+
+def read_tree(path):
+    return {str(p.relative_to(path)): p.read_bytes()
+            for p in sorted(path.rglob('*')) if p.is_file()}
+
+
+@pytest.mark.parametrize('mode', list(CopyMode))
+def test_materialize(src_dir, work_dir, mode, monkeypatch):
+    # Force large files to be copied in parallel chunks
+    monkeypatch.setattr(materialize_module, 'PARALLEL_COPY_MIN_SIZE', 10)
+    monkeypatch.setattr(materialize_module, 'CHUNK_SIZE', 64)
+    contents = read_tree(src_dir)
+    src_file = src_dir / 'a.dat'
+    dst_file = work_dir / 'a.dat'
+    dst_file.write_bytes(b'to be replaced')
+    materialize(src_file, dst_file, mode)
+    assert dst_file.read_bytes() == contents['a.dat']
+    assert src_file.exists() == (mode != CopyMode.move)
+    assert dst_file.is_symlink() == (mode == CopyMode.symlink)
+    if mode in (CopyMode.clone, CopyMode.copy):
+        assert not dst_file.samefile(src_file)
+    elif mode == CopyMode.hardlink:
+        assert dst_file.stat().st_ino == src_file.stat().st_ino
+    if mode == CopyMode.move:
+        src_file.write_bytes(contents['a.dat'])
+    dst_dir = work_dir / 'dst'
+    materialize(str(src_dir), str(dst_dir), str(mode))
+    assert read_tree(dst_dir) == contents
+    assert src_dir.exists() == (mode != CopyMode.move)
+
+
+@pytest.mark.parametrize('mode', [CopyMode.move, CopyMode.hardlink])
+def test_materialize_fallback(src_dir, work_dir, mode, monkeypatch):
+    """Simulates the source and destination being on different file-systems"""
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, 'link', cross_device)
+    monkeypatch.setattr(os, 'rename', cross_device)
+    monkeypatch.setattr(os, 'replace', cross_device)
+    monkeypatch.setattr(materialize_module, 'clone_file', cross_device)
+    contents = read_tree(src_dir)
+    dst_dir = work_dir / 'dst'
+    materialize(src_dir, dst_dir, mode)
+    assert read_tree(dst_dir) == contents
+    assert src_dir.exists() == (mode != CopyMode.move)
+    assert (dst_dir / 'a.dat').stat().st_nlink == 1
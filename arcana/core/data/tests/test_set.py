@@ -1,10 +1,22 @@
+import os
+import re
+import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import cloudpickle as cp
+import pytest
 from pydra import mark, Workflow
-from arcana.core.data.set import Dataset
+from arcana.core.data.set import (
+    Dataset, DatasetRef, MAX_REHYDRATED_DATASETS, _referenced_datasets,
+    _rehydrated_datasets)
+from arcana.core.data.selector import IdSelector
 from arcana.core.data.spec import DataSource, DataSink
 from arcana.data.stores.file_system import FileSystem
+from arcana.exceptions import ArcanaSelectionError
 from arcana.data.dimensions.clinical import Clinical as cl
+from arcana.data.types.general import text, directory
 from arcana.data.types.neuroimaging import dicom, niftix_gz
 
 
@@ -42,4 +54,410 @@ def test_dataset_in_workflow_pickle(dataset: Dataset, tmp_dir: Path):
    'return':{
        'c': int}})
 def func(a, b, dataset):
-   return a + b
\ No newline at end of file
+   return a + b
+
+def test_add_leaf_nodes(dataset: Dataset):
+    # Build the same tree node by node to check that the bulk insertion used
+    # by the store produces an identical tree
+    tree_paths = [n.ids for n in dataset.nodes(dataset.leaf_freq)]
+    tree_paths = [[ids[h] for h in dataset.hierarchy] for ids in tree_paths]
+    single = Dataset(dataset.id, store=dataset.store,
+                     hierarchy=dataset.hierarchy,
+                     id_inference=dataset.id_inference)
+    single._tree = single._new_tree()
+    for tree_path in tree_paths:
+        single.add_leaf_node(tree_path)
+    for freq in dataset.space:
+        assert sorted(single.node_ids(freq), key=str) == sorted(
+            dataset.node_ids(freq), key=str)
+        for node in dataset.nodes(freq):
+            other = single.node(freq, node.id)
+            assert other.ids == node.ids
+            assert {f: set(c) for f, c in other.children.items()} == {
+                f: set(c) for f, c in node.children.items()}
+
+
+def test_snapshot(dataset: Dataset, tmp_dir: Path):
+    kwargs = dict(store=dataset.store, hierarchy=dataset.hierarchy,
+                  id_inference=dataset.id_inference,
+                  snapshot_dir=tmp_dir / 'snapshots')
+    original = Dataset(dataset.id, **kwargs)
+    original.save_snapshot(find_items=True)
+    # Reload from the snapshot with a store that would fail if it was used to
+    # enumerate the nodes or find the items in them
+    reloaded = Dataset(dataset.id, **kwargs)
+    reloaded.store.find_nodes = reloaded.store.find_items = None
+    for freq in dataset.space:
+        assert sorted(reloaded.node_ids(freq), key=str) == sorted(
+            original.node_ids(freq), key=str)
+        for node in original.nodes(freq):
+            other = reloaded.node(freq, node.id)
+            assert other.ids == node.ids
+            assert sorted(i.path for i in other.unresolved) == sorted(
+                i.path for i in node.unresolved)
+    del reloaded.store.find_nodes, reloaded.store.find_items
+    # Removing a node should invalidate the snapshot
+    leaf = next(iter(original.nodes(original.leaf_freq)))
+    leaf_dir = Path(dataset.id).joinpath(
+        *(str(leaf.ids[h]) for h in dataset.hierarchy))
+    moved_dir = tmp_dir / 'moved'
+    leaf_dir.rename(moved_dir)
+    try:
+        refreshed = Dataset(dataset.id, **kwargs)
+        assert len(list(refreshed.nodes(refreshed.leaf_freq))) == len(
+            list(original.nodes(original.leaf_freq))) - 1
+    finally:
+        moved_dir.rename(leaf_dir)
+
+
+def test_concurrent_snapshot_saves(dataset: Dataset, tmp_dir: Path):
+    kwargs = dict(store=dataset.store, hierarchy=dataset.hierarchy,
+                  id_inference=dataset.id_inference,
+                  snapshot_dir=tmp_dir / 'snapshots')
+    original = Dataset(dataset.id, **kwargs)
+    original._load_tree()
+    version = original._tree_version
+    snapshots = [Dataset(dataset.id, **kwargs)._snapshot for _ in range(2)]
+    for snapshot in snapshots:
+        snapshot.dataset._load_tree()
+    barrier = threading.Barrier(len(snapshots))
+
+    def save(snapshot):
+        barrier.wait()
+        for _ in range(5):
+            snapshot.save(version)
+
+    with ThreadPoolExecutor(max_workers=len(snapshots)) as pool:
+        list(pool.map(save, snapshots))
+    # No temporary files are left behind and the snapshot is loadable
+    assert not list((tmp_dir / 'snapshots').glob('*.tmp'))
+    reloaded = Dataset(dataset.id, **kwargs)
+    reloaded.store.find_nodes = None
+    assert sorted(reloaded.node_ids(reloaded.leaf_freq), key=str) == sorted(
+        original.node_ids(original.leaf_freq), key=str)
+    del reloaded.store.find_nodes
+
+
+def test_tree_version_skips_item_contents(tmp_dir: Path, monkeypatch):
+    root = tmp_dir / 'versioned'
+    series_dir = root / 'sess1' / 'series'
+    series_dir.mkdir(parents=True)
+    (series_dir / '0001.dcm').write_text('a')
+    dataset = FileSystem().dataset(root, hierarchy=[cl.session])
+    listed = []
+    scandir = os.scandir
+
+    def logged_scandir(path):
+        listed.append(Path(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', logged_scandir)
+    version = dataset.store.tree_version(dataset)
+    # The item directories are versioned by their modification times alone
+    assert sorted(listed) == [root, root / 'sess1']
+    series_stat = os.stat(series_dir)
+    (series_dir / '0001.dcm').write_text('b')
+    os.utime(series_dir, ns=(series_stat.st_atime_ns,
+                             series_stat.st_mtime_ns))
+    assert dataset.store.tree_version(dataset) == version
+    os.utime(series_dir, ns=(series_stat.st_atime_ns,
+                             series_stat.st_mtime_ns + 10 ** 9))
+    assert dataset.store.tree_version(dataset) != version
+
+
+def test_included_excluded(dataset: Dataset, tmp_dir: Path):
+    kwargs = dict(store=dataset.store, hierarchy=dataset.hierarchy,
+                  id_inference=dataset.id_inference)
+    layer = dataset.hierarchy[0]
+    layer_ids = sorted(dataset.node_ids(layer))
+    # Literal IDs of the top layer of the hierarchy, which are pruned while
+    # walking the store
+    included = Dataset(dataset.id, included={layer: layer_ids[:1]}, **kwargs)
+    assert list(included.node_ids(layer)) == layer_ids[:1]
+    # IDs read from a text file
+    ids_path = tmp_dir / 'ids.txt'
+    ids_path.write_text('\n'.join(layer_ids[:1]))
+    from_file = Dataset(dataset.id, included={layer: ids_path}, **kwargs)
+    assert list(from_file.node_ids(layer)) == layer_ids[:1]
+    # Regular expressions
+    excluded = Dataset(dataset.id, **kwargs, excluded={
+        layer: re.compile(re.escape(layer_ids[0]))})
+    assert sorted(excluded.node_ids(layer)) == layer_ids[1:]
+    # Frequencies that aren't in the hierarchy are filtered after the IDs
+    # are inferred
+    basis = dataset.space.basis()[-1]
+    basis_ids = sorted(dataset.node_ids(basis))
+    by_basis = Dataset(dataset.id, included={basis: basis_ids[-1:]}, **kwargs)
+    assert list(by_basis.node_ids(basis)) == basis_ids[-1:]
+    assert all(n.ids[basis] == basis_ids[-1]
+               for n in by_basis.nodes(by_basis.leaf_freq))
+
+
+def test_id_selector_parse(tmp_dir: Path):
+    assert IdSelector.parse(['a1', 'a2']) == IdSelector(ids=['a1', 'a2'])
+    assert IdSelector.parse('a1').is_literal
+    regex = IdSelector.parse(r'a\d+')
+    assert not regex.is_literal
+    assert regex.match('a10') and not regex.match('a10b')
+    ids_path = tmp_dir / 'ids.txt'
+    ids_path.write_text('a1\na2 a3\n')
+    assert IdSelector.parse(ids_path).ids == {'a1', 'a2', 'a3'}
+    union = IdSelector.union([IdSelector.parse('a1.x'), IdSelector(ids=['b'])])
+    assert union.match('a1.x') and union.match('b') and not union.match('c')
+
+
+def test_prefetch_items(dataset: Dataset):
+    kwargs = dict(store=dataset.store, hierarchy=dataset.hierarchy,
+                  id_inference=dataset.id_inference)
+    # Items found lazily one node at a time for comparison
+    expected = {n.id: sorted(i.path for i in n.unresolved)
+                for n in dataset.nodes(dataset.leaf_freq)}
+    prefetched = Dataset(dataset.id, **kwargs)
+    calls = []
+    errors = prefetched.prefetch_items(
+        workers=4, progress=lambda d, t: calls.append((d, t)))
+    assert not errors
+    total = len(expected)
+    assert calls == [(i, total) for i in range(1, total + 1)]
+    tree = prefetched._tree
+    assert all(tree.unresolved(n.frequency, n._row) is not None
+               for n in prefetched.nodes(prefetched.leaf_freq))
+    assert {n.id: sorted(i.path for i in n.unresolved)
+            for n in prefetched.nodes(prefetched.leaf_freq)} == expected
+    # Nodes that have already been searched are skipped
+    assert not prefetched.prefetch_items(
+        progress=lambda d, t: calls.append((d, t)))
+    assert len(calls) == total
+    # Errors are collected per node and the failed nodes are searched again
+    # on next access
+    failing = Dataset(dataset.id, **kwargs)
+    failing_id = next(iter(expected))
+    find_items = failing.store.find_items
+
+    def flaky_find_items(node):
+        if node.id == failing_id:
+            raise IOError("Connection dropped")
+        find_items(node)
+
+    failing.store.find_items = flaky_find_items
+    try:
+        errors = failing.prefetch_items(workers=4)
+    finally:
+        del failing.store.find_items
+    assert [n.id for n in errors] == [failing_id]
+    assert isinstance(next(iter(errors.values())), IOError)
+    failed_node = failing.node(failing.leaf_freq, failing_id)
+    assert sorted(i.path for i in failed_node.unresolved) == expected[
+        failing_id]
+
+
+def test_incremental_refresh(tmp_dir: Path):
+    root = tmp_dir / 'refreshed'
+
+    def add_session(subject, session):
+        sess_dir = root / subject / session
+        sess_dir.mkdir(parents=True)
+        (sess_dir / 'scan.txt').write_text(session)
+
+    for subject in ('sub0', 'sub1', 'sub2'):
+        for timepoint in range(2):
+            add_session(subject, f'{subject}_{timepoint}')
+    # Backdate the directories so they predate the watermark
+    past = time.time() - 3600
+    for dpath in [root, *root.rglob('*')]:
+        os.utime(dpath, (past, past))
+    dataset = FileSystem().dataset(
+        root, hierarchy=[cl.subject, cl.session],
+        id_inference={cl.session: r'.*_(?P<timepoint>\d+)'})
+    assert not dataset.prefetch_items()
+    unchanged = dataset.node(cl.session, 'sub0_0')
+    unchanged_items = unchanged.unresolved
+    # Add, remove and modify sessions in the store
+    add_session('sub0', 'sub0_2')
+    add_session('sub3', 'sub3_0')
+    shutil.rmtree(root / 'sub2')
+    (root / 'sub1' / 'sub1_0' / 'extra.txt').write_text('extra')
+    # Rewrite a file in place, which doesn't modify its directory
+    (root / 'sub0' / 'sub0_1' / 'scan.txt').write_text('rewritten')
+    os.utime(root / 'sub0' / 'sub0_1', (past, past))
+    searched = []
+    find_items = dataset.store.find_items
+
+    def logged_find_items(node):
+        searched.append(node.id)
+        find_items(node)
+
+    dataset.store.find_items = logged_find_items
+    try:
+        changes = dataset.refresh()
+        assert changes is not None
+        assert sorted(dataset.node_ids(cl.session)) == [
+            'sub0_0', 'sub0_1', 'sub0_2', 'sub1_0', 'sub1_1', 'sub3_0']
+        assert sorted(dataset.node_ids(cl.subject)) == ['sub0', 'sub1',
+                                                        'sub3']
+        assert sorted(dataset.node_ids(cl.timepoint)) == ['0', '1', '2']
+        assert sorted(dataset.node(cl.subject, 'sub0').children[
+            cl.session]) == ['0', '1', '2']
+        assert not dataset.select(cl.session, subject='sub2')
+        # Only the modified and new nodes are searched again
+        for node in dataset.nodes(cl.session):
+            node.unresolved
+        assert sorted(searched) == ['sub0_1', 'sub0_2', 'sub1_0', 'sub3_0']
+        assert sorted(i.path for i in dataset.node(
+            cl.session, 'sub1_0').unresolved) == ['extra', 'scan']
+        # Existing views of unchanged nodes are still valid
+        assert unchanged.unresolved is unchanged_items
+        assert unchanged.id == 'sub0_0'
+        # Full refreshes drop the tree
+        assert dataset.refresh(full=True) is None
+        assert dataset._tree is None
+    finally:
+        del dataset.store.find_items
+
+
+def test_dataset_ref(dataset: Dataset):
+    dataset.add_source('file1', text)
+    dataset.add_sink('deriv', text)
+    dataset.nodes(dataset.leaf_freq)  # Load the data tree
+    ref = dataset.ref()
+    # References created in the current process resolve to the dataset
+    assert ref.load() is dataset
+    pickled = cp.dumps(ref)
+    assert len(pickled) < len(cp.dumps(dataset))
+    unpickled = cp.loads(pickled)
+    assert isinstance(unpickled, DatasetRef)
+    # The representation (which pydra hashes) is stable across pickling
+    assert repr(unpickled) == repr(ref)
+    assert DatasetRef.from_dataset(dataset).digest == ref.digest
+    # Rehydrate the dataset as if in a worker process
+    del _referenced_datasets[ref.digest]
+    try:
+        rehydrated = unpickled.load()
+        assert rehydrated is not dataset
+        assert rehydrated._tree is None  # Loaded lazily on first access
+        assert rehydrated.column_specs == dataset.column_specs
+        assert rehydrated.id_inference == dataset.id_inference
+        for freq in dataset.space:
+            assert sorted(rehydrated.node_ids(freq), key=str) == sorted(
+                dataset.node_ids(freq), key=str)
+        # Subsequent tasks in the same process reuse the rehydrated dataset
+        assert cp.loads(pickled).load() is rehydrated
+        # Only the most recently used rehydrated datasets are kept
+        others = []
+        for i in range(MAX_REHYDRATED_DATASETS):
+            other = Dataset(f'{dataset.id}_{i}', store=dataset.store,
+                            hierarchy=dataset.hierarchy)
+            others.append(other.ref())
+            del _referenced_datasets[others[-1].digest]
+            others[-1].load()
+        assert len(_rehydrated_datasets) == MAX_REHYDRATED_DATASETS
+        assert ref.digest not in _rehydrated_datasets
+    finally:
+        _rehydrated_datasets.clear()
+
+
+def test_unresolved_items_compact(dataset: Dataset):
+    leaf = dataset.nodes(dataset.leaf_freq)[0]
+    node_dir = Path(dataset.id).joinpath(
+        *(str(leaf.ids[h]) for h in dataset.hierarchy))
+    file_groups = [i for i in leaf.unresolved if hasattr(i, 'file_paths')]
+    assert file_groups
+    for item in file_groups:
+        assert not hasattr(item, '__dict__')
+        # Paths are materialised on access
+        assert all(isinstance(p, Path) and p.parent == node_dir
+                   for p in item.file_paths)
+        assert item.file_paths == item.file_paths
+    # Directories and paths are shared between items
+    other = dataset.nodes(dataset.leaf_freq)[1]
+    assert file_groups[0]._file_paths[0] is file_groups[-1]._file_paths[0]
+    assert any(i.path is file_groups[0].path for i in other.unresolved)
+
+
+def test_resolution_index(tmp_dir: Path):
+    sess_dir = tmp_dir / 'resolution' / 'sess1'
+    (sess_dir / 'dicoms').mkdir(parents=True)
+    (sess_dir / 'dicoms' / '1.dcm').write_text('dicom')
+    for fname in ('scan1.txt', 'scan2.txt', 'image.nii.gz'):
+        (sess_dir / fname).write_text(fname)
+    dataset = FileSystem().dataset(sess_dir.parent, hierarchy=[cl.session])
+    dataset.add_source('scan2', text)
+    dataset.add_source('dicoms', directory)
+    node = dataset.node(cl.session, 'sess1')
+    # Only items with plausible extensions are candidates for each format
+    index = node._item_index
+    assert sorted(i.path for i in index.candidates(text)) == ['scan1',
+                                                              'scan2']
+    assert [i.path for i in index.candidates(text, path='scan2')] == ['scan2']
+    assert [i.path for i in index.candidates(niftix_gz)] == ['image']
+    assert [i.path for i in index.candidates(directory)] == [
+        i.path for i in node.unresolved]  # all consist of a single path
+    assert node['scan2'].path == 'scan2'
+    assert node['dicoms'].path == 'dicoms'
+    # Resolutions are cached at the item and node level
+    scan2 = next(i for i in node.unresolved if i.path == 'scan2')
+    assert scan2.resolve(text) is node['scan2']
+    assert node.resolved(text) is node.resolved(text)
+    assert sorted(i.path for i in node.resolved(text)) == ['scan1', 'scan2']
+    # Adding items to the node invalidates the node-level cache
+    (sess_dir / 'scan3.txt').write_text('scan3')
+    node.add_file_group('scan3', file_paths=[sess_dir / 'scan3.txt'])
+    assert sorted(i.path for i in node.resolved(text)) == ['scan1', 'scan2',
+                                                           'scan3']
+
+
+def test_match_columns(tmp_dir: Path):
+    root = tmp_dir / 'matching'
+    for sess_id, fnames in (('sess1', ['scan1.txt', 'scan2.txt']),
+                            ('sess2', ['scan1.txt', 'other.txt']),
+                            ('sess3', ['other.txt'])):
+        (root / sess_id).mkdir(parents=True)
+        for fname in fnames:
+            (root / sess_id / fname).write_text(fname)
+    dataset = FileSystem().dataset(root, hierarchy=[cl.session])
+    dataset.add_source('scan1', text)
+    dataset.add_source('any_scan', text, path=r'scan\d', is_regex=True)
+    dataset.add_sink('deriv', text)
+    plan = dataset.match_columns()
+    assert sorted(plan.items['scan1']) == ['sess1', 'sess2']
+    assert sorted(plan.items['any_scan']) == ['sess2']
+    assert sorted(plan.items['deriv']) == ['sess1', 'sess2', 'sess3']
+    assert not any(i.exists for i in plan.items['deriv'].values())
+    # All missing and ambiguous matches are reported together
+    assert {n: sorted(i) for n, i in plan.missing.items()} == {
+        'scan1': ['sess3'], 'any_scan': ['sess3']}
+    assert plan.ambiguous == {'any_scan': ['sess1']}
+    with pytest.raises(ArcanaSelectionError) as excinfo:
+        plan.raise_errors()
+    for msg in ("Missing 'scan1' in: sess3", "any_scan' in: sess1"):
+        assert msg in str(excinfo.value)
+    # Matched items are cached in the nodes
+    node = dataset.node(cl.session, 'sess2')
+    assert node['scan1'] is plan.items['scan1']['sess2']
+    assert node['any_scan'].path == 'scan1'
+    # Only the requested columns and nodes are matched
+    subset = dataset.match_columns(['scan1'], ids=['sess1'])
+    assert list(subset.items) == ['scan1']
+    assert list(subset.items['scan1']) == ['sess1']
+    assert not subset.errors
+    # Selected IDs only apply to the columns of their frequency, other
+    # columns are matched in the related nodes
+    nested_root = tmp_dir / 'nested'
+    for subj_id in ('subj1', 'subj2'):
+        for sess_id in ('0', '1'):
+            sess_dir = nested_root / subj_id / f'{subj_id}_{sess_id}'
+            sess_dir.mkdir(parents=True)
+            (sess_dir / 'scan1.txt').write_text(sess_id)
+    nested = FileSystem().dataset(
+        nested_root, hierarchy=[cl.subject, cl.session],
+        id_inference={cl.session: r'.*_(?P<timepoint>\d+)'})
+    nested.add_source('scan1', text)
+    nested.add_sink('subj_deriv', text, frequency='subject')
+    nested.add_sink('timepoint_deriv', text, frequency='timepoint')
+    subset = nested.match_columns(ids=['subj2_1'])
+    assert list(subset.items['scan1']) == ['subj2_1']
+    assert list(subset.items['subj_deriv']) == ['subj2']
+    assert list(subset.items['timepoint_deriv']) == ['1']
+    subset = nested.match_columns(ids=['subj1'], frequency='subject')
+    assert list(subset.items['subj_deriv']) == ['subj1']
+    assert sorted(subset.items['scan1']) == ['subj1_0', 'subj1_1']
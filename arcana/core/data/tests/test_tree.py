@@ -0,0 +1,137 @@
+import re
+import pytest
+from arcana.core.data.set import Dataset
+from arcana.core.data.selector import IdSelector
+from arcana.data.stores.file_system import FileSystem
+from arcana.data.dimensions.clinical import Clinical
+from arcana.exceptions import (
+    ArcanaDataTreeConstructionError, ArcanaUsageError)
+
+
+def empty_clinical_dataset(tmp_dir, **kwargs):
+    dataset = Dataset(str(tmp_dir), store=FileSystem(),
+                      hierarchy=[Clinical.subject, Clinical.session], **kwargs)
+    dataset._tree = dataset._new_tree()
+    return dataset
+
+
+def clinical_dataset(tmp_dir):
+    dataset = empty_clinical_dataset(tmp_dir, id_inference={
+        Clinical.subject: r'(?P<group>[A-Z]+)(?P<member>\d+)',
+        Clinical.session: r'.*_(?P<timepoint>\d+)'})
+    dataset.add_leaf_nodes(
+        [f'{g}{m:03}', f'{g}{m:03}_{t}']
+        for g in ('CONTROL', 'TEST') for m in range(200) for t in range(3))
+    return dataset
+
+
+def test_clinical_tree(tmp_dir):
+    dataset = clinical_dataset(tmp_dir)
+    assert len(dataset.nodes(Clinical.session)) == 1200
+    assert len(dataset.nodes(Clinical.subject)) == 400
+    assert sorted(dataset.node_ids(Clinical.group)) == ['CONTROL', 'TEST']
+    assert len(dataset.nodes(Clinical.member)) == 200
+    assert len(dataset.nodes(Clinical.timepoint)) == 3
+    subject = dataset.node(Clinical.subject, 'TEST007')
+    assert subject.ids == {Clinical.dataset: None, Clinical.group: 'TEST',
+                           Clinical.member: '007', Clinical.subject: 'TEST007'}
+    sessions = subject.children[Clinical.session]
+    assert sorted(sessions) == ['0', '1', '2']
+    assert sessions['1'].id == 'TEST007_1'
+    assert sessions['1'].ids[Clinical.timepoint] == '1'
+    group = dataset.node(Clinical.group, 'CONTROL')
+    assert len(group.children[Clinical.subject]) == 200
+    assert len(group.children[Clinical.session]) == 600
+    assert not group.children[Clinical.member]
+    # Views onto the same row of the table are equivalent
+    assert dataset.node(Clinical.session, 'TEST007_1') == sessions['1']
+
+
+def test_clashes(tmp_dir):
+    # Multiple sessions per subject without a way to infer the timepoints
+    # will clash in the children of the subject nodes
+    tree_paths = [['sub1', 'ses1'], ['sub1', 'ses2']]
+    dataset = empty_clinical_dataset(tmp_dir)
+    with pytest.raises(ArcanaDataTreeConstructionError, match='ID clash'):
+        dataset.add_leaf_nodes(tree_paths)
+    dataset = empty_clinical_dataset(tmp_dir)
+    dataset.add_leaf_node(tree_paths[0])
+    with pytest.raises(ArcanaDataTreeConstructionError, match='ID clash'):
+        dataset.add_leaf_node(tree_paths[1])
+    # Nodes added one at a time are checked against the children of their
+    # parents via an index that is kept up to date as they are linked
+    dataset = empty_clinical_dataset(tmp_dir, id_inference={
+        Clinical.session: r'.*_(?P<timepoint>\d+)'})
+    for subject in range(50):
+        for timepoint in range(3):
+            dataset.add_leaf_node([f'sub{subject}',
+                                   f'sub{subject}_{timepoint}'])
+    tree = dataset._tree
+    subject_row = tree.row(Clinical.subject, 'sub7')
+    assert tree.find_child(Clinical.subject, subject_row, Clinical.session,
+                           '2') == tree.row(Clinical.session, 'sub7_2')
+    assert tree.find_child(Clinical.subject, subject_row, Clinical.session,
+                           '3') is None
+    with pytest.raises(ArcanaDataTreeConstructionError, match='ID clash'):
+        dataset.add_leaf_node(['sub7', 'sub7_copy_2'])
+    tree.remove(Clinical.session, [tree.row(Clinical.session, 'sub7_2')])
+    assert tree.find_child(Clinical.subject, subject_row, Clinical.session,
+                           '2') is None
+
+
+def test_select(tmp_dir):
+    dataset = clinical_dataset(tmp_dir)
+
+    def select_ids(frequency, **kwargs):
+        return [n.id for n in dataset.select(frequency, **kwargs)]
+
+    assert select_ids('session', ids=['TEST001_2', 'CONTROL005_0',
+                                      'MISSING']) == [
+        'CONTROL005_0', 'TEST001_2']
+    # Cross-frequency constraints
+    assert select_ids('session', subject=['TEST010', 'TEST011'],
+                      timepoint='2') == ['TEST010_2', 'TEST011_2']
+    assert len(select_ids('session', group='CONTROL', timepoint='1')) == 200
+    # Prefixes and regular expressions
+    assert select_ids('subject', ids=IdSelector(prefix='TEST19')) == [
+        f'TEST19{i}' for i in range(10)]
+    assert select_ids('session', subject=re.compile(r'CONTROL00[0-2]'),
+                      timepoint='0') == [
+        'CONTROL000_0', 'CONTROL001_0', 'CONTROL002_0']
+    assert select_ids('subject', ids='TEST1[0-9]5',
+                      member=IdSelector(prefix='11')) == ['TEST115']
+    assert select_ids('session', subject='MISSING') == []
+    # Dataset.nodes uses the same indices
+    assert [n.id for n in dataset.nodes('subject', ids=['TEST003',
+                                                        'CONTROL003'])] == [
+        'CONTROL003', 'TEST003']
+    with pytest.raises(ArcanaUsageError):
+        dataset.select('subject', timepoint='1')
+
+
+def test_remove(tmp_dir):
+    dataset = clinical_dataset(tmp_dir)
+    tree = dataset._tree
+    subject = dataset.node(Clinical.subject, 'TEST007')
+    remaining = dataset.node(Clinical.session, 'TEST008_0')
+    # Remove all sessions of a subject and all sessions at a timepoint
+    tree.remove(Clinical.session, [
+        n._row for n in dataset.select('session', subject='TEST007')])
+    tree.remove(Clinical.session, [
+        n._row for n in dataset.select('session', timepoint='2')])
+    assert subject.children[Clinical.session] == {}
+    # The subject, the timepoint and the matchedpoints (group x timepoint)
+    # and batches (member x timepoint) of the timepoint are left empty
+    assert tree.prune(Clinical.session) == 1 + 1 + 2 + 200
+    assert len(dataset.nodes(Clinical.session)) == 798
+    assert len(dataset.nodes(Clinical.subject)) == 399
+    assert 'TEST007' not in dataset.node_ids(Clinical.subject)
+    assert sorted(dataset.node_ids(Clinical.timepoint)) == ['0', '1']
+    assert not dataset.select('session', timepoint='2')
+    # Rows of the remaining nodes are unchanged
+    assert remaining.id == 'TEST008_0'
+    assert remaining.ids[Clinical.subject] == 'TEST008'
+    # Removed nodes can be added again
+    dataset.add_leaf_nodes([['TEST007', 'TEST007_2']])
+    assert sorted(dataset.node(Clinical.subject, 'TEST007').children[
+        Clinical.session]) == ['2']
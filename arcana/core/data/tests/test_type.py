@@ -0,0 +1,158 @@
+import gzip
+import zipfile
+from pathlib import Path
+import pytest
+from pydra import mark
+from pydra.engine.task import ShellCommandTask
+from arcana.core.data.type import (
+    FileFormat, FileGroupConverter, ConverterGraph, ConverterChain,
+    format_registry)
+from arcana.core.data.node import dir_exts
+from arcana.core.data.conversion_cache import (
+    ConversionCache, set_default_conversion_cache)
+from arcana.data.types.neuroimaging import nifti, nifti_gz, niftix_gz, dicom
+from arcana.exceptions import ArcanaNoConverterError, ArcanaNameError
+
+
+@mark.task
+@mark.annotate({'return': {'out_file': str}})
+def append_ext(in_file: str, ext: str):
+    out_file = Path.cwd() / (Path(in_file).name.split('.')[0] + ext)
+    out_file.write_text(Path(in_file).read_text() + ext)
+    return str(out_file)
+
+
+class ExpensiveTask(ShellCommandTask):
+    pass
+
+
+def test_converter_graph():
+    a, b, c, d = (FileFormat(name=f'fmt_{x}', extension=f'.{x}')
+                  for x in 'abcd')
+    graph = ConverterGraph()
+    a_to_b = FileGroupConverter(a, b, append_ext, None, None)
+    b_to_c = FileGroupConverter(b, c, append_ext, None, None)
+    a_to_c = FileGroupConverter(a, c, ExpensiveTask, None, None)
+    c_to_d = FileGroupConverter(c, d, append_ext, None, None, cost=0.5)
+    for converter in (a_to_b, b_to_c, a_to_c, c_to_d):
+        graph.add(converter)
+    assert a_to_b.cost == FileGroupConverter.IN_PROCESS_COST
+    assert a_to_c.cost == FileGroupConverter.SUBPROCESS_COST
+    # Two in-process hops are cheaper than one subprocess
+    assert graph.find_path(a, c) == (a_to_b, b_to_c)
+    assert graph.find_path(a, d) == (a_to_b, b_to_c, c_to_d)
+    assert graph.find_path(b, d) == (b_to_c, c_to_d)
+    with pytest.raises(ArcanaNoConverterError):
+        graph.find_path(d, a)
+    # Planned paths are cached until new converters are added
+    assert (a, c) in graph._paths
+    a_to_c.cost = 1.5
+    graph.add(a_to_c)
+    assert not graph._paths
+    assert graph.find_path(a, c) == (a_to_c,)
+
+
+def test_converter_chain(work_dir):
+    x, y, z = (FileFormat(name=f'fmt_{e}', extension=f'.{e}')
+               for e in 'xyz')
+    y.set_converter(x, append_ext, ext='.y')
+    z.set_converter(y, append_ext, ext='.z')
+    converter = z.converter(x)
+    assert isinstance(converter, ConverterChain)
+    assert converter.from_format is x and converter.to_format is z
+    assert converter.cost == 2 * FileGroupConverter.IN_PROCESS_COST
+    fpath = work_dir / 'file.x'
+    fpath.write_text('x')
+    wf = converter(name='convert', to_convert=x.from_path(str(fpath)),
+                   cache_dir=work_dir / 'cache')
+    result = wf(plugin='serial')
+    converted = result.output.converted
+    assert converted.datatype == z
+    assert Path(converted.fs_path).read_text() == 'x.y.z'
+
+
+def test_conversion_cache(work_dir):
+    x, y = (FileFormat(name=f'fmt_cached_{e}', extension=f'.{e}')
+            for e in 'xy')
+    y.set_converter(x, append_ext, ext='.y')
+    cache = ConversionCache(work_dir / 'conversions')
+    fpath = work_dir / 'file.x'
+    fpath.write_text('x')
+    set_default_conversion_cache(cache)
+    try:
+        converted = []
+        for i in range(2):
+            wf = y.converter(x)(name='convert',
+                                to_convert=x.from_path(str(fpath)),
+                                cache_dir=work_dir / f'cache{i}')
+            converted.append(Path(wf(plugin='serial').output.converted.fs_path))
+    finally:
+        set_default_conversion_cache(None)
+    assert [p.read_text() for p in converted] == ['x.y', 'x.y']
+    # The second result was cloned from the cache, so writes to it can't
+    # modify the cached file
+    cached = next(p for p in cache.cache_dir.rglob('file.y'))
+    assert not converted[1].samefile(cached)
+    assert cache.size == 3
+    # Hard-linked entries are read-only and discarded if they are modified
+    # regardless
+    linked = ConversionCache(work_dir / 'linked', copy_mode='hardlink')
+    to_link = work_dir / 'to_link' / 'file.y'
+    to_link.parent.mkdir()
+    to_link.write_text('x.y')
+    linked.put('key', y.from_path(str(to_link)))
+    entry_fpath = linked.cache_dir / 'key' / 'file.y'
+    assert not entry_fpath.stat().st_mode & 0o222
+    (work_dir / 'linked1').mkdir()
+    linked_fpath = Path(linked.get('key', y, work_dir / 'linked1').fs_path)
+    assert linked_fpath.samefile(entry_fpath)
+    linked_fpath.chmod(0o644)
+    linked_fpath.write_text('modified')
+    assert linked.get('key', y, work_dir / 'linked2') is None
+    assert linked.size == 0
+    # Changing the input changes the key
+    fpath.write_text('changed')
+    converter = y.converter(x)
+    key = cache.key(converter, x.from_path(str(fpath)))
+    assert cache.get(key, y, work_dir) is None
+    cache.put(key, y.from_path(str(converted[0])))
+    assert cache.size == 6
+    # Least recently used results are evicted
+    assert len(cache.evict(4)) == 1
+    assert cache.get(key, y, work_dir / 'cache0') is not None
+
+
+def test_format_registry(work_dir):
+    fmt = FileFormat(name='fmt_registered', extension='.Reg',
+                     alternate_names=['registered'])
+    assert format_registry.by_name('REGISTERED') == [fmt]
+    assert format_registry.by_ext('.reg') == [fmt]
+    assert format_registry.has_name(fmt, 'fmt_registered')
+    assert not format_registry.has_name(nifti, 'fmt_registered')
+    assert nifti_gz in format_registry.by_ext('.nii.gz')
+    assert niftix_gz in format_registry.by_ext('.nii.gz')
+    assert format_registry.resolve('nifti_gz') is nifti_gz
+    with pytest.raises(ArcanaNameError):
+        format_registry.resolve('not_a_format')
+    # Files with missing or unrecognised extensions are sniffed
+    header = bytearray(348)
+    header[344:348] = b'n+1\x00'
+    (work_dir / 'image').write_bytes(header)
+    (work_dir / 'image.gz').write_bytes(gzip.compress(bytes(header)))
+    dicom_bytes = bytes(128) + b'DICM' + bytes(100)
+    (work_dir / '1.2.840.10008').write_bytes(dicom_bytes)
+    with zipfile.ZipFile(work_dir / 'archive.bin', 'w') as zfile:
+        zfile.writestr('a.txt', 'a')
+    assert format_registry.sniff(work_dir / 'image') == '.nii'
+    assert format_registry.sniff(work_dir / 'image.gz') == '.nii.gz'
+    assert format_registry.sniff(work_dir / '1.2.840.10008') == '.dcm'
+    assert format_registry.sniff(work_dir / 'archive.bin') == '.zip'
+    assert nifti in format_registry.from_path(work_dir / 'image')
+    assert nifti_gz in format_registry.from_path(work_dir / 'image.gz')
+    assert format_registry.sniff(work_dir) is None
+    # Directories of extension-less DICOMs are matched by sniffing them
+    dicom_dir = work_dir / 'dicoms'
+    dicom_dir.mkdir()
+    for i in range(3):
+        (dicom_dir / f'1.2.{i}').write_bytes(dicom_bytes)
+    assert dicom.within_dir_exts == dir_exts(dicom_dir)
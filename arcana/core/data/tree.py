@@ -0,0 +1,540 @@
+from __future__ import annotations
+import typing as ty
+import threading
+from bisect import bisect_left
+import numpy as np
+from .dimensions import DataDimensions
+from .selector import IdSelector
+
+
+# Code used for frequencies that aren't present in the IDs of a node, and
+# for parents that aren't linked to a node
+ABSENT = -1
+
+
+class DataTree():
+    """A columnar table of the nodes in the data tree of a dataset. Node IDs
+    are interned into integer codes per frequency, and the IDs of each node
+    (over all frequencies) and the rows of the parent nodes it is linked to
+    are stored in NumPy arrays, with one table per frequency, one row per node
+    and one column per frequency of the data dimensions. `DataNode` objects
+    are lightweight views onto a row of the table.
+
+    Parameters
+    ----------
+    space : type
+        The DataDimensions subclass of the dataset
+    """
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, space: type):
+        self.space = space
+        n_cols = max(space).value + 1
+        self.freqs: ty.List[DataDimensions] = [None] * n_cols
+        for freq in space:
+            self.freqs[freq.value] = freq
+        # Intern tables mapping node IDs of each frequency to integer codes
+        # and back again
+        self._codes = [{} for _ in range(n_cols)]
+        self._values = [[] for _ in range(n_cols)]
+        # The row of the node of each frequency with each ID code
+        self._code_rows = [np.full(0, ABSENT, dtype=np.int32)
+                           for _ in range(n_cols)]
+        # The ID codes of each node for all frequencies and the rows of
+        # parent nodes it is linked to, one table for each frequency
+        self._ids = [self._empty_table(n_cols) for _ in range(n_cols)]
+        self._parents = [self._empty_table(n_cols) for _ in range(n_cols)]
+        self._sizes = [0] * n_cols
+        # The number of rows of each table that have been removed. Removed
+        # rows are left in place (with all their IDs and parents set to
+        # ABSENT) so that the rows of the remaining nodes don't change
+        self._n_removed = [0] * n_cols
+        # Unresolved items found in the nodes and items matched to columns,
+        # sparsely keyed by row
+        self._unresolved = [{} for _ in range(n_cols)]
+        self._items = [{} for _ in range(n_cols)]
+        # Lazily-built indices of the unresolved items of each node (see
+        # `UnresolvedIndex`), which also cache the items resolved from them
+        self._item_indices = [{} for _ in range(n_cols)]
+        # Items of nodes that are in the process of being found, which are
+        # only published to `_unresolved` once the search is complete, along
+        # with events that other threads accessing the node can wait on
+        self._staged = {}
+        self._discovering = {}
+        self._lock = threading.Lock()
+        # Lazily-built indices of the rows of child nodes, sorted by the rows
+        # of the parent nodes they are linked to
+        self._child_indices = [{} for _ in range(n_cols)]
+        # Lazily-built maps from the rows of parent nodes and the ID codes
+        # that children are keyed by in them to the rows of the children,
+        # which are kept up to date as nodes are linked to their parents
+        self._child_keys = [{} for _ in range(n_cols)]
+        # Lazily-built indices of the rows of nodes sorted by the ID codes
+        # in each column of their table, and of the string IDs of each
+        # frequency in lexical order (for prefix selection)
+        self._id_indices = [{} for _ in range(n_cols)]
+        self._sorted_ids = [None] * n_cols
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Locks can't be pickled and searches in progress can't be resumed
+        del state['_lock']
+        state['_staged'] = {}
+        state['_discovering'] = {}
+        state['_child_keys'] = [{} for _ in self._child_keys]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_child_keys' not in state:
+            self._child_keys = [{} for _ in self.freqs]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(self._sizes) - sum(self._n_removed)
+
+    def size(self, frequency: DataDimensions) -> int:
+        """The number of nodes of the given frequency"""
+        f = frequency.value
+        return self._sizes[f] - self._n_removed[f]
+
+    def rows(self, frequency: DataDimensions) -> np.ndarray:
+        """Returns the rows of all nodes of the given frequency that haven't
+        been removed, in the order they were inserted"""
+        f = frequency.value
+        if not self._n_removed[f]:
+            return np.arange(self._sizes[f])
+        return np.flatnonzero(self._ids[f][:self._sizes[f], f] != ABSENT)
+
+    def row(self, frequency: DataDimensions, id) -> ty.Optional[int]:
+        """Returns the row of the node of the given frequency and ID, or None
+        if it isn't present"""
+        f = frequency.value
+        code = self._codes[f].get(id)
+        if code is None:
+            return None
+        code_rows = self._code_rows[f]
+        if code >= len(code_rows) or code_rows[code] == ABSENT:
+            return None
+        return int(code_rows[code])
+
+    def id(self, frequency: DataDimensions, row: int):
+        """Returns the ID of the node of the given frequency at the given row"""
+        f = frequency.value
+        return self._values[f][self._ids[f][row, f]]
+
+    def ids(self, frequency: DataDimensions, row: int) -> ty.Dict[
+            DataDimensions, str]:
+        """Returns the IDs of the node at the given row for its frequency and
+        all of its "parent" frequencies"""
+        return {self.freqs[f]: self._values[f][c]
+                for f, c in enumerate(self._ids[frequency.value][row].tolist())
+                if c != ABSENT}
+
+    def node_ids(self, frequency: DataDimensions) -> ty.List[str]:
+        """Returns the IDs of all nodes of the given frequency in the order
+        they were inserted"""
+        f = frequency.value
+        values = self._values[f]
+        return [values[c]
+                for c in self._ids[f][self.rows(frequency), f].tolist()]
+
+    def unresolved(self, frequency: DataDimensions, row: int):
+        return self._unresolved[frequency.value].get(row)
+
+    def set_unresolved(self, frequency: DataDimensions, row: int, unresolved):
+        self._unresolved[frequency.value][row] = unresolved
+        self._item_indices[frequency.value].pop(row, None)
+
+    def append_unresolved(self, frequency: DataDimensions, row: int, item):
+        """Appends an item to the unresolved items of a node, or to its staged
+        items if they are in the process of being found"""
+        key = (frequency.value, row)
+        with self._lock:
+            try:
+                unresolved = self._staged[key]
+            except KeyError:
+                unresolved = self._unresolved[frequency.value].setdefault(
+                    row, [])
+            unresolved.append(item)
+            self._item_indices[frequency.value].pop(row, None)
+
+    def discover(self, frequency: DataDimensions, row: int,
+                 find: ty.Callable[[], None]):
+        """Runs a search for the unresolved items of a node (which adds them
+        via `append_unresolved`) unless it has already been run. The found
+        items are staged until the search completes and then published
+        together, so other threads never see a partially populated node and
+        wait for a search already in progress instead of repeating it. If the
+        search fails, nothing is published and the exception is raised.
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the node
+        row : int
+            The row of the node
+        find : Callable
+            Function that adds the items of the node
+
+        Returns
+        -------
+        list[UnresolvedDataItem]
+            The unresolved items of the node
+        """
+        f = frequency.value
+        key = (f, row)
+        with self._lock:
+            try:
+                return self._unresolved[f][row]
+            except KeyError:
+                pass
+            try:
+                event, owner = self._discovering[key]
+            except KeyError:
+                event = threading.Event()
+                owner = threading.get_ident()
+                self._discovering[key] = (event, owner)
+                self._staged[key] = staged = []
+            else:
+                if owner == threading.get_ident():
+                    # Accessed from within the search itself
+                    return self._staged[key]
+                staged = None
+        if staged is None:
+            event.wait()
+            # If the search failed in the other thread this will try again
+            return self.discover(frequency, row, find)
+        try:
+            find()
+        except Exception:
+            with self._lock:
+                del self._staged[key]
+            raise
+        else:
+            with self._lock:
+                self._unresolved[f][row] = self._staged.pop(key)
+        finally:
+            with self._lock:
+                del self._discovering[key]
+            event.set()
+        return staged
+
+    def items(self, frequency: DataDimensions, row: int) -> dict:
+        return self._items[frequency.value].setdefault(row, {})
+
+    def item_index(self, frequency: DataDimensions, row: int):
+        return self._item_indices[frequency.value].get(row)
+
+    def set_item_index(self, frequency: DataDimensions, row: int, index):
+        self._item_indices[frequency.value][row] = index
+
+    def clear_items(self, frequency: DataDimensions, row: int):
+        """Drops the unresolved items found in a node and the items matched
+        to columns from them, so they are searched for again on next access"""
+        with self._lock:
+            self._unresolved[frequency.value].pop(row, None)
+        self._items[frequency.value].pop(row, None)
+        self._item_indices[frequency.value].pop(row, None)
+
+    def add_row(self, frequency: DataDimensions,
+                ids: ty.Dict[DataDimensions, str]) -> int:
+        """Appends a node of the given frequency to the table. Checking that
+        the ID of the node is not already present is left to the caller
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the node
+        ids : Dict[DataDimensions, str]
+            The IDs of the node and all of its "parent" frequencies
+
+        Returns
+        -------
+        int
+            The row of the new node
+        """
+        f = frequency.value
+        row = self._sizes[f]
+        if row == len(self._ids[f]):
+            self._ids[f] = self._grow(self._ids[f])
+            self._parents[f] = self._grow(self._parents[f])
+        id_codes = self._ids[f][row]
+        for freq, id in ids.items():
+            id_codes[freq.value] = self._intern(freq.value, id)
+        code = int(id_codes[f])
+        if code >= len(self._code_rows[f]):
+            self._code_rows[f] = self._grow(self._code_rows[f], code + 1)
+        self._code_rows[f][code] = row
+        self._sizes[f] += 1
+        self._child_indices[f].clear()
+        self._id_indices[f].clear()
+        return row
+
+    def link(self, frequency: DataDimensions, row: int,
+             parent_freq: DataDimensions, parent_row: int):
+        """Links a node to one of its parent nodes"""
+        f, p = frequency.value, parent_freq.value
+        self._parents[f][row, p] = parent_row
+        self._child_indices[f].pop(p, None)
+        keys = self._child_keys[f].get(p)
+        if keys is not None:
+            keys.setdefault((parent_row, int(self._ids[f][row, f - p])), row)
+
+    def remove(self, frequency: DataDimensions, rows: ty.Iterable[int]):
+        """Removes nodes from the table, along with the items found in them.
+        The rows of the remaining nodes are unaffected. Parent nodes left
+        without any children are not removed (see `prune`)
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the nodes to remove
+        rows : Iterable[int]
+            The rows of the nodes to remove
+        """
+        f = frequency.value
+        rows = np.asarray(list(rows), dtype=np.int64)
+        codes = self._ids[f][rows, f]
+        rows = rows[codes != ABSENT]  # Skip rows already removed
+        if not len(rows):
+            return
+        self._code_rows[f][codes[codes != ABSENT]] = ABSENT
+        self._ids[f][rows] = ABSENT
+        self._parents[f][rows] = ABSENT
+        self._n_removed[f] += len(rows)
+        for row in rows.tolist():
+            self.clear_items(frequency, row)
+        self._child_indices[f].clear()
+        self._child_keys[f].clear()
+        self._id_indices[f].clear()
+
+    def prune(self, frequency: DataDimensions):
+        """Removes the nodes of all "parent" frequencies of the given
+        frequency that aren't linked to any nodes of that frequency, e.g.
+        subjects and timepoints that no longer have any sessions after
+        sessions have been removed
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the nodes (typically the leaf frequency) that
+            all nodes of its parent frequencies should be linked to
+
+        Returns
+        -------
+        int
+            The number of nodes removed
+        """
+        f = frequency.value
+        linked = self._parents[f][self.rows(frequency)]
+        n_removed = 0
+        for parent_freq in self.space:
+            p = parent_freq.value
+            if not p or not parent_freq.is_parent(frequency):
+                continue
+            orphans = np.setdiff1d(self.rows(parent_freq), linked[:, p],
+                                   assume_unique=False)
+            self.remove(parent_freq, orphans)
+            n_removed += len(orphans)
+        return n_removed
+
+    def child_rows(self, parent_freq: DataDimensions, parent_row: int,
+                   frequency: DataDimensions) -> np.ndarray:
+        """Returns the rows of the nodes of the given frequency that are linked
+        to a parent node, in the order they were inserted. All nodes of the
+        frequency are children of the root node"""
+        f, p = frequency.value, parent_freq.value
+        if not p:
+            return self.rows(frequency)
+        try:
+            order, parent_rows = self._child_indices[f][p]
+        except KeyError:
+            parent_rows = self._parents[f][:self._sizes[f], p]
+            order = np.argsort(parent_rows, kind='stable')
+            parent_rows = parent_rows[order]
+            self._child_indices[f][p] = (order, parent_rows)
+        start, end = np.searchsorted(parent_rows, [parent_row, parent_row + 1])
+        return order[start:end]
+
+    def child_ids(self, parent_freq: DataDimensions, frequency: DataDimensions,
+                  rows: np.ndarray) -> list:
+        """Returns the IDs that the nodes at the given rows are keyed by in
+        the children of their parent node of the given frequency (i.e. the
+        IDs of the frequency that separates them from the parent, or their own
+        IDs for children of the root node)"""
+        f = frequency.value
+        diff = f - parent_freq.value
+        values = self._values[diff]
+        return [values[c] for c in self._ids[f][rows, diff].tolist()]
+
+    def find_child(self, parent_freq: DataDimensions, parent_row: int,
+                   frequency: DataDimensions, diff_id) -> ty.Optional[int]:
+        """Finds the row of a child of a parent node that is keyed by the given
+        ID, or None if there isn't one"""
+        f, p = frequency.value, parent_freq.value
+        code = self._codes[f - p].get(diff_id)
+        if code is None:
+            return None
+        try:
+            keys = self._child_keys[f][p]
+        except KeyError:
+            size = self._sizes[f]
+            linked = np.flatnonzero(self._parents[f][:size, p] != ABSENT)
+            # Reversed so the first of any clashing children is kept
+            keys = self._child_keys[f][p] = dict(zip(
+                zip(self._parents[f][linked, p].tolist()[::-1],
+                    self._ids[f][linked, f - p].tolist()[::-1]),
+                linked.tolist()[::-1]))
+        return keys.get((parent_row, code))
+
+    def select(self, frequency: DataDimensions,
+               constraints: ty.Dict[DataDimensions, IdSelector]) -> np.ndarray:
+        """Selects the rows of nodes of the given frequency that have IDs
+        selected by each of the constraints. Each constraint is looked up in
+        an index, so the time taken is proportional to the number of matching
+        nodes rather than the size of the tree (except for regular expressions,
+        which need to be matched against every distinct ID of the constrained
+        frequency)
+
+        Parameters
+        ----------
+        frequency : DataDimensions
+            The frequency of the nodes to select
+        constraints : Dict[DataDimensions, IdSelector]
+            Selectors for the IDs of the frequency of the nodes or any of its
+            "parent" frequencies
+
+        Returns
+        -------
+        np.ndarray
+            The selected rows in the order the nodes were inserted
+        """
+        f = frequency.value
+        selected = None
+        # Apply the most selective (i.e. literal) constraints first
+        for col_freq, selector in sorted(
+                constraints.items(), key=lambda c: not c[1].is_literal):
+            if selected is not None and not len(selected):
+                break
+            rows = self._rows_with_codes(
+                f, col_freq.value, self._matching_codes(col_freq.value,
+                                                        selector))
+            if selected is None:
+                selected = rows
+            else:
+                selected = np.intersect1d(selected, rows, assume_unique=True)
+        if selected is None:
+            return self.rows(frequency)
+        return selected
+
+    def _matching_codes(self, c: int, selector: IdSelector) -> ty.List[int]:
+        """Returns the codes of the interned IDs of a frequency that are
+        selected by the selector"""
+        codes = self._codes[c]
+        if selector.is_literal:
+            return [codes[i] for i in selector.ids if i in codes]
+        if selector.prefix is not None:
+            if (self._sorted_ids[c] is None
+                    or self._sorted_ids[c][2] != len(codes)):
+                sorted_ids = sorted((i, k) for i, k in codes.items()
+                                    if isinstance(i, str))
+                self._sorted_ids[c] = ([i for i, _ in sorted_ids],
+                                       [k for _, k in sorted_ids], len(codes))
+            ids, id_codes, _ = self._sorted_ids[c]
+            matching = []
+            for i in range(bisect_left(ids, selector.prefix), len(ids)):
+                if not ids[i].startswith(selector.prefix):
+                    break
+                matching.append(id_codes[i])
+            return matching
+        return [k for i, k in codes.items() if selector.match(i)]
+
+    def _rows_with_codes(self, f: int, c: int,
+                         codes: ty.List[int]) -> np.ndarray:
+        """Returns the sorted rows of the table for frequency `f` that have the
+        given ID codes in column `c`"""
+        if not codes:
+            return np.empty(0, dtype=np.int64)
+        if c == f:
+            code_rows = self._code_rows[f]
+            rows = code_rows[[k for k in codes if k < len(code_rows)]]
+            rows = rows[rows != ABSENT]
+        else:
+            try:
+                order, sorted_codes = self._id_indices[f][c]
+            except KeyError:
+                sorted_codes = self._ids[f][:self._sizes[f], c]
+                order = np.argsort(sorted_codes, kind='stable')
+                sorted_codes = sorted_codes[order]
+                self._id_indices[f][c] = (order, sorted_codes)
+            codes = np.asarray(codes)
+            starts = np.searchsorted(sorted_codes, codes, side='left')
+            ends = np.searchsorted(sorted_codes, codes, side='right')
+            rows = np.concatenate(
+                [order[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+                + [np.empty(0, dtype=order.dtype)])
+        return np.sort(rows).astype(np.int64)
+
+    def find_clashes(self):
+        """Finds nodes that are linked to the same parent node and keyed by the
+        same ID in its children, in a single vectorised pass over the table
+
+        Returns
+        -------
+        list[tuple[DataDimensions, int, DataDimensions, list[int]]]
+            The parent frequency and row, the frequency of the children and
+            the rows of the clashing children for each clash
+        """
+        clashes = []
+        for frequency in self.space:
+            f = frequency.value
+            size = self._sizes[f]
+            if not size:
+                continue
+            parents = self._parents[f][:size]
+            ids = self._ids[f][:size]
+            for parent_freq in self.space:
+                p = parent_freq.value
+                if not p or not parent_freq.is_parent(frequency):
+                    continue
+                linked = np.flatnonzero(parents[:, p] != ABSENT)
+                if len(linked) < 2:
+                    continue
+                keys = ((parents[linked, p].astype(np.int64) << 32)
+                        | ids[linked, f - p].astype(np.int64))
+                _, inverse, counts = np.unique(
+                    keys, return_inverse=True, return_counts=True)
+                for dup in np.flatnonzero(counts > 1):
+                    rows = linked[inverse.ravel() == dup].tolist()
+                    clashes.append((parent_freq, int(parents[rows[0], p]),
+                                    frequency, rows))
+        return clashes
+
+    @property
+    def nbytes(self):
+        """The memory used by the arrays of the table (excluding the intern
+        tables and the items found in the nodes)"""
+        return sum(a.nbytes for arrays in (self._ids, self._parents,
+                                           self._code_rows)
+                   for a in arrays)
+
+    def _intern(self, f, id):
+        codes = self._codes[f]
+        try:
+            return codes[id]
+        except KeyError:
+            code = codes[id] = len(codes)
+            self._values[f].append(id)
+            return code
+
+    @classmethod
+    def _empty_table(cls, n_cols):
+        return np.full((cls.INITIAL_CAPACITY, n_cols), ABSENT, dtype=np.int32)
+
+    @classmethod
+    def _grow(cls, array, min_length=0):
+        return np.concatenate((array, np.full(
+            (max(len(array), min_length),) + array.shape[1:], ABSENT,
+            dtype=array.dtype)))
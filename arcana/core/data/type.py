@@ -1,18 +1,28 @@
 import os.path as op
 from copy import copy
 from abc import abstractmethod, ABCMeta
+import heapq
+import gzip
+import pkgutil
+import tempfile
+from importlib import import_module
 from collections import defaultdict
 from pathlib import Path
 import numpy as np
 import attr
+import typing as ty
 from typing import Any, Dict
 from pydra import Workflow
 from pydra.engine.core import TaskBase
+from pydra.engine.task import ShellCommandTask
 from ..utils import func_task
 import logging
 from arcana.exceptions import (
-    ArcanaFileFormatError, ArcanaUsageError, ArcanaNoConverterError)
+    ArcanaFileFormatError, ArcanaUsageError, ArcanaNoConverterError,
+    ArcanaNameError)
 import arcana.core.data.item
+from .fscache import fs_cache
+from .conversion_cache import ConversionCache, default_conversion_cache
 
 
 logger = logging.getLogger('arcana')
@@ -84,6 +94,7 @@ class FileFormat(object):
                 raise ArcanaUsageError(
                     "Extension for side car '{}' cannot be the same as the "
                     "primary file ('{}')".format(sc_name, sc_ext))
+        format_registry.register(self)
 
     def __eq__(self, other):
         try:
@@ -127,8 +138,7 @@ class FileFormat(object):
     def __call__(self, *args, **kwargs):
         """Temporary workaround until FileFormat is retired in place of using
         separate subclasses for each type"""
-        from .item import FileGroup
-        return FileGroup(*args, datatype=self, **kwargs)
+        return self.file_group_cls(*args, datatype=self, **kwargs)
 
     @property
     def all_names(self):
@@ -193,12 +203,35 @@ class FileFormat(object):
         return f"{file_group_name}___{aux_name}"
 
     def converter(self, file_format):
+        """Returns a converter from the given format to this one. If there
+        isn't a converter set directly between the formats, the cheapest chain
+        of converters that links them is planned from the converter graph
+        (see `ConverterGraph`)
+
+        Parameters
+        ----------
+        file_format : FileFormat
+            The format to convert from
+
+        Returns
+        -------
+        FileGroupConverter or ConverterChain
+            The converter, which is called to create a workflow that converts
+            file groups between the formats
+
+        Raises
+        ------
+        ArcanaNoConverterError
+            If there is no chain of converters between the formats
+        """
         try:
             return self._converters[file_format]
         except KeyError:
-            raise ArcanaNoConverterError(
-                f"No converter set for conversion between {self} and "
-                f"{file_format}")
+            pass
+        path = converter_graph.find_path(file_format, self)
+        if len(path) == 1:
+            return path[0]
+        return ConverterChain(path)
 
     def input_spec_fields(self):
         return ['in_file'] + list(self.side_cars)
@@ -207,7 +240,7 @@ class FileFormat(object):
         return ['out_file'] + list(self.side_cars)
 
     def set_converter(self, file_format, task, inputs=None,
-                      outputs=None, **default_kwargs):
+                      outputs=None, cost=None, **default_kwargs):
         """Creates a small workflow that takes a file group of format
         `file_format` and converts it into a file-group of format `self`.
         Wraps up an existing task interface (e.g. Dcm2Nixx or MRConvert)
@@ -227,6 +260,11 @@ class FileFormat(object):
         outputs : Dict[str, str]
             Maps the auxiliary file names and 'in_file' (for primary) onto
             the appropriate fields in the converter's output spec
+        cost : float, optional
+            A hint of the relative cost of running the converter, used to
+            select the cheapest chain of converters between formats. By
+            default converters that run in a subprocess (shell commands) are
+            assumed to be 10 times as expensive as in-process (function) ones
         **default_kwargs
             Keyword arguments passed through to the task interface on
             initialisation
@@ -236,13 +274,16 @@ class FileFormat(object):
         if outputs is None:
             outputs = {'primary': 'out_file'}
         # Save the converter for when it is required
-        self._converters[file_format] = FileGroupConverter(
+        converter = FileGroupConverter(
             from_format=file_format,
             to_format=self,
             task=task,
             inputs=inputs,
             outputs=outputs,
-            task_kwargs=default_kwargs)
+            task_kwargs=default_kwargs,
+            cost=cost)
+        self._converters[file_format] = converter
+        converter_graph.add(converter)
 
     @property
     def convertable_from(self):
@@ -273,10 +314,7 @@ class FileFormat(object):
         by_ext = defaultdict(list)
         candidates = list(candidates)  # protect against iterators
         for path in candidates:
-            ext = ''.join(Path(path).suffixes).lower()
-            if not ext:
-                ext = None
-            by_ext[ext].append(path)
+            by_ext[fs_cache.ext(path)].append(path)
         primary_file = by_ext[self.ext]
         if not primary_file:
             raise ArcanaFileFormatError(
@@ -535,6 +573,21 @@ class FileGroupConverter:
     inputs: Dict[str, str] = attr.ib()
     outputs: Dict[str, str] = attr.ib()
     task_kwargs: Dict[str, Any] = attr.ib(factory=dict)
+    cost: float = attr.ib()
+
+    IN_PROCESS_COST = 1.0
+    SUBPROCESS_COST = 10.0
+
+    @cost.default
+    def cost_default(self):
+        return (self.SUBPROCESS_COST
+                if isinstance(self.task, type)
+                and issubclass(self.task, ShellCommandTask)
+                else self.IN_PROCESS_COST)
+
+    def __attrs_post_init__(self):
+        if self.cost is None:
+            self.cost = self.cost_default()
 
     @inputs.default
     def inputs_default(self):
@@ -559,7 +612,67 @@ class FileGroupConverter:
     def __call__(self, name, **kwargs):
         """
         Create a Pydra workflow to convert a file group from one format to
-        another
+        another. If a conversion cache is set (see
+        `set_default_conversion_cache`) the conversion is only run if the
+        result isn't already in the cache
+        """
+        from .item import FileGroup
+        cache = default_conversion_cache()
+        if cache is None:
+            return self.workflow(name, **kwargs)
+        wf = Workflow(name=name,
+                      input_spec=['to_convert'],
+                      **kwargs)
+        wf.add(func_task(
+            cached_conversion,
+            in_fields=[('converter', FileGroupConverter),
+                       ('cache', ConversionCache),
+                       ('to_convert', FileGroup)],
+            out_fields=[('converted', FileGroup)],
+            name='cached_conversion',
+            converter=self,
+            cache=cache,
+            to_convert=wf.lzin.to_convert))
+        wf.set_output(('converted', wf.cached_conversion.lzout.converted))
+        return wf
+
+    def convert(self, file_group, cache_dir=None):
+        """Converts a file group in the current process, without the
+        wrapping workflow (e.g. from within a task that is already running
+        in a workflow)
+
+        Parameters
+        ----------
+        file_group : FileGroup
+            The file group to convert
+        cache_dir : Path, optional
+            The cache directory to run the converter task in
+
+        Returns
+        -------
+        FileGroup
+            The converted file group
+        """
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp()
+        inputs_dir = Path(cache_dir) / 'converter_inputs'
+        inputs_dir.mkdir(parents=True, exist_ok=True)
+        paths = extract_paths(self.from_format, file_group,
+                              inputs=list(self.inputs), dest_dir=inputs_dir)
+        if len(self.inputs) == 1:
+            paths = (paths,)
+        conv_kwargs = copy(self.task_kwargs)
+        conv_kwargs.update((self.inputs[i], p)
+                           for i, p in zip(self.inputs, paths))
+        result = self.task(name='converter', cache_dir=cache_dir,
+                           **conv_kwargs)()
+        return encapsulate_paths(
+            self.to_format,
+            **{k: getattr(result.output, v) for k, v in self.outputs.items()})
+
+    def workflow(self, name, **kwargs):
+        """
+        Create a Pydra workflow that runs the converter task
         """
         from .item import FileGroup
         wf = Workflow(name=name,
@@ -570,11 +683,13 @@ class FileGroupConverter:
         # assume the converter expects)
         wf.add(func_task(
             extract_paths,
-            in_fields=[('from_format', type), ('file_group', FileGroup)],
+            in_fields=[('from_format', type), ('file_group', FileGroup),
+                       ('inputs', ty.List[str])],
             out_fields=[(i, str) for i in self.inputs],
             name='extract_paths',
             from_format=self.from_format,
-            file_group=wf.lzin.to_convert))
+            file_group=wf.lzin.to_convert,
+            inputs=list(self.inputs)))
 
         # Add the actual converter node
         conv_kwargs = copy(self.task_kwargs)
@@ -599,14 +714,332 @@ class FileGroupConverter:
         return wf
 
 
-def extract_paths(from_format, file_group):
-    """Copies files into the CWD renaming so the basenames match
-    except for extensions"""
+@attr.s
+class ConverterChain():
+    """A chain of converters that converts file groups between two formats
+    via intermediate formats, as planned by `ConverterGraph.find_path`
+
+    Parameters
+    ----------
+    converters : tuple[FileGroupConverter]
+        The converters to apply in order
+    """
+
+    converters: ty.Tuple[FileGroupConverter] = attr.ib(converter=tuple)
+
+    @property
+    def from_format(self):
+        return self.converters[0].from_format
+
+    @property
+    def to_format(self):
+        return self.converters[-1].to_format
+
+    @property
+    def cost(self):
+        return sum(c.cost for c in self.converters)
+
+    def __call__(self, name, **kwargs):
+        """
+        Create a Pydra workflow that chains the workflows of each converter
+        """
+        wf = Workflow(name=name,
+                      input_spec=['to_convert'],
+                      **kwargs)
+        converted = wf.lzin.to_convert
+        for i, converter in enumerate(self.converters):
+            step_name = f'step{i}_to_{converter.to_format.name}'
+            wf.add(converter(name=step_name, to_convert=converted))
+            converted = getattr(wf, step_name).lzout.converted
+        wf.set_output(('converted', converted))
+        return wf
+
+
+@attr.s
+class ConverterGraph():
+    """A graph of the converters between file formats, which is populated
+    by `FileFormat.set_converter` and used to plan the cheapest chain of
+    converters between formats that aren't linked by a single converter.
+    Planned chains are cached for each pair of formats until a new converter
+    is added.
+
+    Parameters
+    ----------
+    converters : Dict[FileFormat, Dict[FileFormat, FileGroupConverter]]
+        The converters from each format keyed by the format they convert to
+    """
+
+    converters: ty.Dict[FileFormat, ty.Dict[FileFormat, FileGroupConverter]] = (
+        attr.ib(factory=lambda: defaultdict(dict)))
+    _paths: ty.Dict[ty.Tuple[FileFormat, FileFormat],
+                    ty.Tuple[FileGroupConverter]] = attr.ib(factory=dict,
+                                                            repr=False)
+
+    def add(self, converter):
+        """Adds a converter to the graph (replacing any existing converter
+        between the same formats)"""
+        self.converters[converter.from_format][converter.to_format] = converter
+        self._paths.clear()
+
+    def find_path(self, from_format, to_format):
+        """Finds the cheapest chain of converters between two formats, going
+        by the cost hints of the converters
+
+        Parameters
+        ----------
+        from_format : FileFormat
+            The format to convert from
+        to_format : FileFormat
+            The format to convert to
+
+        Returns
+        -------
+        tuple[FileGroupConverter]
+            The converters to apply in order
+
+        Raises
+        ------
+        ArcanaNoConverterError
+            If there is no chain of converters between the formats
+        """
+        key = (from_format, to_format)
+        try:
+            path = self._paths[key]
+        except KeyError:
+            path = self._paths[key] = self._cheapest_path(from_format,
+                                                          to_format)
+        if path is None:
+            raise ArcanaNoConverterError(
+                f"No converter set for conversion between {to_format} and "
+                f"{from_format}, either directly or via intermediate formats")
+        return path
+
+    def _cheapest_path(self, from_format, to_format):
+        # Dijkstra's algorithm, the counter breaks ties between equal costs
+        # without comparing formats
+        costs = {from_format: 0.0}
+        queue = [(0.0, 0, from_format, ())]
+        counter = 1
+        while queue:
+            cost, _, fmt, path = heapq.heappop(queue)
+            if fmt == to_format and path:
+                logger.debug("Planned conversion from %s to %s via %s",
+                             from_format, to_format,
+                             ', '.join(str(c.to_format) for c in path[:-1]))
+                return path
+            if cost > costs.get(fmt, float('inf')):
+                continue
+            for next_fmt, converter in self.converters.get(fmt, {}).items():
+                next_cost = cost + converter.cost
+                if next_cost < costs.get(next_fmt, float('inf')):
+                    costs[next_fmt] = next_cost
+                    heapq.heappush(queue, (next_cost, counter, next_fmt,
+                                           path + (converter,)))
+                    counter += 1
+        return None
+
+
+converter_graph = ConverterGraph()
+
+
+@attr.s
+class FormatRegistry():
+    """A registry of all file formats, which are registered on creation,
+    indexed by their (lower-case) names and alternate names, their
+    (compound) extensions and the names they are defined under in the
+    modules of `arcana.data.types`. Files with unknown extensions (e.g. DICOM
+    files without extensions) are identified by "sniffing" the magic bytes at
+    the start of them.
+
+    Parameters
+    ----------
+    formats : list[FileFormat]
+        The registered formats in the order they were created
+    """
+
+    formats: ty.List[FileFormat] = attr.ib(factory=list)
+    _by_name: ty.Dict[str, ty.List[FileFormat]] = attr.ib(
+        factory=lambda: defaultdict(list), repr=False)
+    _by_ext: ty.Dict[str, ty.List[FileFormat]] = attr.ib(
+        factory=lambda: defaultdict(list), repr=False)
+    # Formats by the names they are defined under in arcana.data.types,
+    # loaded on first access
+    _by_attr: ty.Dict[str, ty.Any] = attr.ib(default=None, repr=False)
+
+    TYPES_PACKAGE = 'arcana.data.types'
+    SNIFF_SIZE = 352  # Long enough to include the NIfTI-1 magic string
+
+    def register(self, file_format):
+        """Adds a format to the indices of the registry"""
+        self.formats.append(file_format)
+        for name in set(file_format.all_names):
+            self._by_name[name.lower()].append(file_format)
+        if file_format.ext is not None:
+            self._by_ext[file_format.ext.lower()].append(file_format)
+
+    def by_name(self, name):
+        """Returns the formats with the given name or alternate name"""
+        return self._by_name.get(name.lower(), [])
+
+    def by_ext(self, ext):
+        """Returns the formats with the given (compound) extension"""
+        if ext is None:
+            return []
+        return self._by_ext.get(ext.lower(), [])
+
+    def has_name(self, file_format, name):
+        """Whether a resource name (e.g. on XNAT) refers to the format"""
+        return any(f is file_format or f == file_format
+                   for f in self.by_name(name))
+
+    def resolve(self, name):
+        """Resolves a format from the name it is defined under in a
+        sub-module of `arcana.data.types`
+
+        Parameters
+        ----------
+        name : str
+            The name of the format
+
+        Returns
+        -------
+        FileFormat
+            The resolved file format
+
+        Raises
+        ------
+        ArcanaNameError
+            If there is no format with that name
+        """
+        if self._by_attr is None:
+            self._by_attr = self._load_types()
+        try:
+            return self._by_attr[name]
+        except KeyError:
+            raise ArcanaNameError(
+                name,
+                f"Could not find format {name} in installed modules:\n"
+                + "\n    ".join(self._type_modules()))
+
+    def ext_of(self, path):
+        """Returns the extension used to look up the format of a file,
+        sniffing the type of the file if its extension isn't recognised
+
+        Parameters
+        ----------
+        path : str or Path
+            The path of the file
+
+        Returns
+        -------
+        str or None
+            The extension of the file, or the extension of the format sniffed
+            from its contents
+        """
+        ext = fs_cache.ext(path)
+        if ext is not None and ext in self._by_ext:
+            return ext
+        sniffed = self.sniff(path)
+        return sniffed if sniffed is not None else ext
+
+    def from_path(self, path):
+        """Returns the formats that a file could be stored in, going by its
+        extension or its magic bytes if the extension isn't recognised"""
+        return self.by_ext(self.ext_of(path))
+
+    @classmethod
+    def sniff(cls, path):
+        """Identifies the type of a file from the magic bytes at the start
+        of it
+
+        Parameters
+        ----------
+        path : str or Path
+            The path of the file
+
+        Returns
+        -------
+        str or None
+            The extension corresponding to the type of the file, or None if
+            it isn't recognised
+        """
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(cls.SNIFF_SIZE)
+        except (IsADirectoryError, FileNotFoundError, PermissionError):
+            return None
+        if header[:2] == b'\x1f\x8b':
+            try:
+                with gzip.open(path, 'rb') as f:
+                    inner = cls._sniff_header(f.read(cls.SNIFF_SIZE))
+            except (OSError, EOFError):
+                inner = None
+            return inner + '.gz' if inner is not None else '.gz'
+        return cls._sniff_header(header)
+
+    @staticmethod
+    def _sniff_header(header):
+        if header[344:348] in (b'n+1\x00', b'ni1\x00'):
+            return '.nii'
+        if header[4:8] in (b'n+2\x00', b'ni2\x00'):
+            return '.nii'
+        if header[128:132] == b'DICM':
+            return '.dcm'
+        if header[:4] == b'PK\x03\x04':
+            return '.zip'
+        if header[257:262] == b'ustar':
+            return '.tar'
+        if header[:12] == b'mrtrix image':
+            return '.mif'
+        return None
+
+    def _load_types(self):
+        by_attr = {}
+        for module_name in self._type_modules():
+            module = import_module(self.TYPES_PACKAGE + '.' + module_name)
+            for obj_name, obj in vars(module).items():
+                if isinstance(obj, FileFormat):
+                    by_attr[obj_name] = obj
+        return by_attr
+
+    def _type_modules(self):
+        package = import_module(self.TYPES_PACKAGE)
+        return [i.name for i in pkgutil.iter_modules(package.__path__)]
+
+
+format_registry = FormatRegistry()
+
+
+def cached_conversion(converter, cache, to_convert):
+    """Links the result of the conversion from the cache into the working
+    directory if present, otherwise runs the conversion and adds the result
+    to the cache"""
+    key = cache.key(converter, to_convert)
+    converted = cache.get(key, converter.to_format, Path.cwd())
+    if converted is None:
+        logger.debug("Converting %s to %s (%s not in conversion cache)",
+                     to_convert, converter.to_format, key)
+        converted = converter.convert(to_convert,
+                                      cache_dir=Path.cwd() / 'convert')
+        cache.put(key, converted)
+    return converted
+
+
+def extract_paths(from_format, file_group, inputs=None, dest_dir=None):
+    """Copies files into the CWD (or the destination directory if provided)
+    renaming so the basenames match except for extensions. If the names of the
+    converter inputs are provided ('primary' and side car names) only the
+    paths of those are returned, in that order"""
     logger.debug("Extracting paths from %s (%s format) before conversion", file_group, from_format)
     if file_group.datatype != from_format:
         raise ValueError(f"Format of {file_group} doesn't match converter {from_format}")
-    cpy = file_group.copy_to(Path(file_group.path).name, symlink=True)
-    paths = (cpy.fs_path,) + tuple(cpy.side_cars.values())
+    cpy = file_group.copy_to(
+        str(Path(dest_dir or '.') / Path(file_group.path).name), symlink=True)
+    if inputs is None:
+        paths = (cpy.fs_path,) + tuple(cpy.side_cars.values())
+    else:
+        paths = tuple(cpy.fs_path if i == 'primary' else cpy.side_cars[i]
+                      for i in inputs)
     return paths if len(paths) > 1 else paths[0]
 
 
@@ -10,7 +10,7 @@ from pydra.engine.task import FunctionTask
 from pydra.engine.specs import BaseSpec, SpecInfo
 from arcana.exceptions import ArcanaNameError, ArcanaUsageError
 from .data.item import DataItem, FileGroup
-from .data.set import Dataset
+from .data.set import Dataset, DatasetRef
 from .data.type import FileFormat
 from .data.dimensions import DataDimensions
 from .utils import func_task
@@ -92,7 +92,7 @@ class Pipeline():
 
     @property
     def dataset(self):
-        return self.wf.per_node.sink.inputs.dataset
+        return self.wf.per_node.sink.inputs.dataset.load()
 
     def __call__(self, *args, **kwargs):
         self.check_connections()
@@ -230,9 +230,14 @@ class Pipeline():
                 output_types[output_name] = produced_format = sink.datatype
             pipeline.outputs.append((output_name, produced_format))
 
+        # Pass a lightweight reference to the dataset to the tasks instead of
+        # the dataset itself, so the data tree isn't hashed and pickled with
+        # every task
+        dataset_ref = dataset.ref()
+
         # Generate list of nodes to process checking existing outputs
         wf.add(to_process(
-            dataset=dataset,
+            dataset=dataset_ref,
             frequency=frequency,
             outputs=pipeline.outputs,
             requested_ids=None,  # FIXME: Needs to be set dynamically
@@ -246,7 +251,7 @@ class Pipeline():
             id=wf.to_process.lzout.ids).split('id'))
 
         source_in = [
-            ('dataset', Dataset),
+            ('dataset', DatasetRef),
             ('frequency', DataDimensions),
             ('id', str),
             ('inputs', ty.Sequence[str])]
@@ -263,7 +268,7 @@ class Pipeline():
             in_fields=source_in,
             out_fields=list(source_out_dct.items()),
             name='source',
-            dataset=dataset,
+            dataset=dataset_ref,
             frequency=frequency,
             inputs=input_names,
             id=wf.per_node.lzin.id))
@@ -333,11 +338,12 @@ class Pipeline():
         wf.per_node.add(func_task(
             sink_items,
             in_fields=(
-                [('dataset', Dataset), ('frequency', DataDimensions), ('id', str)]
+                [('dataset', DatasetRef), ('frequency', DataDimensions),
+                 ('id', str)]
                 + [(s, DataItem) for s in to_sink]),
             out_fields=[('id', str)],
             name='sink',
-            dataset=dataset,
+            dataset=dataset_ref,
             frequency=frequency,
             id=wf.per_node.lzin.id,
             **to_sink))
@@ -382,7 +388,7 @@ def split_side_car_suffix(name):
 
 @mark.task
 @mark.annotate({
-    'dataset': Dataset,
+    'dataset': DatasetRef,
     'frequency': DataDimensions,
     'outputs': ty.Sequence[str],
     'requested_ids': ty.Sequence[str] or None,
@@ -390,13 +396,19 @@ def split_side_car_suffix(name):
         'ids': ty.List[str],
         'cant_process': ty.List[str]}})
 def to_process(dataset, frequency, outputs, requested_ids):
-    if requested_ids is None:
-        requested_ids = dataset.node_ids(frequency)
+    dataset = dataset.load()
     ids = []
     cant_process = []
+    # Match the outputs in all requested nodes in a single pass (finding the
+    # items in the nodes concurrently) before checking whether they exist
+    output_names = [o[0] for o in outputs]
+    plan = dataset.match_columns(output_names, ids=requested_ids,
+                                 frequency=frequency)
+    plan.raise_errors()
     for data_node in dataset.nodes(frequency, ids=requested_ids):
         # TODO: Should check provenance of existing nodes to see if it matches
-        not_exist = [not data_node[o[0]].exists for o in outputs]
+        not_exist = [not plan.items[o][data_node.id].exists
+                     for o in output_names]
         if all(not_exist):
             ids.append(data_node.id)
         elif any(not_exist):
@@ -411,6 +423,7 @@ def source_items(dataset, frequency, id, inputs):
     sources and retrieves them from the store to a cache on 
     the host"""
     logger.debug("Sourcing %s", inputs)
+    dataset = dataset.load()
     sourced = []
     data_node = dataset.node(frequency, id)
     with dataset.store:
@@ -424,6 +437,7 @@ def source_items(dataset, frequency, id, inputs):
 def sink_items(dataset, frequency, id, **to_sink):
     """Stores items generated by the pipeline back into the store"""
     logger.debug("Sinking %s", to_sink)
+    dataset = dataset.load()
     data_node = dataset.node(frequency, id)
     with dataset.store:
         for outpt_name, output in to_sink.items():
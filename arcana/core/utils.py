@@ -223,23 +223,8 @@ def resolve_datatype(name):
     """
     if re.match(r'int|float|str|list\[(int|float|str)\]', name):
         return eval(name)
-    import arcana.data.types
-    data_format = None
-    module_names = [
-        i.name for i in pkgutil.iter_modules(
-            [os.path.dirname(arcana.data.types.__file__)])]
-    for module_name in module_names:
-        module = import_module('arcana.data.types.' + module_name)
-        try:
-            data_format = getattr(module, name)
-        except AttributeError:
-            pass
-    if data_format is None:
-        raise ArcanaNameError(
-            name,
-            f"Could not find format {name} in installed modules:\n"
-            + "\n    ".join(module_names))
-    return data_format
+    from arcana.core.data.type import format_registry
+    return format_registry.resolve(name)
 
 
 def submodules(module):
@@ -307,18 +307,35 @@ class BidsFormat(FileSystem):
         except ArcanaEmptyDatasetError:
             return
 
+        tree_paths = []
+        explicit_ids = []
         for subject_id, participant in dataset.participants.items():
+            if not dataset.selects(dataset.hierarchy[0], subject_id):
+                continue
             try:
-                explicit_ids = {Clinical.group: participant['group']}
+                subject_explicit_ids = {Clinical.group: participant['group']}
             except KeyError:
-                explicit_ids = {}
+                subject_explicit_ids = {}
             if dataset.is_multi_session():
                 for sess_id in (dataset.root_dir / subject_id).iterdir():
-                    dataset.add_leaf_node([subject_id, sess_id],
-                                          explicit_ids=explicit_ids)
+                    tree_paths.append([subject_id, sess_id])
+                    explicit_ids.append(subject_explicit_ids)
             else:
-                dataset.add_leaf_node([subject_id],
-                                      explicit_ids=explicit_ids)
+                tree_paths.append([subject_id])
+                explicit_ids.append(subject_explicit_ids)
+        dataset.add_leaf_nodes(tree_paths, explicit_ids=explicit_ids)
+
+    def watermark(self, dataset: BidsDataset):
+        # Nodes are listed in the participants file rather than found by
+        # walking the directory tree, so changes are found by reloading it
+        return None
+
+    def _tree_version_depth(self, dataset, top_dir):
+        # Items are stored in modality sub-directories of the session
+        # directories, or in the same arrangement under
+        # 'derivatives/<pipeline-name>'
+        depth = len(dataset.hierarchy) + 1
+        return depth + 2 if top_dir == 'derivatives' else depth
 
     def find_items(self, data_node):
         rel_session_path = self.node_path(data_node)
@@ -5,9 +5,12 @@ import re
 from copy import copy
 import errno
 from collections import defaultdict
+from itertools import chain
 import shutil
 import logging
 import json
+import hashlib
+import time
 import attr
 from fasteners import InterProcessLock
 from arcana.core.data.provenance import DataProvenance
@@ -15,7 +18,9 @@ from arcana.exceptions import ArcanaFileFormatError, ArcanaMissingDataException,
 from arcana.core.utils import get_class_info, HOSTNAME, split_extension
 from arcana.core.data.set import Dataset
 from arcana.data.dimensions.clinical import Clinical, DataDimensions
-from arcana.core.data.store import DataStore
+from arcana.core.data.store import DataStore, DataTreeChanges
+from arcana.core.data.materialize import materialize
+from arcana.core.data.fscache import fs_cache
 
 
 logger = logging.getLogger('arcana')
@@ -42,6 +47,9 @@ class FileSystem(DataStore):
     LOCK_SUFFIX = '.lock'
     PROV_KEY = '__provenance__'
     VALUE_KEY = '__value__'
+    # Modification times up to this long before a watermark are treated as
+    # being after it, to allow for file systems with coarse timestamps
+    MTIME_MARGIN_NS = 2 * 10 ** 9
     
     def dataset(self, name, *args, **kwargs):
         name = Path(name)
@@ -66,11 +74,11 @@ class FileSystem(DataStore):
         side_cars = file_group.datatype.default_side_cars(primary_path)
         location_str = (f"{file_group.data_node} node of "
                         f"Dataset '{file_group.data_node.dataset.id}' on {self}")
-        if not op.exists(primary_path):
+        if not fs_cache.exists(primary_path):
             raise ArcanaMissingDataException(
                 f"File-group '{file_group.path}' ({primary_path}) does not exist in {location_str}")
         for aux_name, aux_path in side_cars.items():
-            if not op.exists(aux_path):
+            if not fs_cache.exists(aux_path):
                 raise ArcanaMissingDataException(
                     f"File-group '{file_group.path}' is missing '{aux_name}' side car "
                     f"({aux_path}) in {location_str}")
@@ -107,7 +115,7 @@ class FileSystem(DataStore):
         if not dname.exists():
             os.makedirs(dname)
         if fs_path.is_file():
-            shutil.copyfile(fs_path, target_path)
+            materialize(fs_path, target_path, self.copy_mode)
             sc_target_paths = file_group.datatype.default_side_cars(target_path)
             # Copy side car files into store
             if side_cars is not None:
@@ -119,7 +127,7 @@ class FileSystem(DataStore):
                     raise ArcanaFileFormatError(
                         f"Missing side car '{sc_name}' when attempting to "
                         f"put file_group")
-                shutil.copyfile(str(sc_path), str(sc_target_paths[sc_name]))
+                materialize(sc_path, sc_target_paths[sc_name], self.copy_mode)
             if side_cars:
                 raise ArcanaFileFormatError(
                     f"Unrecognised side cars ({side_cars}) when attempting to "
@@ -127,12 +135,17 @@ class FileSystem(DataStore):
         elif fs_path.is_dir():
             if target_path.exists():
                 shutil.rmtree(target_path)
-            shutil.copytree(fs_path, target_path)
+                fs_cache.invalidate(target_path)
+            materialize(fs_path, target_path, self.copy_mode)
         else:
             raise ValueError(
                 f"Source path '{fs_path}' to be set for {file_group} does not exist")
         if file_group.provenance is not None:
             file_group.provenance.save(self.prov_json_path(file_group))
+        for path in chain([target_path],
+                          file_group.datatype.default_side_cars(
+                              target_path).values()):
+            fs_cache.invalidate(path)
 
     def put_field(self, field, value):
         """
@@ -157,6 +170,7 @@ class FileSystem(DataStore):
                 self.PROV_KEY: field.provenance.dct}
             with open(fpath, 'w') as f:
                 json.dump(dct, f, indent=2)
+        fs_cache.invalidate(fpath)
 
     def find_nodes(self, dataset: Dataset):
         """
@@ -168,16 +182,178 @@ class FileSystem(DataStore):
         dataset : Dataset
             The dataset to construct the tree dimensions for
         """
+        dataset.add_leaf_nodes(self._find_tree_paths(dataset))
+
+    def _find_tree_paths(self, dataset: Dataset):
+        """Returns the tree paths of all leaf node directories of the dataset
+        that are selected by its included/excluded filters"""
         if not os.path.exists(dataset.id):
             raise ArcanaUsageError(
                 f"Could not find a directory at '{dataset.id}' to be the "
                 "root node of the dataset")
 
-        for dpath, _, _ in os.walk(dataset.id):
-            tree_path = Path(dpath).relative_to(dataset.id).parts
-            if (len(tree_path) == len(dataset.hierarchy)
-                    and not re.match(r'__.*__$', tree_path[-1])):
-                dataset.add_leaf_node(tree_path)
+        # Walk down the layers of the hierarchy, skipping the sub-trees of
+        # directories that aren't selected by the included/excluded filters
+        tree_paths = [()]
+        for depth, layer in enumerate(dataset.hierarchy):
+            is_leaf = depth == len(dataset.hierarchy) - 1
+            layer_paths = []
+            for tree_path in tree_paths:
+                with os.scandir(op.join(dataset.id, *tree_path)) as entries:
+                    for entry in entries:
+                        if (entry.is_dir(follow_symlinks=False)
+                                and not (is_leaf and re.match(r'__.*__$',
+                                                              entry.name))
+                                and dataset.selects(layer, entry.name)):
+                            layer_paths.append(tree_path + (entry.name,))
+            tree_paths = layer_paths
+        return tree_paths
+
+    def watermark(self, dataset: Dataset):
+        """
+        The current time, which the modification times of the directories
+        of nodes are compared against to find the nodes that have changed
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the watermark for
+
+        Returns
+        -------
+        int
+            The current time in nanoseconds since the epoch
+        """
+        return time.time_ns()
+
+    def find_changes(self, dataset: Dataset, watermark: int):
+        """
+        Finds the leaf nodes added or removed since the watermark by walking
+        the directories of the hierarchy again (which doesn't require the
+        leaf directories to be listed) and the nodes that have been modified
+        by checking the modification times of the directories (and fields
+        JSON files) of the nodes that items have already been found in, along
+        with those of the primary and side-car files (or directories) of the
+        items found in them, so files that are rewritten in place are also
+        detected. The contents of items stored as directories (e.g. DICOM
+        series) aren't walked, so files rewritten in place within them are
+        only picked up by a full refresh (see `Dataset.refresh`).
+        Modifications to nodes whose items haven't been
+        found yet don't need to be reported as they will be found from
+        scratch on access.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to find the changes to
+        watermark : int
+            The time the previous watermark was taken in nanoseconds since
+            the epoch
+
+        Returns
+        -------
+        DataTreeChanges
+            The changes to the dataset since the watermark
+        """
+        new_watermark = time.time_ns()
+        threshold = watermark - self.MTIME_MARGIN_NS
+        root_dir = Path(dataset.id)
+        leaves = {tuple(n.ids[h] for h in dataset.hierarchy): n.id
+                  for n in dataset.nodes(dataset.leaf_freq)}
+        tree_paths = set(tuple(p) for p in self._find_tree_paths(dataset))
+        changes = DataTreeChanges(
+            watermark=new_watermark,
+            added=sorted(tree_paths.difference(leaves)),
+            removed=[i for p, i in leaves.items() if p not in tree_paths])
+        removed = set(changes.removed)
+        for node in chain([dataset.root_node], dataset.nodes()):
+            unresolved = node._unresolved
+            if unresolved is None or (node.frequency == dataset.leaf_freq
+                                      and node.id in removed):
+                continue
+            node_dir = root_dir / self.node_path(node)
+            try:
+                modified = os.stat(node_dir).st_mtime_ns >= threshold
+            except FileNotFoundError:
+                # Items have been removed along with the directory
+                modified = bool(unresolved)
+            else:
+                try:
+                    modified |= (os.stat(node_dir / self.FIELDS_FNAME)
+                                 .st_mtime_ns >= threshold)
+                except FileNotFoundError:
+                    pass
+            if not modified:
+                modified = any(
+                    self._modified_since(p, threshold)
+                    for i in unresolved
+                    for p in getattr(i, 'file_paths', ()))
+            if modified:
+                changes.modified.append((node.frequency, node.id))
+        return changes
+
+    @classmethod
+    def _modified_since(cls, path, threshold):
+        """Whether a file or directory has been modified (or removed) since
+        the threshold"""
+        try:
+            return os.stat(path).st_mtime_ns >= threshold
+        except FileNotFoundError:
+            return True
+
+    def tree_version(self, dataset: Dataset):
+        """
+        Digests the modification times of all directories down to the depth
+        that items are stored at in the dataset (along with those of the
+        fields JSON files), which change whenever nodes or items are added or
+        removed. Directories at that depth (e.g. those of DICOM series) aren't
+        listed, so the cost depends on the number of items rather than the
+        number of files in the dataset.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the version of the data tree for
+
+        Returns
+        -------
+        str
+            A hex digest of the directory modification times
+        """
+        vhash = hashlib.sha1()
+        root_dir = str(dataset.root_dir)
+        # The directories to visit, their depths and the depths of the
+        # sub-trees of the top-level directories they are in
+        to_visit = [(root_dir, 0, None)]
+        while to_visit:
+            dpath, depth, max_depth = to_visit.pop()
+            vhash.update(
+                f"{op.relpath(dpath, root_dir)}:{os.stat(dpath).st_mtime_ns}\n"
+                .encode('utf-8'))
+            if depth == max_depth:
+                # Items are added to or removed from these directories, so
+                # their modification times are enough
+                continue
+            with os.scandir(dpath) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    if entry.is_dir(follow_symlinks=False):
+                        to_visit.append((
+                            entry.path, depth + 1,
+                            max_depth if depth else self._tree_version_depth(
+                                dataset, entry.name)))
+                    elif entry.name == self.FIELDS_FNAME:
+                        vhash.update(
+                            f"{entry.name}:{entry.stat().st_mtime_ns}\n"
+                            .encode('utf-8'))
+        return vhash.hexdigest()
+
+    def _tree_version_depth(self, dataset, top_dir):
+        """The depth below the root directory of the dataset that
+        directory modification times need to be checked at in order to detect
+        new nodes or items (i.e. the leaf node directories and the
+        sub-directories within them), within the sub-tree of the given
+        top-level directory"""
+        return len(dataset.hierarchy) + 1
 
     def find_items(self, data_node):
         # First ID can be omitted
@@ -186,15 +362,17 @@ class FileSystem(DataStore):
             data_node)
 
     def find_items_in_dir(self, dpath, data_node):
-        if not op.exists(dpath):
+        if not fs_cache.is_dir(dpath):
             return
-        # Filter contents of directory to omit fields JSON and provenance
+        # Filter contents of directory to omit fields JSON and provenance.
+        # The directory listing also caches the kinds of the files, so they
+        # don't need to be stat-ed again when the file groups are resolved
         filtered = []
-        for subpath in dpath.iterdir():
-            if not (subpath.name.startswith('.')
-                    or subpath.name == self.FIELDS_FNAME
-                    or subpath.name.endswith(self.PROV_SUFFIX)):
-                filtered.append(subpath.name)
+        for name in fs_cache.listdir(dpath):
+            if not (name.startswith('.')
+                    or name == self.FIELDS_FNAME
+                    or name.endswith(self.PROV_SUFFIX)):
+                filtered.append(name)
         # Group files and sub-dirs that match except for extensions
         matching = defaultdict(set)
         for fname in filtered:
@@ -119,3 +119,58 @@ def test_put_items(mutable_xnat_dataset: Dataset, caplog):
                     / mutable_xnat_dataset.id)
         mutable_xnat_dataset.refresh()
         check_inserted()  
+
+
+def test_single_listing_per_tree_load(work_dir, monkeypatch):
+    import arcana.data.stores.xnat.api
+    from arcana.data.stores.xnat.api import Xnat
+
+    class MockLogin():
+
+        def __init__(self):
+            self.queries = []
+
+        def get_json(self, uri, query=None):
+            self.queries.append(uri)
+            experiments = [
+                {'ID': f'E{i}', 'label': f'sess{i}', 'subject_label': f'subj{i}',
+                 'last_modified': '2021-01-01'} for i in range(3)]
+            if '/subjects/' in uri:
+                subject_label = uri.split('/')[-2]
+                experiments = [
+                    {k: v for k, v in e.items() if k != 'subject_label'}
+                    for e in experiments
+                    if e['subject_label'] == subject_label]
+            return {'ResultSet': {'Result': experiments}}
+
+        def disconnect(self):
+            pass
+
+    login = MockLogin()
+    monkeypatch.setattr(arcana.data.stores.xnat.api.xnat, 'connect',
+                        lambda **kwargs: login)
+    store = Xnat(server='http://xnat.example', cache_dir=work_dir)
+    for snapshot_dir in (None, work_dir / 'snapshots'):
+        login.queries.clear()
+        dataset = Dataset('proj', store=store,
+                          hierarchy=[Clinical.subject, Clinical.session],
+                          snapshot_dir=snapshot_dir)
+        assert sorted(dataset.node_ids(Clinical.session)) == [
+            'sess0', 'sess1', 'sess2']
+        # The watermark, tree version and nodes share one listing
+        assert len(login.queries) == 1
+        # Only the experiments of literally included subjects are listed
+        login.queries.clear()
+        dataset = Dataset('proj', store=store,
+                          hierarchy=[Clinical.subject, Clinical.session],
+                          included={Clinical.subject: ['subj0', 'subj2']},
+                          snapshot_dir=snapshot_dir)
+        assert sorted(dataset.node_ids(Clinical.session)) == ['sess0',
+                                                               'sess2']
+        assert sorted(login.queries) == [
+            '/data/projects/proj/subjects/subj0/experiments',
+            '/data/projects/proj/subjects/subj2/experiments']
+        # Refreshing lists the experiments again to find the changes
+        login.queries.clear()
+        assert dataset.refresh() is not None
+        assert len(login.queries) == 2
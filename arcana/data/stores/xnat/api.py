@@ -9,12 +9,13 @@ import logging
 import errno
 import json
 import re
+import hashlib
 from zipfile import ZipFile, BadZipfile
 import shutil
 import attr
 import xnat
 from arcana.core.utils import JSON_ENCODING
-from arcana.core.data.store import DataStore
+from arcana.core.data.store import DataStore, DataTreeChanges
 from arcana.core.data.node import DataNode
 from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaFileFormatError,
@@ -73,6 +74,11 @@ class Xnat(DataStore):
     race_condition_delay: int = attr.ib(default=30)
     _cached_datasets: ty.Dict[str, Dataset]= attr.ib(factory=dict, init=False)
     _login = attr.ib(default=None, init=False)
+    # Listings of the experiments of the subjects selected by datasets, which
+    # are shared by find_nodes, tree_version and watermark for the duration
+    # of the outermost connection context
+    _experiment_listings: ty.Dict[tuple, list] = attr.ib(factory=dict,
+                                                         init=False)
 
     type = 'xnat'
     MD5_SUFFIX = '.md5.json'
@@ -100,6 +106,13 @@ class Xnat(DataStore):
                               "exiting outer context")
         return self._login
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_login'] = None
+        state['_cached_datasets'] = {}
+        state['_experiment_listings'] = {}
+        return state
+
     def connect(self):
         """
         Parameters
@@ -120,6 +133,68 @@ class Xnat(DataStore):
     def disconnect(self):
         self.login.disconnect()
         self._login = None
+        self._experiment_listings.clear()
+
+    def list_experiments(self, dataset: Dataset, refresh: bool=False):
+        """
+        Lists the experiments of the subjects selected by the dataset with
+        their subject labels and last-modified dates. If the dataset only
+        includes a literal list of subjects, the experiments of each of those
+        subjects are listed, otherwise all experiments in the project are
+        listed in a single query. The listing is cached until the outermost
+        connection context is exited, so that taking the watermark of the
+        data tree and then versioning and enumerating it (see
+        `Dataset._load_tree`) only lists the experiments once
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to list the experiments of
+        refresh : bool
+            Whether to list the experiments again even if they are cached
+
+        Returns
+        -------
+        list[dict[str, str]]
+            The ID, label, subject_label and last_modified columns of each
+            experiment
+        """
+        subject_freq = dataset.hierarchy[0]
+        included_subjects = dataset.included.get(subject_freq)
+        if included_subjects is not None and included_subjects.is_literal:
+            subject_labels = tuple(sorted(included_subjects.ids))
+        else:
+            subject_labels = None
+        key = (dataset.id, subject_labels)
+        with self:
+            if refresh or key not in self._experiment_listings:
+                if subject_labels is None:
+                    # List all experiments in the project in a single query
+                    experiments = self.login.get_json(
+                        f'/data/projects/{dataset.id}/experiments',
+                        query={'columns':
+                               'ID,label,subject_label,last_modified'})[
+                            'ResultSet']['Result']
+                else:
+                    # Only list the experiments of the included subjects
+                    experiments = []
+                    for subject_label in subject_labels:
+                        try:
+                            subj_exps = self.login.get_json(
+                                f'/data/projects/{dataset.id}/subjects/'
+                                f'{subject_label}/experiments',
+                                query={'columns': 'ID,label,last_modified'})[
+                                    'ResultSet']['Result']
+                        except xnat.exceptions.XNATResponseError:
+                            logger.warning(
+                                "Included subject '%s' was not found in %s",
+                                subject_label, dataset.id)
+                            continue
+                        experiments.extend(
+                            dict(e, subject_label=subject_label)
+                            for e in subj_exps)
+                self._experiment_listings[key] = experiments
+            return self._experiment_listings[key]
 
     def find_nodes(self, dataset: Dataset, **kwargs):
         """
@@ -131,10 +206,95 @@ class Xnat(DataStore):
         dataset : Dataset
             The dataset to construct
         """
-        with self:
-            # Get per_dataset level derivatives and fields
-            for exp in self.login.projects[dataset.id].experiments.values():
-                dataset.add_leaf_node([exp.subject.label, exp.label])
+        subject_freq, session_freq = dataset.hierarchy
+        dataset.add_leaf_nodes(
+            (e['subject_label'], e['label'])
+            for e in self.list_experiments(dataset)
+            if (dataset.selects(subject_freq, e['subject_label'])
+                and dataset.selects(session_freq, e['label'])))
+
+    def tree_version(self, dataset: Dataset):
+        """
+        Digests the labels and last-modified dates of the experiments of the
+        subjects selected by the dataset (see `list_experiments`)
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the version of the data tree for
+
+        Returns
+        -------
+        str
+            A hex digest of the experiment modification dates
+        """
+        experiments = self.list_experiments(dataset)
+        vhash = hashlib.sha1()
+        for exp in sorted(experiments, key=lambda e: e['ID']):
+            vhash.update(
+                '{}:{}:{}\n'.format(exp['subject_label'], exp['label'],
+                                    exp.get('last_modified'))
+                .encode('utf-8'))
+        return vhash.hexdigest()
+
+    def watermark(self, dataset: Dataset):
+        """
+        The last-modified dates of all selected experiments, taken from the
+        listing of them that the data tree is enumerated from (see
+        `list_experiments`) so it doesn't require an extra query
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the watermark for
+
+        Returns
+        -------
+        dict[tuple[str, str], str]
+            The last-modified date of each experiment keyed by the labels of
+            its subject and itself
+        """
+        return self._experiment_dates(dataset,
+                                      self.list_experiments(dataset))
+
+    def _experiment_dates(self, dataset, experiments):
+        subject_freq, session_freq = dataset.hierarchy
+        return {(e['subject_label'], e['label']): e.get('last_modified')
+                for e in experiments
+                if (dataset.selects(subject_freq, e['subject_label'])
+                    and dataset.selects(session_freq, e['label']))}
+
+    def find_changes(self, dataset: Dataset, watermark: dict):
+        """
+        Finds the experiments that have been added, removed or modified since
+        the watermark by listing the selected experiments again and comparing
+        their last-modified dates against it. Changes to resources stored at the subject
+        or project level are not detected.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to find the changes to
+        watermark : dict[tuple[str, str], str]
+            The last-modified dates of the experiments previously returned by
+            `watermark`
+
+        Returns
+        -------
+        DataTreeChanges
+            The changes to the dataset since the watermark
+        """
+        new_watermark = self._experiment_dates(
+            dataset, self.list_experiments(dataset, refresh=True))
+        leaves = {tuple(n.ids[h] for h in dataset.hierarchy): n.id
+                  for n in dataset.nodes(dataset.leaf_freq)}
+        return DataTreeChanges(
+            watermark=new_watermark,
+            added=sorted(p for p in new_watermark if p not in leaves),
+            removed=[i for p, i in leaves.items() if p not in new_watermark],
+            modified=[(dataset.leaf_freq, leaves[p])
+                      for p, modified in new_watermark.items()
+                      if p in leaves and modified != watermark.get(p)])
 
     def find_items(self, data_node):
         with self:
@@ -332,8 +492,9 @@ class Xnat(DataStore):
             file_group.set_fs_paths(primary_path, side_car_paths)
             with open(append_suffix(cache_path, self.MD5_SUFFIX), 'w',
                       **JSON_ENCODING) as f:
-                json.dump(file_group.calculate_checksums(), f,
-                          indent=2)
+                # MD5 digests are compared with those calculated by XNAT
+                json.dump(file_group.calculate_checksums(
+                    engine=self.checksum_engine, algorithm='md5'), f, indent=2)
             # Save provenance
             if file_group.provenance:
                 self.put_provenance(file_group)
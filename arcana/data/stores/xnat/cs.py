@@ -23,6 +23,7 @@ from arcana import __version__
 from arcana.__about__ import install_requires, PACKAGE_NAME, python_versions
 from arcana.data.dimensions.clinical import Clinical
 from arcana.core.data.type import FileFormat
+from arcana.core.data.materialize import materialize
 from arcana.core.data.dimensions import DataDimensions
 from arcana.core.utils import resolve_class, DOCKER_HUB
 from arcana.exceptions import ArcanaFileFormatError, ArcanaUsageError, ArcanaNoDirectXnatMountException
@@ -135,14 +136,15 @@ class XnatViaCS(Xnat):
     def put_file_group(self, file_group, fs_path, side_cars):
         primary_path, side_car_paths = self.get_output_paths(file_group)
         if file_group.datatype.directory:
-            shutil.copytree(fs_path, primary_path)
+            materialize(fs_path, primary_path, self.copy_mode)
         else:
             os.makedirs(primary_path.parent, exist_ok=True)
             # Upload primary file and add to cache
-            shutil.copyfile(fs_path, primary_path)
+            materialize(fs_path, primary_path, self.copy_mode)
             # Upload side cars and add them to cache
             for sc_name, sc_src_path in side_cars.items():
-                shutil.copyfile(sc_src_path, side_car_paths[sc_name])
+                materialize(sc_src_path, side_car_paths[sc_name],
+                            self.copy_mode)
         # Update file-group with new values for local paths and XNAT URI
         file_group.set_fs_paths(primary_path, side_car_paths)
         file_group.uri = (self._make_uri(file_group.data_node)
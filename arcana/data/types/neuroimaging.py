@@ -3,16 +3,19 @@ from abc import ABCMeta, abstractmethod
 import os
 import os.path as op
 import json
+from concurrent.futures import ThreadPoolExecutor
 import pydicom
 import numpy as np
 import nibabel
 from pydra.tasks.dcm2niix import Dcm2Niix
 # Hack to get module to load until pydra-mrtrix is published on PyPI
 from pydra.tasks.mrtrix3.utils import MRConvert
-from arcana.exceptions import ArcanaUsageError
-from arcana.tasks.utils import identity_converter
+from arcana.exceptions import ArcanaUsageError, ArcanaFileFormatError
+from arcana.tasks.compression import gzip_file, gunzip_file, link_file
 from arcana.core.data.type import FileFormat
 from arcana.core.data.item import FileGroup
+from arcana.core.data.array import arrays_equal, rms_diff
+from arcana.core.data.header_cache import header_cache
 
 
 # class Dcm2niixConverter(Converter):
@@ -59,54 +62,66 @@ class BaseImage(FileGroup):
     IGNORE_HDR_KEYS = None
 
     @abstractmethod
-    def get_header(self, fileset):
+    def get_header(self):
         """
-        Returns array data associated with the given path for the
+        Returns header data associated with the given path for the
         file format
         """
 
     @abstractmethod
-    def get_array(self, fileset):
+    def get_array(self):
         """
-        Returns header data associated with the given path for the
+        Returns array data associated with the given path for the
         file format
         """
 
-    def contents_equal(self, fileset, other_fileset, rms_tol=None, **kwargs):
+    def get_array_proxy(self):
+        """
+        Returns a lazy proxy to the array data (e.g. a memory-mapped array),
+        which only reads the data that is sliced from it. Defaults to the
+        fully loaded array for formats that can't be read lazily
         """
-        Test whether the (relevant) contents of two image filesets are equal
-        given specific criteria
+        return self.get_array()
+
+    def contents_equal(self, other, rms_tol=None, chunk_size=None, **kwargs):
+        """
+        Test whether the (relevant) contents of two image file groups are
+        equal given specific criteria. The arrays are compared slab by slab
+        via their array proxies, returning as soon as they are found to
+        differ
 
         Parameters
         ----------
-        fileset : Fileset
-            One of the two filesets to compare
-        other_fileset : Fileset
-            The other fileset to compare
+        other : BaseImage
+            The other file group to compare
         rms_tol : float
             The root-mean-square tolerance that is acceptable between the array
             data for the images to be considered equal
+        chunk_size : int, optional
+            The maximum number of bytes read from each array at a time
         """
-        if other_fileset.datatype != self:
+        if other.datatype != self.datatype:
             return False
-        if self.headers_diff(fileset, other_fileset, **kwargs):
+        if self.headers_diff(other, **kwargs):
             return False
         if rms_tol:
-            rms_diff = self.rms_diff(fileset, other_fileset)
+            rms_diff = self.rms_diff(other, chunk_size=chunk_size,
+                                     stop_above=rms_tol)
             return (rms_diff < rms_tol)
         else:
-            return np.array_equiv(fileset.get_array(),
-                                  other_fileset.get_array())
+            return arrays_equal(self.get_array_proxy(),
+                                other.get_array_proxy(),
+                                chunk_size=chunk_size)
 
-    def headers_diff(self, fileset, other_fileset, include_keys=None,
-                     ignore_keys=None, **kwargs):
+    def headers_diff(self, other, include_keys=None, ignore_keys=None,
+                     **kwargs):
         """
         Check headers to see if all values
         """
         diff = []
-        hdr = fileset.get_header()
+        hdr = self.get_header()
         hdr_keys = set(hdr.keys())
-        other_hdr = other_fileset.get_header()
+        other_hdr = other.get_header()
         if include_keys is not None:
             if ignore_keys is not None:
                 raise ArcanaUsageError(
@@ -151,81 +166,168 @@ class BaseImage(FileGroup):
                     diff.append(key)
         return diff
 
-    def rms_diff(self, fileset, other_fileset):
+    def rms_diff(self, other, chunk_size=None, stop_above=None):
         """
-        Return the RMS difference between the image arrays
+        Return the RMS difference between the image arrays, accumulated slab
+        by slab (see `arcana.core.data.array.rms_diff`)
         """
-        return np.sqrt(np.sum((fileset.get_array()
-                               - other_fileset.get_array()) ** 2))
+        return rms_diff(self.get_array_proxy(), other.get_array_proxy(),
+                        chunk_size=chunk_size, stop_above=stop_above)
 
 
 class NiftiImage(BaseImage):
 
-    def get_header(self, fileset):
-        return dict(nibabel.load(fileset.path).header)
+    def get_header(self):
+        return header_cache.get(
+            'nifti_header', self.fs_path,
+            lambda: dict(nibabel.load(self.fs_path).header))
 
-    def get_array(self, fileset):
-        return nibabel.load(fileset.path).get_data()
+    def get_array(self):
+        return np.asanyarray(self.get_array_proxy())
 
-    def get_vox_sizes(self, fileset):
+    def get_array_proxy(self):
+        # Uncompressed images are memory-mapped by nibabel
+        return header_cache.get(
+            'nifti_proxy', self.fs_path,
+            lambda: nibabel.load(self.fs_path).dataobj)
+
+    def get_vox_sizes(self):
         # FIXME: This won't work for 4-D files
-        return self.get_header(fileset)['pixdim'][1:4]
+        return self.get_header()['pixdim'][1:4]
 
-    def get_dims(self, fileset):
+    def get_dims(self):
         # FIXME: This won't work for 4-D files
-        return self.get_header(fileset)['dim'][1:4]
+        return self.get_header()['dim'][1:4]
 
 
 class NiftixImage(NiftiImage):
 
-    def get_header(self, fileset):
-        hdr = super().get_header(fileset)
-        with open(fileset.aux_file('json')) as f:
-            hdr.update(json.load(f))
-        return hdr
+    def get_header(self):
+        def load():
+            hdr = dict(super(NiftixImage, self).get_header())
+            hdr.update(self.side_car_header())
+            return hdr
+        return header_cache.get(
+            'niftix_header', [self.fs_path, self.side_cars['json']], load)
 
+    def side_car_header(self):
+        """The parsed contents of the JSON side car"""
+        def load():
+            with open(self.side_cars['json']) as f:
+                return json.load(f)
+        return header_cache.get('json_side_car', self.side_cars['json'], load)
 
-class DicomImage(BaseImage):
+    def extract_metadata(self, keys):
+        """Extracts the values of fields of the JSON side car (e.g. the DICOM
+        keywords written by dcm2niix)"""
+        side_car = self.side_car_header()
+        return {k: side_car.get(k) for k in keys}
 
-    SERIES_NUMBER_TAG = ('0020', '0011')
 
-    def dcm_files(self, fileset):
-        return [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
+class DicomImage(BaseImage):
 
-    def get_array(self, fileset):
-        image_stack = []
-        for fname in self.dcm_files(fileset):
-            image_stack.append(
-                pydicom.dcmread(op.join(fileset.path, fname)).pixel_array)
-        return np.asarray(image_stack)
+    SERIES_NUMBER_TAG = ('0020', '0011')
+    MAX_WORKERS = None  # Threads used to read the files, by default n. CPUs
+
+    def dcm_files(self):
+        """The names of the DICOM files in the series, sorted by the
+        positions of the slices"""
+        return [f for f, _ in self.series_headers()]
+
+    def series_files(self):
+        """The names of the DICOM files in the series directory, in the
+        order they are listed"""
+        fnames = [f for f in os.listdir(self.fs_path) if f.endswith('.dcm')]
+        if not fnames:
+            # Directories of extension-less DICOMs (see FormatRegistry.sniff)
+            fnames = [f for f in os.listdir(self.fs_path)
+                      if not f.startswith('.')]
+        return fnames
+
+    def series_headers(self):
+        """Reads the headers (excluding the pixel data) of the files in the
+        series in parallel, sorting them by instance number and then by slice
+        position. The table is cached in the header cache, keyed by the
+        modification times and sizes of the directory and each of the files
+        in it, so the files are only read once unless files are added to,
+        removed from or rewritten in the series.
 
-    def get_header(self, fileset, index=0):
-        dcm_files = [f for f in os.listdir(fileset.path) if f.endswith('.dcm')]
+        Returns
+        -------
+        list[tuple[str, pydicom.Dataset]]
+            The file names and headers of the slices of the series
+        """
+        fnames = self.series_files()
+        return header_cache.get(
+            'dicom_series',
+            [self.fs_path] + [op.join(self.fs_path, f) for f in fnames],
+            lambda: self._read_series_headers(fnames))
+
+    def _read_series_headers(self, fnames):
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            headers = list(pool.map(
+                lambda f: pydicom.dcmread(op.join(self.fs_path, f),
+                                          stop_before_pixels=True),
+                fnames))
+        return sorted(zip(fnames, headers),
+                      key=lambda x: dicom_sort_key(x[1]) + (x[0],))
+
+    def get_array(self):
+        """Decodes the pixel data of the slices in parallel into a single
+        preallocated array in slice order"""
+        fpaths = [op.join(self.fs_path, f) for f in self.dcm_files()]
+        first = pydicom.dcmread(fpaths[0]).pixel_array
+        array = np.empty((len(fpaths),) + first.shape, dtype=first.dtype)
+        array[0] = first
+
+        def decode(index):
+            array[index] = pydicom.dcmread(fpaths[index]).pixel_array
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            list(pool.map(decode, range(1, len(fpaths))))
+        return array
+
+    def get_header(self, index=0):
         # TODO: Probably should collate fields that vary across the set of
         #       files in the set into lists
-        return pydicom.dcmread(op.join(fileset.path, dcm_files[index]))
-
-    def get_vox_sizes(self, fileset):
-        hdr = self.get_header(fileset)
-        return np.array(hdr.PixelSpacing + [hdr.SliceThickness])
-
-    def get_dims(self, fileset):
-        hdr = self.get_header(fileset)
-        return np.array((hdr.Rows, hdr.Columns, len(self.dcm_files(fileset))),
-                        datatype=int)
-
-    def extract_id(self, fileset):
-        return int(fileset.dicom_values([self.SERIES_NUMBER_TAG])[0])
-
-    def dicom_values(self, file_group, tags):
+        return self.series_headers()[index][1]
+
+    def get_vox_sizes(self):
+        hdr = self.get_header()
+        return np.array(list(hdr.PixelSpacing) + [hdr.SliceThickness])
+
+    def get_dims(self):
+        hdr = self.get_header()
+        return np.array((hdr.Rows, hdr.Columns, len(self.series_headers())),
+                        dtype=int)
+
+    def extract_id(self):
+        return int(self.dicom_values([self.SERIES_NUMBER_TAG])[0])
+
+    def extract_metadata(self, keys):
+        """Extracts the values of DICOM header fields, given by keyword
+        (e.g. 'SeriesDescription') or tag (e.g. '0008,103E'). The header is
+        read from the first file of the series or, if the series hasn't been
+        downloaded, via the store (e.g. XNAT's dicomdump service)"""
+        tags = {k: dicom_tag(k) for k in keys}
+        if (self.fs_path is None and self.data_node is not None
+                and hasattr(self.data_node.dataset.store, 'dicom_header')):
+            hdr = self.data_node.dataset.store.dicom_header(self)
+            return {k: hdr.get(t) for k, t in tags.items()}
+        dcm = self.get_header(0)
+        metadata = {}
+        for key, tag in tags.items():
+            elem = dcm.get(pydicom.tag.Tag(*(int(t, 16) for t in tag)))
+            metadata[key] = dicom_json_value(elem.value) if elem else None
+        return metadata
+
+    def dicom_values(self, tags):
         """
         Returns a dictionary with the DICOM header fields corresponding
         to the given tag names
 
         Parameters
         ----------
-        file_group : FileGroup
-            The file group to extract the DICOM header for
         tags : List[Tuple[str, str]]
             List of DICOM tag values as 2-tuple of strings, e.g.
             [('0080', '0020')]
@@ -235,13 +337,14 @@ class DicomImage(BaseImage):
         dct : Dict[Tuple[str, str], str|int|float]
         """
         try:
-            if (file_group._path is None and file_group._dataset is not None
-                    and hasattr(file_group.dataset.store, 'dicom_header')):
-                hdr = file_group.dataset.store.dicom_header(self)
+            if (self.fs_path is None and self.data_node is not None
+                    and hasattr(self.data_node.dataset.store,
+                                'dicom_header')):
+                hdr = self.data_node.dataset.store.dicom_header(self)
                 dct = [hdr[t] for t in tags]
             else:
                 # Get the DICOM object for the first file in the fileset
-                dcm = file_group.get_header(0)
+                dcm = self.get_header(0)
                 dct = [dcm[t].value for t in tags]
         except KeyError as e:
             e.msg = ("{} does not have dicom tag {}".format(
@@ -250,49 +353,171 @@ class DicomImage(BaseImage):
         return dct
 
 
+def dicom_tag(key):
+    """Converts a DICOM keyword (e.g. 'SeriesNumber') or tag (e.g. '0020,0011'
+    or ('0020', '0011')) into a tuple of hex strings, as used to look up
+    the values of DICOM headers
+
+    Parameters
+    ----------
+    key : str or tuple[str, str]
+        The keyword or tag
+
+    Returns
+    -------
+    tuple[str, str]
+        The group and element numbers of the tag
+    """
+    if isinstance(key, str):
+        if ',' in key:
+            key = key.strip('()').split(',')
+        else:
+            tag = pydicom.datadict.tag_for_keyword(key)
+            if tag is None:
+                raise ArcanaUsageError(f"Unrecognised DICOM keyword '{key}'")
+            key = (f'{tag >> 16:04X}', f'{tag & 0xFFFF:04X}')
+    return tuple(f'{int(str(k), 16):04X}' for k in key)
+
+
+def dicom_json_value(value):
+    """Converts a value of a DICOM header to a JSON-serialisable value so it
+    can be stored in the metadata index"""
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return [dicom_json_value(v) for v in value]
+    if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        return value
+    return str(value)
+
+
+def dicom_sort_key(header):
+    """Returns a key to sort the slices of a series by their instance
+    number, then by their position along the normal of the slice plane"""
+    instance = getattr(header, 'InstanceNumber', None)
+    position = 0.0
+    try:
+        orientation = np.array(header.ImageOrientationPatient, dtype=float)
+        position = float(np.dot(
+            np.cross(orientation[:3], orientation[3:]),
+            np.array(header.ImagePositionPatient, dtype=float)))
+    except (AttributeError, ValueError, TypeError):
+        pass
+    return (int(instance) if instance is not None else 0, position)
+
+
 class MrtrixImage(BaseImage):
 
-    def _load_header_and_array(self, fileset):
-        with open(fileset.path, 'rb') as f:
-            contents = f.read()
-        hdr_end = contents.find(b'\nEND\n')
-        hdr_contents = contents[:hdr_end].decode('utf-8')
-        hdr = dict(l.split(': ', maxsplit=1) for l in hdr_contents.split('\n'))
-        for key, value in list(hdr.items()):
-            if ',' in value:
+    # Numpy dtypes corresponding to the MRtrix datatypes (without the
+    # endianness suffix)
+    DTYPES = {
+        'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2',
+        'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8', 'UInt64': 'u8',
+        'Float32': 'f4', 'Float64': 'f8', 'CFloat32': 'c8',
+        'CFloat64': 'c16'}
+    # Header fields that are kept as strings
+    STR_HDR_KEYS = ('layout', 'file', 'datatype')
+
+    def get_header(self):
+        """Parses the text header of the image, which is read line by line up
+        to the 'END' line without reading any of the voxel data. Fields that
+        are repeated (e.g. 'transform') are collected into lists"""
+        return header_cache.get('mrtrix_header', self.fs_path,
+                                self._read_header)
+
+    def get_array_proxy(self):
+        """Memory-maps the data section of the image, with the dtype,
+        endianness, offset and strides declared in the header. The axes are
+        in the order of the 'dim' field, the stored values are not scaled"""
+        return header_cache.get('mrtrix_proxy', self.fs_path, self._map_array)
+
+    def _read_header(self):
+        hdr = {}
+        with open(self.fs_path, 'rb') as f:
+            magic = f.readline().decode('utf-8').strip()
+            if magic != 'mrtrix image':
+                raise ArcanaFileFormatError(
+                    f"{self.fs_path} is not an MRtrix image (starts with "
+                    f"'{magic}')")
+            for line in f:
+                line = line.decode('utf-8').rstrip('\n')
+                if line == 'END':
+                    break
+                key, value = line.split(': ', maxsplit=1)
+                if key not in self.STR_HDR_KEYS:
+                    value = self._parse_hdr_value(value)
+                if key in hdr:
+                    if not isinstance(hdr[key], list):
+                        hdr[key] = [hdr[key]]
+                    hdr[key].append(value)
+                else:
+                    hdr[key] = value
+        if 'transform' in hdr:
+            hdr['transform'] = np.array(hdr['transform'], dtype=float)
+        return hdr
+
+    def _map_array(self):
+        hdr = self.get_header()
+        fname, offset = hdr['file'].split()
+        if fname == '.':
+            data_path = self.fs_path
+        else:
+            data_path = op.join(op.dirname(self.fs_path), fname)
+        dims = np.atleast_1d(hdr['dim']).astype(int)
+        layout = hdr['layout'].split(',')
+        ranks = [abs(int(l)) for l in layout]
+        # The axes from the slowest to the fastest varying on disk
+        stored_axes = sorted(range(len(dims)), key=lambda a: -ranks[a])
+        array = np.memmap(data_path, dtype=self._dtype(hdr['datatype']),
+                          mode='r', offset=int(offset),
+                          shape=tuple(dims[a] for a in stored_axes))
+        array = array.transpose([stored_axes.index(a)
+                                 for a in range(len(dims))])
+        # Axes stored in reverse order are flipped back with negative strides
+        return array[tuple(slice(None, None, -1) if l.startswith('-')
+                           else slice(None) for l in layout)]
+
+    def get_array(self):
+        array = np.array(self.get_array_proxy())
+        scaling = self.get_header().get('scaling')
+        if scaling is not None:
+            offset, scale = scaling
+            if offset != 0.0 or scale != 1.0:
+                array = array * scale + offset
+        return array
+
+    def get_vox_sizes(self):
+        return self.get_header()['vox']
+
+    def get_dims(self):
+        return self.get_header()['dim']
+
+    @classmethod
+    def _dtype(cls, datatype):
+        endianness = '='
+        if datatype.endswith('LE'):
+            endianness, datatype = '<', datatype[:-2]
+        elif datatype.endswith('BE'):
+            endianness, datatype = '>', datatype[:-2]
+        try:
+            return np.dtype(endianness + cls.DTYPES[datatype])
+        except KeyError:
+            raise ArcanaFileFormatError(
+                f"Unsupported MRtrix datatype '{datatype}'")
+
+    @staticmethod
+    def _parse_hdr_value(value):
+        if ',' in value:
+            for dtype in (int, float):
                 try:
-                    hdr[key] = np.array(value.split(','), datatype=int)
+                    return np.array(value.split(','), dtype=dtype)
                 except ValueError:
-                    try:
-                        hdr[key] = np.array(value.split(','), datatype=float)
-                    except ValueError:
-                        pass
-            else:
+                    pass
+        else:
+            for dtype in (int, float):
                 try:
-                    hdr[key] = int(value)
+                    return dtype(value)
                 except ValueError:
-                    try:
-                        hdr[key] = float(value)
-                    except ValueError:
-                        pass
-        del hdr['mrtrix image']  # Delete "magic line" at start of header
-        array_start = int(hdr['file'].split()[1])
-        array = np.asarray(contents[array_start:])
-        dim = [hdr['dim'][int(l[1])] for l in hdr['layout']]
-        array = array.reshape(dim)
-        return hdr, array
-
-    def get_header(self, fileset):
-        return self._load_header_and_array(fileset)[0]
-
-    def get_array(self, fileset):
-        return self._load_header_and_array(fileset)[1]
-
-    def get_vox_sizes(self, fileset):
-        return self.get_header(fileset)['vox']
-
-    def get_dims(self, fileset):
-        return self.get_header(fileset)['dim']
+                    pass
+        return value
 
 
 # =====================================================================
@@ -351,16 +576,17 @@ niftix.set_converter(dicom, Dcm2Niix, compress='n', out_dir='.',
 nifti.set_converter(dicom, Dcm2Niix, out_dir='.',
                     inputs={'primary': 'in_dir'})
 nifti.set_converter(analyze, MRConvert, out_file='file.nii')
-nifti.set_converter(nifti_gz, MRConvert, out_file='file.nii')
 nifti.set_converter(mrtrix_image, MRConvert, out_file='file.nii')
-nifti.set_converter(niftix_gz, MRConvert, out_file='file.nii')
+# Only the compression (and side car) differ, so convert in process
+nifti.set_converter(nifti_gz, gunzip_file)
+nifti.set_converter(niftix_gz, gunzip_file)
 
 nifti_gz.set_converter(dicom, Dcm2Niix, compress='y', out_dir='.',
                        inputs={'primary': 'in_dir'})
-nifti_gz.set_converter(nifti, MRConvert, out_file="file.nii.gz")
 nifti_gz.set_converter(analyze, MRConvert, out_file="file.nii.gz")
 nifti_gz.set_converter(mrtrix_image, MRConvert, out_file="file.nii.gz")
-nifti_gz.set_converter(niftix_gz, identity_converter)
+nifti_gz.set_converter(nifti, gzip_file)
+nifti_gz.set_converter(niftix_gz, link_file)
 
 analyze.set_converter(dicom, MRConvert, out_file="file.hdr")
 analyze.set_converter(nifti, MRConvert, out_file="file.hdr")
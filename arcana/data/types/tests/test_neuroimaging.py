@@ -0,0 +1,148 @@
+import os
+import json
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from arcana.data.types.neuroimaging import (
+    dicom, mrtrix_image, niftix, DicomImage)
+from arcana.data.stores.file_system import FileSystem
+from arcana.data.dimensions.clinical import Clinical
+
+
+def write_dicom_series(dpath, n_slices=4, rows=3, cols=5, ext='.dcm',
+                       description='series'):
+    dpath.mkdir(parents=True)
+    series_uid = generate_uid()
+    for i in range(n_slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = 7
+        ds.SeriesDescription = description
+        ds.InstanceNumber = i + 1
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [0, 0, 2 * i]
+        ds.PixelSpacing = [0.5, 0.5]
+        ds.SliceThickness = 2.0
+        ds.Rows, ds.Columns = rows, cols
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = np.full((rows, cols), i, dtype=np.uint16).tobytes()
+        # Write the slices in reverse so listing order doesn't match
+        ds.save_as(dpath / f'{n_slices - i:04}{ext}', enforce_file_format=True)
+
+
+def rewrite_dicom_series(dpath, **values):
+    """Rewrites the files of a series in place, without modifying the
+    directory"""
+    dir_stat = os.stat(dpath)
+    for fpath in sorted(dpath.iterdir()):
+        ds = pydicom.dcmread(fpath)
+        for keyword, value in values.items():
+            setattr(ds, keyword, value)
+        mtime = os.stat(fpath).st_mtime_ns + 10 ** 9
+        ds.save_as(fpath, enforce_file_format=True)
+        os.utime(fpath, ns=(mtime, mtime))
+    os.utime(dpath, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+
+def test_dicom_series_loader(work_dir, monkeypatch):
+    write_dicom_series(work_dir / 'series')
+    image = dicom.from_path(str(work_dir / 'series'))
+    array = image.get_array()
+    assert array.shape == (4, 3, 5)
+    assert [int(s[0, 0]) for s in array] == [0, 1, 2, 3]
+    assert list(image.get_dims()) == [3, 5, 4]
+    assert list(image.get_vox_sizes()) == [0.5, 0.5, 2.0]
+    # The header table is cached, so the files aren't read again
+    monkeypatch.setattr(pydicom, 'dcmread', None)
+    assert image.dicom_values([(0x0020, 0x0011)]) == [7]
+    assert image.extract_id() == 7
+    assert image.dcm_files()[0] == '0004.dcm'
+    # Files rewritten in place are read again
+    monkeypatch.undo()
+    rewrite_dicom_series(work_dir / 'series', SeriesNumber=9)
+    assert image.extract_id() == 9
+
+
+def write_mif(path, array, layout, datatype='Int16BE', dtype='>i2',
+              data=True):
+    ranks = [abs(int(l)) for l in layout]
+    stored_axes = sorted(range(array.ndim), key=lambda a: -ranks[a])
+    stored = array[tuple(slice(None, None, -1) if l.startswith('-')
+                         else slice(None) for l in layout)]
+    stored = stored.transpose(stored_axes).astype(dtype)
+    lines = ['mrtrix image',
+             'dim: ' + ','.join(str(d) for d in array.shape),
+             'vox: 2,2,2.5',
+             'layout: ' + ','.join(layout),
+             'datatype: ' + datatype,
+             'transform: 1,0,0,0',
+             'transform: 0,1,0,0',
+             'transform: 0,0,1,0',
+             'file: . 256',
+             'END\n']
+    header = '\n'.join(lines).encode('utf-8')
+    path.write_bytes(header.ljust(256, b'\0')
+                     + (stored.tobytes() if data else b''))
+
+
+def test_mrtrix_memmap_reader(work_dir):
+    array = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    write_mif(work_dir / 'image.mif', array, ['-0', '+2', '+1'])
+    image = mrtrix_image.from_path(str(work_dir / 'image.mif'))
+    proxy = image.get_array_proxy()
+    assert isinstance(proxy.base, np.memmap)
+    assert proxy.dtype == np.dtype('>i2')
+    assert (proxy == array).all()
+    assert (image.get_array() == array).all()
+    # The header is read without touching the voxel data
+    write_mif(work_dir / 'truncated.mif', array, ['+0', '+1', '+2'],
+              data=False)
+    truncated = mrtrix_image.from_path(str(work_dir / 'truncated.mif'))
+    assert list(truncated.get_dims()) == [3, 4, 5]
+    assert list(truncated.get_vox_sizes()) == [2, 2, 2.5]
+    hdr = truncated.get_header()
+    assert hdr['transform'].shape == (3, 4)
+    assert hdr['layout'] == '+0,+1,+2'
+
+
+def test_metadata_index(work_dir, monkeypatch):
+    root = work_dir / 'dataset'
+    for desc in ('dwi_a', 'dwi_b'):
+        write_dicom_series(root / 'sess1' / desc, n_slices=2,
+                           description=desc)
+    index_dir = work_dir / 'metadata'
+
+    def match():
+        dataset = FileSystem().dataset(root, hierarchy=[Clinical.session],
+                                       metadata_dir=index_dir)
+        dataset.add_source('dwi', dicom, path='dwi_.*', is_regex=True,
+                           metadata={'SeriesDescription': 'dwi_b',
+                                     '0020,0011': 7})
+        plan = dataset.match_columns()
+        return plan.items['dwi']['sess1']
+
+    assert match().path == 'dwi_b'
+    # The metadata is looked up from the persistent index the second time
+    monkeypatch.setattr(DicomImage, 'extract_metadata', None)
+    assert match().path == 'dwi_b'
+    # Entries are invalidated when the files within a series are rewritten
+    monkeypatch.undo()
+    rewrite_dicom_series(root / 'sess1' / 'dwi_b', SeriesDescription='dwi_c')
+    rewrite_dicom_series(root / 'sess1' / 'dwi_a', SeriesDescription='dwi_b')
+    assert match().path == 'dwi_a'
+    # NIfTI-X metadata is read from the JSON side car
+    (work_dir / 'image.nii').write_bytes(b'')
+    (work_dir / 'image.json').write_text(json.dumps({'EchoTime': 0.05}))
+    image = niftix.from_path(str(work_dir / 'image.nii'))
+    assert image.metadata('EchoTime') == 0.05
+    assert image.metadata('RepetitionTime') is None
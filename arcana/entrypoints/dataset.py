@@ -1,8 +1,11 @@
 
 import os
+from pathlib import Path
+from collections import defaultdict
 from importlib import import_module
 from arcana.data.dimensions.clinical import Clinical
 from arcana.exceptions import ArcanaUsageError
+from arcana.core.data.selector import IdSelector
 from arcana.data.stores.file_system import FileSystem
 from arcana.data.stores.xnat import Xnat
 from arcana.data.stores.xnat.cs import XnatViaCS
@@ -35,17 +38,19 @@ class BaseDatasetCmd(BaseCmd):
             action='append',
             help=("The nodes to include in the dataset. First value is the "
                   "frequency of the ID (e.g. 'group', 'subject', 'session') "
-                  "followed by the IDs to be included in the dataset. "
+                  "followed by the ID to be included in the dataset. "
                   "If the second arg contains '/' then it is interpreted as "
-                  "the path to a text file containing a list of IDs"))
+                  "the path to a text file containing a list of IDs, and if "
+                  "it contains any other regular expression special "
+                  "characters it is interpreted as a regular expression that "
+                  "the IDs need to match. Can be provided multiple times"))
         parser.add_argument(
             '--excluded', nargs=2, default=[], metavar=('FREQ', 'ID'),
             action='append',
             help=("The nodes to exclude from the dataset. First value is the "
                   "frequency of the ID (e.g. 'group', 'subject', 'session') "
-                  "followed by the IDs to be included in the dataset. "
-                  "If the second arg contains '/' then it is interpreted as "
-                  "the path to a text file containing a list of IDs"))    
+                  "followed by the ID to be excluded from the dataset. "
+                  "Takes the same forms as '--included'"))    
         parser.add_argument(
             '--dataspace', type=str, default='clinical.Clinical',
             help=("The enum that specifies the data dimensions of the dataset. "
@@ -78,6 +83,11 @@ class BaseDatasetCmd(BaseCmd):
                   "in the data tree, and what each layer corresponds to, "
                   "needs to specified. Defaults to all the hierarchy in the "
                   "data dimensions"))
+        parser.add_argument(
+            '--snapshot_dir', default=None,
+            help=("Directory to save a snapshot of the data tree in, which is "
+                  "loaded instead of re-enumerating the store on subsequent "
+                  "runs if the store reports that the tree hasn't changed"))
 
     @classmethod
     def get_dataset(cls, args, work_dir):
@@ -133,22 +143,19 @@ class BaseDatasetCmd(BaseCmd):
             hierarchy = [max(dimensions)]
 
         def parse_ids(ids_args):
-            parsed_ids = {}
-            for iargs in ids_args:
-                freq = dimensions[iargs.pop(0)]
-                if len(iargs) == 1 and '/' in iargs[0]:
-                    with open(args.ids[0]) as f:
-                        ids = f.read().split()
-                else:
-                    ids = args.ids
-                parsed_ids[freq] = ids
-            return parsed_ids
+            selectors = defaultdict(list)
+            for freq, id_arg in ids_args:
+                if '/' in id_arg:
+                    id_arg = Path(id_arg)
+                selectors[dimensions[freq]].append(IdSelector.parse(id_arg))
+            return {f: IdSelector.union(s) for f, s in selectors.items()}
         
         return store.dataset(args.dataset_name,
                                   hierarchy=hierarchy,
                                   id_inference=id_inference,
                                   included=parse_ids(args.included),
-                                  excluded=parse_ids(args.excluded))
+                                  excluded=parse_ids(args.excluded),
+                                  snapshot_dir=args.snapshot_dir)
 
     @classmethod
     def parse_dataspace(cls, args):
@@ -5,16 +5,15 @@ import typing as ty
 import tempfile
 import logging
 from typing import Sequence, Dict
-import arcana.data.types
 from arcana.exceptions import ArcanaUsageError
-from arcana.core.data.type import FileFormat
+from arcana.core.data.type import FileFormat, format_registry
 from arcana.core.data.dimensions import DataDimensions
 from arcana.core.data.enum import DataQuality
 from arcana import __version__
 from arcana.tasks.bids import construct_bids, extract_bids, bids_app
 from .dataset import BaseDatasetCmd
 from arcana.core.utils import (
-    resolve_class, resolve_datatype, list_instances, set_loggers)
+    resolve_class, resolve_datatype, set_loggers)
 
 logger = logging.getLogger('arcana')
 
@@ -176,15 +175,14 @@ class RunCmd(BaseDatasetCmd):
             datatype = resolve_datatype(datatype_name.lower())
         elif '.' in path:
             path = Path(path)
-            path_ext = '.'.join(path.suffixes)
+            path_ext = ''.join(path.suffixes)
             # Strip suffix from path
-            path = path.parent / path.stem
-            # FIXME: Need a more robust way of determining datatype
-            # from output path extension
-            for dtype in list_instances(arcana.data.types, FileFormat):
-                if dtype.extension == path_ext:
-                    datatype = dtype
-                    break
+            path = path.parent / path.name[:-len(path_ext)]
+            matches = format_registry.by_ext(path_ext)
+            if matches:
+                # Prefer formats without side cars, e.g. nifti_gz over
+                # niftix_gz for '.nii.gz'
+                datatype = min(matches, key=lambda f: len(f.side_cars))
         if datatype is None:
             datatype = default
         return path, datatype
@@ -10,6 +10,7 @@ from pydra.engine.specs import (
     MultiInputObj, MultiOutputObj, File, Directory)
 from arcana.core.utils import set_cwd
 from arcana.exceptions import ArcanaUsageError
+from .compression import open_parallel_gzip
 
 
 TAR_COMPRESSION_TYPES = ['gz', 'bz2', 'xz']
@@ -48,12 +49,24 @@ def create_tar(in_file, out_file=None, base_dir='.', filter=None,
 
     out_file = os.path.abspath(out_file)
 
-    with tarfile.open(
-            out_file, mode=f'w:{compression}', format=format,
-            ignore_zeros=ignore_zeros,
-            encoding=encoding) as tfile, set_cwd(base_dir):
-        for path in in_file:
-            tfile.add(relative_path(path, base_dir), filter=filter)
+    if compression == 'gz':
+        # Compress in parallel blocks instead of single-threaded zlib
+        fileobj = open_parallel_gzip(out_file)
+        mode = 'w:'
+    else:
+        fileobj = None
+        mode = f'w:{compression}'
+
+    try:
+        with tarfile.open(
+                out_file, mode=mode, fileobj=fileobj, format=format,
+                ignore_zeros=ignore_zeros,
+                encoding=encoding) as tfile, set_cwd(base_dir):
+            for path in in_file:
+                tfile.add(relative_path(path, base_dir), filter=filter)
+    finally:
+        if fileobj is not None:
+            fileobj.close()
 
     return out_file
 
@@ -0,0 +1,186 @@
+import os
+import io
+import gzip
+import zlib
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import attr
+from pydra import mark
+from pydra.engine.specs import File
+from arcana.core.data.enum import CopyMode
+from arcana.core.data.materialize import materialize
+
+
+CHUNK_SIZE = 2 ** 20  # Stream files in 1MB chunks to bound memory usage
+GZIP_BLOCK_SIZE = 2 ** 20  # Size of the blocks compressed in parallel
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """A pigz-style writer that splits the data written to it into blocks,
+    which are compressed concurrently in a thread pool (zlib releases the GIL
+    while it compresses) and written out in order as consecutive gzip
+    members. Multi-member gzip files are part of the gzip standard (RFC 1952)
+    and are read transparently by gzip/zlib readers, including nibabel and
+    tarfile. At most two blocks per thread are held in memory at a time.
+
+    Parameters
+    ----------
+    fileobj : file-like
+        The binary file object to write the compressed data to
+    compresslevel : int
+        The zlib compression level
+    block_size : int
+        The number of bytes of uncompressed data in each gzip member
+    max_workers : int, optional
+        The number of threads to compress the blocks with, by default the
+        number of CPUs
+    close_fileobj : bool
+        Whether to close the file object when the writer is closed
+    """
+
+    def __init__(self, fileobj, compresslevel=6, block_size=GZIP_BLOCK_SIZE,
+                 max_workers=None, close_fileobj=False):
+        super().__init__()
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.close_fileobj = close_fileobj
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_pending = 2 * max_workers
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._offset = 0
+        self._n_blocks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast('B')
+        self._buffer += data
+        self._offset += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        """The number of uncompressed bytes written"""
+        return self._offset
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # Empty input still needs a (single) valid gzip member
+            if self._buffer or not self._n_blocks:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            self.fileobj.flush()
+        finally:
+            self._pool.shutdown()
+            if self.close_fileobj:
+                self.fileobj.close()
+            super().close()
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(
+            compress_block, block, self.compresslevel))
+        self._n_blocks += 1
+        while len(self._pending) > self._max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+
+def compress_block(block, compresslevel=6):
+    """Compresses a block of data into a complete gzip member (zlib writes
+    a minimal header with a zero modification time)"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def open_parallel_gzip(path, compresslevel=6, max_workers=None):
+    """Opens a file for writing gzip-compressed data in parallel blocks
+
+    Parameters
+    ----------
+    path : str or Path
+        The path of the gzip file to write
+    compresslevel : int
+        The zlib compression level
+    max_workers : int, optional
+        The number of threads to compress with, by default the number of CPUs
+
+    Returns
+    -------
+    ParallelGzipWriter
+        The writer, which closes the file when it is closed
+    """
+    return ParallelGzipWriter(open(path, 'wb'), compresslevel=compresslevel,
+                              max_workers=max_workers, close_fileobj=True)
+
+
+def output_path(in_file, out_file, strip_ext='', add_ext=''):
+    """Returns the absolute path of the output file, by default the name of
+    the input file in the current working directory with the extension
+    stripped/added"""
+    if out_file is None or out_file == attr.NOTHING:
+        out_file = os.path.basename(in_file)
+        if strip_ext and out_file.endswith(strip_ext):
+            out_file = out_file[:-len(strip_ext)]
+        out_file += add_ext
+    return os.path.abspath(out_file)
+
+
+@mark.task
+@mark.annotate({
+    'in_file': File,
+    'out_file': str,
+    'compresslevel': int,
+    'return': {
+        'out_file': File}})
+def gzip_file(in_file, out_file=None, compresslevel=6):
+    """Compresses a file with gzip in process, streaming it in chunks that
+    are compressed in parallel (see `ParallelGzipWriter`). The modification
+    times in the gzip headers are zero so that the output only depends on the
+    contents of the input"""
+    out_file = output_path(in_file, out_file, add_ext='.gz')
+    with open(in_file, 'rb') as f_in, open_parallel_gzip(
+            out_file, compresslevel=compresslevel) as f_out:
+        shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+    return out_file
+
+
+@mark.task
+@mark.annotate({
+    'in_file': File,
+    'out_file': str,
+    'return': {
+        'out_file': File}})
+def gunzip_file(in_file, out_file=None):
+    """Decompresses a gzipped file in process, streaming it in chunks"""
+    out_file = output_path(in_file, out_file, strip_ext='.gz')
+    with gzip.open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+    return out_file
+
+
+@mark.task
+@mark.annotate({
+    'in_file': File,
+    'out_file': str,
+    'return': {
+        'out_file': File}})
+def link_file(in_file, out_file=None):
+    """Hard links (falling back to cloning/copying) the primary file of a
+    file group to a new location, for conversions that only drop side cars"""
+    out_file = output_path(in_file, out_file)
+    materialize(in_file, out_file, CopyMode.hardlink)
+    return out_file
@@ -0,0 +1,57 @@
+import os
+import gzip
+from arcana.tasks.compression import (
+    gzip_file, gunzip_file, link_file, ParallelGzipWriter, open_parallel_gzip)
+from arcana.data.types.neuroimaging import nifti, nifti_gz, niftix_gz
+
+
+def test_gzip_roundtrip(work_dir):
+    data = os.urandom(3 * 2 ** 20 + 17)
+    in_file = work_dir / 'image.nii'
+    in_file.write_bytes(data)
+    gz_files = []
+    for i in range(2):
+        gz_files.append(work_dir / f'image{i}.nii.gz')
+        gzip_file(in_file=str(in_file), out_file=str(gz_files[-1]))()
+    # Outputs only depend on the contents of the input
+    assert gz_files[0].read_bytes() == gz_files[1].read_bytes()
+    assert gzip.decompress(gz_files[0].read_bytes()) == data
+    out_file = work_dir / 'unzipped.nii'
+    gunzip_file(in_file=str(gz_files[0]), out_file=str(out_file))()
+    assert out_file.read_bytes() == data
+    linked = work_dir / 'linked.nii.gz'
+    link_file(in_file=str(gz_files[0]), out_file=str(linked))()
+    assert linked.samefile(gz_files[0])
+
+
+def test_nifti_gz_converters(work_dir):
+    assert nifti.converter(nifti_gz).task is gunzip_file
+    assert nifti_gz.converter(nifti).task is gzip_file
+    src_dir = work_dir / 'src'
+    src_dir.mkdir()
+    (src_dir / 'image.nii.gz').write_bytes(gzip.compress(b'voxels'))
+    (src_dir / 'image.json').write_text('{}')
+    file_group = niftix_gz.from_path(str(src_dir / 'image.nii.gz'))
+    converted = nifti.converter(niftix_gz).convert(
+        file_group, cache_dir=work_dir / 'cache')
+    assert converted.datatype == nifti
+    assert converted.fs_path.read_bytes() == b'voxels'
+    converted = nifti_gz.converter(niftix_gz).convert(
+        file_group, cache_dir=work_dir / 'cache')
+    assert converted.fs_path.samefile(src_dir / 'image.nii.gz')
+
+
+def test_parallel_gzip_writer(work_dir):
+    data = os.urandom(2 ** 16) * 20 + b'tail'
+    path = work_dir / 'blocks.gz'
+    with open(path, 'wb') as f:
+        with ParallelGzipWriter(f, block_size=2 ** 14, max_workers=3) as gz:
+            for i in range(0, len(data), 5000):
+                gz.write(data[i:i + 5000])
+            assert gz.tell() == len(data)
+        assert not f.closed
+    with gzip.open(path) as f:
+        assert f.read() == data
+    with open_parallel_gzip(work_dir / 'empty.gz'):
+        pass
+    assert gzip.decompress((work_dir / 'empty.gz').read_bytes()) == b''
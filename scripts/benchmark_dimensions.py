@@ -0,0 +1,50 @@
+"""Micro-benchmark of the frequency algebra of the `Clinical` data dimensions,
+comparing the precomputed lookup tables against constructing new enum members
+for each operation (as DataDimensions did before the tables were added)
+"""
+import timeit
+from arcana.data.dimensions.clinical import Clinical
+
+
+def and_reference(a, b):
+    return type(a)(a.value & b.value)
+
+
+def sub_reference(a, b):
+    return type(a)(a.value - b.value)
+
+
+def nonzero_basis_reference(freq):
+    cls = type(freq)
+    return [cls(b) for b in sorted(freq.nonzero_bits(), reverse=True)]
+
+
+def is_parent_reference(parent, child):
+    return (and_reference(parent, child).value == parent.value
+            and child.value != parent.value)
+
+
+pairs = [(a, b) for a in Clinical for b in Clinical]
+sub_pairs = [(a, b) for a, b in pairs if b.is_parent(a, if_match=True)]
+
+BENCHMARKS = {
+    '&': (lambda: [a & b for a, b in pairs],
+          lambda: [and_reference(a, b) for a, b in pairs]),
+    '-': (lambda: [a - b for a, b in sub_pairs],
+          lambda: [sub_reference(a, b) for a, b in sub_pairs]),
+    'is_parent': (lambda: [a.is_parent(b) for a, b in pairs],
+                  lambda: [is_parent_reference(a, b) for a, b in pairs]),
+    'nonzero_basis': (lambda: [f.nonzero_basis() for f in Clinical],
+                      lambda: [nonzero_basis_reference(f) for f in Clinical])}
+
+
+if __name__ == '__main__':
+    number = 2000
+    print(f"{'operation':<15}{'tables (s)':>12}{'reference (s)':>15}"
+          f"{'speedup':>10}")
+    for name, (tables, reference) in BENCHMARKS.items():
+        assert tables() == reference()
+        t_tables = min(timeit.repeat(tables, number=number, repeat=5))
+        t_ref = min(timeit.repeat(reference, number=number, repeat=5))
+        print(f"{name:<15}{t_tables:>12.4f}{t_ref:>15.4f}"
+              f"{t_ref / t_tables:>9.1f}x")
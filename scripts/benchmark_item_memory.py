@@ -0,0 +1,49 @@
+"""Measures the memory used by the unresolved items found in the nodes of a
+large dataset (e.g. a 50k session XNAT project with ~15 scans per session).
+Usage: python benchmark_item_memory.py [N_SESSIONS]
+"""
+import sys
+import tracemalloc
+from pathlib import Path
+from tempfile import mkdtemp
+from arcana.core.data.node import UnresolvedFileGroup, UnresolvedField
+from arcana.data.stores.file_system import FileSystem
+from arcana.data.dimensions.clinical import Clinical
+
+
+SCANS = ['t1w', 't2w', 'flair', 'dwi', 'dwi_ref', 'fmap_mag', 'fmap_phase',
+         'rest_bold', 'rest_sbref', 'task1_bold', 'task1_sbref', 'task2_bold',
+         'task2_sbref', 'swi', 'asl']
+
+
+def build_items(dataset, n_sessions, root):
+    dataset.add_leaf_nodes([f'sub{i}', f'sub{i}_MR01']
+                           for i in range(n_sessions))
+    items = []
+    for node in dataset.nodes(Clinical.session):
+        session_dir = f'{root}/{node.ids[Clinical.subject]}/{node.id}'
+        for i, scan in enumerate(SCANS):
+            items.append(UnresolvedFileGroup(
+                path=scan, data_node=node, order=i,
+                file_paths=[f'{session_dir}/{scan}.txt']))
+        items.append(UnresolvedField(path='age', data_node=node, value='42'))
+    return items
+
+
+def measure(n_sessions):
+    root = mkdtemp()
+    dataset = FileSystem().dataset(
+        root, hierarchy=[Clinical.subject, Clinical.session])
+    tracemalloc.start()
+    items = build_items(dataset, n_sessions, root)
+    nbytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    Path(root).rmdir()
+    return len(items), nbytes
+
+
+if __name__ == '__main__':
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_items, nbytes = measure(n_sessions)
+    print(f"{n_items} unresolved items in {n_sessions} sessions: "
+          f"{nbytes / 2 ** 20:.1f} MiB ({nbytes / n_items:.0f} bytes/item)")